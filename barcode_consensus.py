@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import itertools
+import os
+import tempfile
+
+import numpy as np
+
+import run_metrics
+from barcode_index import BarcodeIndex, decode_barcodes, encode_barcodes
+from columnar import load_barcode_variant_counter, read_table, table_variants, variant_columns, write_table
+
+OBSERVATION_DTYPE = np.dtype([('key', '<u8'), ('variant_id', '<i4'), ('count', '<i8')])
+DEFAULT_CHUNK_SIZE = 1000000
+DEFAULT_MAX_BARCODES_IN_MEMORY = 20000000
+OUTCOMES = ['accepted', 'low_reads', 'collision', 'invalid']
+# bases of the randomized barcodes of the library, the length barcode_mapping.py checks barcodes against
+LIBRARY_BARCODE_LENGTH = 26
+
+
+def reduce_observations(observations):
+    """Sums the counts of identical (key, variant id) pairs
+
+    Args:
+        observations: OBSERVATION_DTYPE array
+
+    Returns:
+        OBSERVATION_DTYPE array sorted by key and variant id with one row per distinct pair
+    """
+    if not len(observations):
+        return observations
+    order = np.lexsort((observations['variant_id'], observations['key']))
+    observations = observations[order]
+    new_pair = np.ones(len(observations), dtype=bool)
+    new_pair[1:] = (observations['key'][1:] != observations['key'][:-1]) | \
+        (observations['variant_id'][1:] != observations['variant_id'][:-1])
+    starts = np.flatnonzero(new_pair)
+    reduced = observations[starts]
+    reduced['count'] = np.add.reduceat(observations['count'], starts)
+    return reduced
+
+
+def resolve_barcodes(observations, min_reads=1, min_purity=0.9):
+    """Resolves every barcode of reduced observations to its most frequent variant
+
+    Args:
+        observations: OBSERVATION_DTYPE array from reduce_observations
+        min_reads: reads a barcode needs to be accepted
+        min_purity: fraction of the reads of a barcode that has to support its most frequent variant. barcodes
+            whose top two variants are tied are always collisions
+
+    Returns:
+        tuple of sorted uint64 keys, int32 top variant ids, int64 reads per barcode, float purity per barcode and
+        array of outcome indices into OUTCOMES
+    """
+    order = np.lexsort((-observations['count'], observations['key']))
+    observations = observations[order]
+    new_key = np.ones(len(observations), dtype=bool)
+    new_key[1:] = observations['key'][1:] != observations['key'][:-1]
+    starts = np.flatnonzero(new_key)
+    reads = np.add.reduceat(observations['count'], starts) if len(starts) else np.zeros(0, dtype=np.int64)
+    top = observations[starts]
+    # the second row of a barcode, if it has one, holds its second most frequent variant
+    second_rows = np.minimum(starts + 1, len(observations) - 1)
+    has_second = np.zeros(len(starts), dtype=bool)
+    has_second[:-1] = starts[1:] > starts[:-1] + 1
+    if len(starts):
+        has_second[-1] = len(observations) > starts[-1] + 1
+    tied = has_second & (observations['count'][second_rows] == top['count'])
+    purity = top['count'] / np.maximum(reads, 1)
+
+    outcomes = np.full(len(starts), OUTCOMES.index('accepted'), dtype=np.int8)
+    outcomes[reads < min_reads] = OUTCOMES.index('low_reads')
+    outcomes[(reads >= min_reads) & (tied | (purity < min_purity))] = OUTCOMES.index('collision')
+    return top['key'], top['variant_id'], reads, purity, outcomes
+
+
+class BarcodeConsensus(object):
+    """Streams barcode, variant observations (one per read) into per barcode variant counts and resolves each
+    barcode to one variant. barcodes are held as 2 bit packed keys; once more than max_barcodes_in_memory distinct
+    barcode, variant pairs are held, they are spilled to partition files by the leading bits of their key, and
+    each partition is resolved on its own, so memory is bounded by the largest partition. barcodes of another
+    length than barcode_length are counted as invalid. without a barcode_length, the most common length of the
+    reads of the first chunk_size observations is used"""
+
+    def __init__(self, barcode_length=None, min_reads=1, min_purity=0.9,
+                 max_barcodes_in_memory=DEFAULT_MAX_BARCODES_IN_MEMORY, partition_bits=4, tmp_dir=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.barcode_length = barcode_length
+        self.min_reads = min_reads
+        self.min_purity = min_purity
+        self.max_barcodes_in_memory = max_barcodes_in_memory
+        self.partition_bits = partition_bits
+        self.tmp_dir = tmp_dir
+        self.chunk_size = chunk_size
+        self.variants = []
+        self.variant_id_dict = {}
+        # reads with a barcode of the wrong length or with ambiguous bases, by variant id
+        self.invalid_reads = collections.Counter()
+        self._chunks = []
+        self._chunk_rows = 0
+        self._spill_dir = None
+
+    def add(self, barcode_variants):
+        """Adds an iterable of (barcode string, variant) observations, one per read"""
+        self.add_counts((barcode, variant, 1) for barcode, variant in barcode_variants)
+
+    def add_counter(self, barcode_variant_counter):
+        """Adds a dictionary of barcode keys and Counter values of variant read counts"""
+        self.add_counts((barcode, variant, count) for barcode, variant_counter in barcode_variant_counter.items()
+                        for variant, count in variant_counter.items())
+
+    def add_counts(self, barcode_variant_counts):
+        """Adds an iterable of (barcode string, variant, read count) observations"""
+        if self.barcode_length is None:
+            # a single truncated first read must not set the length every other barcode is checked against
+            barcode_variant_counts = iter(barcode_variant_counts)
+            first_chunk = list(itertools.islice(barcode_variant_counts, self.chunk_size))
+            length_reads = collections.Counter()
+            for barcode, variant, count in first_chunk:
+                length_reads[len(barcode)] += count
+            if not length_reads:
+                return
+            self.barcode_length = length_reads.most_common(1)[0][0]
+            barcode_variant_counts = itertools.chain(first_chunk, barcode_variant_counts)
+        barcodes = []
+        variant_ids = []
+        counts = []
+        for barcode, variant, count in barcode_variant_counts:
+            variant_id = self.variant_id_dict.get(variant)
+            if variant_id is None:
+                variant_id = self.variant_id_dict[variant] = len(self.variants)
+                self.variants.append(variant)
+            if len(barcode) != self.barcode_length:
+                self.invalid_reads[variant_id] += count
+                continue
+            barcodes.append(barcode.encode())
+            variant_ids.append(variant_id)
+            counts.append(count)
+            if len(barcodes) == self.chunk_size:
+                self._add_chunk(barcodes, variant_ids, counts)
+                barcodes, variant_ids, counts = [], [], []
+        if barcodes:
+            self._add_chunk(barcodes, variant_ids, counts)
+
+    def _add_chunk(self, barcodes, variant_ids, counts):
+        keys, valid = encode_barcodes(np.array(barcodes, dtype='S{0}'.format(self.barcode_length)))
+        variant_ids = np.array(variant_ids, dtype=np.int32)
+        counts = np.array(counts, dtype=np.int64)
+        for variant_id, count in zip(variant_ids[~valid].tolist(), counts[~valid].tolist()):
+            self.invalid_reads[variant_id] += count
+        observations = np.empty(int(valid.sum()), dtype=OBSERVATION_DTYPE)
+        observations['key'] = keys[valid]
+        observations['variant_id'] = variant_ids[valid]
+        observations['count'] = counts[valid]
+        observations = reduce_observations(observations)
+        self._chunks.append(observations)
+        self._chunk_rows += len(observations)
+        if self._chunk_rows > self.max_barcodes_in_memory:
+            self._chunks = [reduce_observations(np.concatenate(self._chunks))]
+            self._chunk_rows = len(self._chunks[0])
+            if self._chunk_rows > self.max_barcodes_in_memory // 2:
+                self._spill()
+
+    def _partition_files(self):
+        return [os.path.join(self._spill_dir.name, 'partition{0}.bin'.format(partition))
+                for partition in range(2 ** self.partition_bits)]
+
+    def _spill(self):
+        """Appends the reduced in memory observations to one file per partition of leading key bits"""
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.TemporaryDirectory(dir=self.tmp_dir)
+            print('Distinct barcodes exceed memory budget, spilling to {0}'.format(self._spill_dir.name))
+        observations = self._chunks[0]
+        shift = np.uint64(max(2 * self.barcode_length - self.partition_bits, 0))
+        partitions = (observations['key'] >> shift).astype(np.int64)
+        # observations are sorted by key, so every partition is one contiguous slice
+        bounds = np.searchsorted(partitions, np.arange(2 ** self.partition_bits + 1))
+        for partition_file, start, end in zip(self._partition_files(), bounds[:-1], bounds[1:]):
+            if end > start:
+                with open(partition_file, 'ab') as f:
+                    observations[start:end].tofile(f)
+        self._chunks = []
+        self._chunk_rows = 0
+
+    def _partitions(self):
+        """Yields fully reduced observations one partition at a time"""
+        if self._spill_dir is None:
+            yield reduce_observations(np.concatenate(self._chunks)) if self._chunks else \
+                np.zeros(0, dtype=OBSERVATION_DTYPE)
+            return
+        if self._chunks:
+            self._chunks = [reduce_observations(np.concatenate(self._chunks))]
+            self._spill()
+        for partition_file in self._partition_files():
+            if os.path.exists(partition_file):
+                yield reduce_observations(np.fromfile(partition_file, dtype=OBSERVATION_DTYPE))
+
+    def resolve(self):
+        """Resolves all barcodes added so far and releases spilled partitions
+
+        Returns:
+            tuple of BarcodeIndex of accepted barcodes and ConsensusStats
+        """
+        index_keys, index_variant_ids = [], []
+        stats = ConsensusStats(self.variants, self.min_reads, self.min_purity)
+        for variant_id, read_count in self.invalid_reads.items():
+            stats.reads[variant_id, OUTCOMES.index('invalid')] += read_count
+        for observations in self._partitions():
+            keys, variant_ids, reads, purity, outcomes = resolve_barcodes(
+                observations, self.min_reads, self.min_purity)
+            stats.add(variant_ids, reads, outcomes)
+            accepted = outcomes == OUTCOMES.index('accepted')
+            index_keys.append(keys[accepted])
+            index_variant_ids.append(variant_ids[accepted])
+        if self._spill_dir is not None:
+            self._spill_dir.cleanup()
+            self._spill_dir = None
+        self._chunks = []
+        self._chunk_rows = 0
+        for outcome, totals in stats.summary().items():
+            run_metrics.count('barcodes_' + outcome, totals['barcodes'])
+            run_metrics.count('barcode_reads_' + outcome, totals['reads'])
+
+        # partitions are in key order, so the keys are sorted already. variant ids are renumbered to the sorted
+        # variant order of BarcodeIndex.from_dict
+        variants = sorted(self.variants)
+        new_ids = np.zeros(len(self.variants), dtype=np.int32)
+        new_ids[[self.variant_id_dict[variant] for variant in variants]] = np.arange(len(variants), dtype=np.int32)
+        keys = np.concatenate(index_keys) if index_keys else np.zeros(0, dtype=np.uint64)
+        variant_ids = new_ids[np.concatenate(index_variant_ids)] if index_variant_ids else np.zeros(0, np.int32)
+        barcode_index = BarcodeIndex(keys, variant_ids, [tuple(variant) for variant in variants],
+                                     self.barcode_length or 0)
+        return barcode_index, stats
+
+
+class ConsensusStats(object):
+    """Per variant counts of barcodes and reads by consensus outcome: accepted, low_reads, collision (no variant
+    reached the purity threshold) and invalid (barcode of the wrong length or with ambiguous bases, counted in
+    reads only). collisions and low read barcodes are attributed to their most frequent variant"""
+
+    def __init__(self, variants, min_reads, min_purity):
+        self.variants = variants
+        self.min_reads = min_reads
+        self.min_purity = min_purity
+        self.barcodes = np.zeros((len(variants), len(OUTCOMES)), dtype=np.int64)
+        self.reads = np.zeros((len(variants), len(OUTCOMES)), dtype=np.int64)
+
+    def add(self, variant_ids, reads, outcomes):
+        np.add.at(self.barcodes, (variant_ids, outcomes), 1)
+        np.add.at(self.reads, (variant_ids, outcomes), reads)
+
+    def summary(self):
+        """dict of total barcodes and reads per outcome"""
+        return {outcome: {'barcodes': int(self.barcodes[:, column].sum()), 'reads': int(self.reads[:, column].sum())}
+                for column, outcome in enumerate(OUTCOMES)}
+
+    def variant_barcode_counter(self, outcome='accepted'):
+        """Counter of variants and number of barcodes with the given outcome, the library_barcode_counter that
+        barcode_mapping.library_coverage takes"""
+        column = self.barcodes[:, OUTCOMES.index(outcome)]
+        return collections.Counter({variant: int(count) for variant, count in zip(self.variants, column.tolist())
+                                    if count})
+
+    def save(self, stats_file, metadata=None):
+        order = sorted(range(len(self.variants)), key=lambda variant_id: self.variants[variant_id])
+        columns = variant_columns([self.variants[variant_id] for variant_id in order])
+        for column, outcome in enumerate(OUTCOMES):
+            columns['{0}_barcodes'.format(outcome)] = self.barcodes[order, column]
+            columns['{0}_reads'.format(outcome)] = self.reads[order, column]
+        write_table(stats_file, columns, dict(metadata or {}, min_reads=self.min_reads, min_purity=self.min_purity,
+                                              summary=self.summary()))
+
+    @classmethod
+    def load(cls, stats_file):
+        columns, metadata = read_table(stats_file, mmap=False)
+        stats = cls(table_variants(columns), metadata['min_reads'], metadata['min_purity'])
+        for column, outcome in enumerate(OUTCOMES):
+            stats.barcodes[:, column] = columns['{0}_barcodes'.format(outcome)]
+            stats.reads[:, column] = columns['{0}_reads'.format(outcome)]
+        return stats
+
+
+def print_consensus_summary(stats):
+    print('outcome\tbarcodes\treads')
+    for outcome, totals in stats.summary().items():
+        print('{0}\t{1}\t{2}'.format(outcome, totals['barcodes'], totals['reads']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to resolve every barcode of a barcode variant counter
+    table or pickle to a single variant by read count and purity, and write the barcode index used by
+    variant_fitness.py""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-c', '--counter_file', required=True,
+                          help='barcode variant counter table or pickle from bowtie_barcode_library_dict.py')
+    parser.add_argument('-o', '--output', default='barcode_index.bcidx', help='barcode index file to write')
+    parser.add_argument('-s', '--stats', default='barcode_consensus.col',
+                        help='per variant table of barcode and read counts by consensus outcome')
+    parser.add_argument('-r', '--min_reads', type=int, default=1, help='reads a barcode needs to be accepted')
+    parser.add_argument('-p', '--min_purity', type=float, default=0.9,
+                        help='fraction of reads of a barcode that has to support its most frequent variant')
+    parser.add_argument('-l', '--barcode_length', type=int,
+                        help='length of barcodes, barcodes of other lengths are rejected. default: most common '
+                             'length of the first barcodes')
+    parser.add_argument('-d', '--decode', action='store_true', help='print accepted barcodes and variants')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    consensus = BarcodeConsensus(args.barcode_length, args.min_reads, args.min_purity)
+    with metrics.stage('load barcode variant counter'):
+        barcode_variant_counter = load_barcode_variant_counter(args.counter_file)
+    with metrics.stage('add barcode variant counts', len(barcode_variant_counter), profile=True):
+        consensus.add_counter(barcode_variant_counter)
+    with metrics.stage('resolve barcode consensus'):
+        consensus_index, consensus_stats = consensus.resolve()
+    consensus_index.save(args.output)
+    consensus_stats.save(args.stats, {'counter_file': args.counter_file})
+    print_consensus_summary(consensus_stats)
+    if args.decode:
+        for barcode, variant_id in zip(decode_barcodes(consensus_index.keys, consensus_index.barcode_length),
+                                       consensus_index.variant_ids.tolist()):
+            print('{0}\t{1}'.format(barcode, consensus_index.variants[variant_id]))
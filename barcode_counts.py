@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+
+import numpy as np
+
+import run_metrics
+from barcode_index import BarcodeIndex
+from columnar import read_table, write_table
+
+
+class BarcodeCountMatrix(object):
+    """Sparse barcodes x timepoints read count matrix. only barcodes with reads are stored, as their row in the
+    barcode index they were counted against, so per variant counts of any subset of barcodes are one grouped sum
+    over the variant ids of the index
+
+    Args:
+        rows: (barcodes,) int32 array of barcode index rows, ascending
+        counts: (barcodes, timepoints) integer array of read counts
+        index_version: BarcodeIndex.version of the index the rows refer to
+    """
+
+    def __init__(self, rows, counts, index_version):
+        self.rows = rows
+        self.counts = counts
+        self.index_version = index_version
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def timepoints(self):
+        return self.counts.shape[1]
+
+    @classmethod
+    def from_barcode_counts(cls, barcode_index, barcode_counts):
+        """Builds the matrix from one dense count array per timepoint, aligned with the rows of barcode_index"""
+        dense = np.stack([np.asarray(counts, dtype=np.int64) for counts in barcode_counts], axis=1)
+        rows = np.flatnonzero(dense.any(axis=1))
+        counts = dense[rows]
+        # most libraries fit 32 bit counts, which halves the file
+        if not len(counts) or counts.max() <= np.iinfo(np.uint32).max:
+            counts = counts.astype(np.uint32)
+        return cls(rows.astype(np.int32), counts, barcode_index.version)
+
+    def save(self, table_file, metadata=None):
+        """Writes the matrix as a table of barcode_row and counts columns"""
+        write_table(table_file, {'barcode_row': self.rows, 'counts': self.counts},
+                    dict(metadata or {}, barcode_index_version=self.index_version))
+
+    @classmethod
+    def load(cls, table_file):
+        columns, metadata = read_table(table_file, mmap=False)
+        return cls(columns['barcode_row'], columns['counts'], metadata['barcode_index_version'])
+
+    def check_index(self, barcode_index):
+        """Raises IOError if the matrix was counted against a different barcode index"""
+        if barcode_index.version != self.index_version:
+            raise IOError('barcode counts were counted against barcode index {0}, not {1}'.format(
+                self.index_version, barcode_index.version))
+
+    def barcode_filter(self, barcode_index, min_reads=0, min_first_reads=0, max_variant_fraction=None):
+        """Mask of the barcodes to keep
+
+        Args:
+            barcode_index: BarcodeIndex the matrix was counted against
+            min_reads: reads a barcode needs over all timepoints
+            min_first_reads: reads a barcode needs at the first timepoint
+            max_variant_fraction: largest share of the first timepoint reads of its variant a barcode may have.
+                barcodes above it are jackpots, e.g. from PCR or a second mutation, that would dominate their
+                variant
+
+        Returns:
+            boolean array aligned with the stored barcodes
+        """
+        self.check_index(barcode_index)
+        keep = self.counts.sum(axis=1) >= min_reads
+        keep &= self.counts[:, 0] >= min_first_reads
+        if max_variant_fraction is not None:
+            variant_ids = barcode_index.variant_ids[self.rows]
+            variant_first_reads = np.bincount(variant_ids, weights=self.counts[:, 0],
+                                              minlength=len(barcode_index.variants))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fractions = self.counts[:, 0] / variant_first_reads[variant_ids]
+            # a variant with a single barcode is never its own outlier
+            barcodes_per_variant = np.bincount(variant_ids, minlength=len(barcode_index.variants))
+            keep &= (fractions <= max_variant_fraction) | (barcodes_per_variant[variant_ids] == 1)
+        return keep
+
+    def variant_counts(self, barcode_index, keep=None):
+        """Sums the counts of the kept barcodes of every variant
+
+        Returns:
+            (variants, timepoints) int64 array aligned with barcode_index.variants
+        """
+        self.check_index(barcode_index)
+        rows, counts = (self.rows, self.counts) if keep is None else (self.rows[keep], self.counts[keep])
+        variant_ids = barcode_index.variant_ids[rows]
+        variant_counts = np.zeros((len(barcode_index.variants), self.timepoints), dtype=np.int64)
+        for timepoint in range(self.timepoints):
+            variant_counts[:, timepoint] = np.bincount(variant_ids, weights=counts[:, timepoint],
+                                                       minlength=len(barcode_index.variants))
+        return variant_counts
+
+    def variant_counter(self, barcode_index, keep=None, pseudocount=0.5):
+        """defaultdict with variants as keys and lists of read counts plus pseudocount per timepoint as values, as
+        returned by variant_fitness.variant_counter_from_fastqs"""
+        variant_counter = collections.defaultdict(lambda: [pseudocount] * self.timepoints)
+        variant_counts = self.variant_counts(barcode_index, keep)
+        for variant_id in np.flatnonzero(variant_counts.any(axis=1)).tolist():
+            variant_counter[barcode_index.variants[variant_id]] = (variant_counts[variant_id] + pseudocount).tolist()
+        return variant_counter
+
+
+if __name__ == '__main__':
+    # variant_fitness imports this module to write the matrix while counting
+    from variant_fitness import print_poor_fits, variant_fitness_statistics, write_count_table, write_fitness_table
+
+    parser = argparse.ArgumentParser(description="""script to aggregate a barcode count matrix written while counting
+    into per variant counts and fitness again, with barcode filters and without reading the fastqs""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-c', '--barcode_counts', required=True, help='barcode count matrix written by counting')
+    required.add_argument('-b', '--barcode_index', required=True,
+                          help='barcode index file the matrix was counted against')
+    parser.add_argument('-r', '--min_reads', type=int, default=0, help='reads a barcode needs over all timepoints')
+    parser.add_argument('-f', '--min_first_reads', type=int, default=0,
+                        help='reads a barcode needs at the first timepoint')
+    parser.add_argument('-x', '--max_variant_fraction', type=float,
+                        help='drop barcodes with more than this share of the first timepoint reads of their variant')
+    parser.add_argument('-t', '--timepoints', nargs='*', type=float,
+                        help='time of each count column, e.g. generations or hours. defaults to 0, 1, 2, ...')
+    parser.add_argument('--weights', nargs='*', type=float,
+                        help='weight of each timepoint in the fitness regression')
+    parser.add_argument('-n', '--name_suffix')
+    parser.add_argument('--counts_only', action='store_true',
+                        help='write per variant counts to variant_counts.col without fitting fitness')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    barcode_count_matrix = BarcodeCountMatrix.load(args.barcode_counts)
+    library_index = BarcodeIndex.load(args.barcode_index)
+    with metrics.stage('filter barcodes', len(barcode_count_matrix)):
+        kept_barcodes = barcode_count_matrix.barcode_filter(library_index, args.min_reads, args.min_first_reads,
+                                                            args.max_variant_fraction)
+    run_metrics.count('barcodes', len(barcode_count_matrix))
+    run_metrics.count('barcodes_kept', int(kept_barcodes.sum()))
+    run_metrics.count('reads', int(barcode_count_matrix.counts.sum()))
+    run_metrics.count('reads_kept', int(barcode_count_matrix.counts[kept_barcodes].sum()))
+    print('Kept {0} of {1} barcodes with {2} of {3} reads'.format(
+        int(kept_barcodes.sum()), len(barcode_count_matrix), int(barcode_count_matrix.counts[kept_barcodes].sum()),
+        int(barcode_count_matrix.counts.sum())))
+    with metrics.stage('aggregate variant counts', int(kept_barcodes.sum())):
+        variant_timepoint_counter = barcode_count_matrix.variant_counter(library_index, kept_barcodes)
+    metadata = {
+        'sample': args.name_suffix,
+        'barcode_counts': args.barcode_counts,
+        'barcode_index': args.barcode_index,
+        'barcode_filter': {'min_reads': args.min_reads, 'min_first_reads': args.min_first_reads,
+                           'max_variant_fraction': args.max_variant_fraction},
+    }
+    suffix = '_{0}'.format(args.name_suffix) if args.name_suffix else ''
+    if args.counts_only:
+        write_count_table('variant_counts{0}.col'.format(suffix), variant_timepoint_counter, metadata)
+    else:
+        with metrics.stage('fit fitness', len(variant_timepoint_counter)):
+            variants, fitness_statistics = variant_fitness_statistics(variant_timepoint_counter, args.timepoints,
+                                                                      args.weights)
+        print_poor_fits(variants, fitness_statistics)
+        write_fitness_table('variant_fitness{0}.col'.format(suffix), variant_timepoint_counter, variants,
+                            fitness_statistics, dict(metadata, timepoints=args.timepoints or list(
+                                range(barcode_count_matrix.timepoints)), weights=args.weights))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+
+import numpy as np
+
+import run_metrics
+from fastq_reader import fastq_batches
+
+# constant sequence downstream of the barcode in timepoint reads
+FLANK = 'GAGCTCTCTAGAGGGCCGCATCATG'
+DEFAULT_ANCHOR_LENGTH = 12
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+for base, complement in zip(b'ACGTacgt', b'TGCAtgca'):
+    COMPLEMENT[base] = complement
+
+
+class BarcodeExtractor(object):
+    """Locates the barcode of every read of a fastq batch. without a flank the barcode is the fixed window
+    seq[offset:offset + barcode_length]. with a flank, the first anchor_length bases of the flank are searched for
+    right after every candidate barcode offset from min_offset to max_offset, allowing flank_mismatches
+    substitutions, and the barcode is read upstream of the best match. with reverse_complement, reads without a
+    forward match are searched for the reverse complement of the anchor and their barcode is reverse complemented.
+    all offsets are barcode starts counted from the first base of the read as sequenced. in reverse complemented
+    reads the barcode follows the reverse complemented anchor, so reverse offsets below anchor_length find nothing.
+    they default to the forward offsets plus anchor_length, i.e. the reverse anchor starts within the forward offsets.
+    reads are searched in whole batches with numpy, one comparison per candidate offset. with a quality filter,
+    barcodes whose bases fail its thresholds are dropped like barcodes that were not found
+
+    Args:
+        barcode_length: bases per barcode, None to use the length of the barcode index counted against
+        offset: start of the barcode in reads without a flank
+        flank: constant sequence following the barcode, None for fixed offset extraction
+        min_offset: first candidate barcode start with a flank
+        max_offset: last candidate barcode start with a flank
+        flank_mismatches: substitutions allowed between read and anchor
+        anchor_length: bases of the flank compared, shorter anchors tolerate reads ending inside the flank
+        reverse_complement: also search reverse complemented reads
+        reverse_min_offset: first candidate reverse complemented barcode start, None for min_offset + anchor_length
+        reverse_max_offset: last candidate reverse complemented barcode start, None for max_offset + anchor_length
+        quality_filter: optional quality_filter.QualityFilter applied to the qualities of the barcode bases
+    """
+
+    def __init__(self, barcode_length=20, offset=0, flank=None, min_offset=0, max_offset=10, flank_mismatches=1,
+                 anchor_length=DEFAULT_ANCHOR_LENGTH, reverse_complement=False, quality_filter=None,
+                 reverse_min_offset=None, reverse_max_offset=None):
+        assert min_offset <= max_offset, 'min_offset has to be at most max_offset'
+        self.barcode_length = barcode_length
+        self.offset = offset
+        self.flank = flank.upper() if flank else None
+        self.min_offset = min_offset
+        self.max_offset = max_offset
+        self.flank_mismatches = flank_mismatches
+        self.anchor_length = min(anchor_length, len(flank)) if flank else anchor_length
+        self.reverse_complement = reverse_complement
+        self.reverse_min_offset = min_offset + self.anchor_length if reverse_min_offset is None else reverse_min_offset
+        self.reverse_max_offset = max_offset + self.anchor_length if reverse_max_offset is None else reverse_max_offset
+        self.quality_filter = quality_filter
+        if self.flank and reverse_complement:
+            assert self.reverse_max_offset >= self.anchor_length, \
+                'reverse_max_offset has to be at least the anchor length {0}, reverse complemented barcodes start ' \
+                'after the reverse complemented anchor'.format(self.anchor_length)
+            assert self.reverse_min_offset <= self.reverse_max_offset, \
+                'reverse_min_offset has to be at most reverse_max_offset'
+        if self.flank:
+            self.anchor = np.frombuffer(self.flank[:self.anchor_length].encode(), dtype=np.uint8)
+            self.reverse_anchor = COMPLEMENT[self.anchor][::-1]
+
+    def settings(self):
+        """json serializable extraction settings for cache keys and table metadata, None for the default
+        extraction of the first barcode_length bases without quality filter"""
+        if self.flank:
+            settings = {'flank': self.flank, 'min_offset': self.min_offset, 'max_offset': self.max_offset,
+                        'flank_mismatches': self.flank_mismatches, 'anchor_length': self.anchor_length,
+                        'reverse_complement': self.reverse_complement}
+            if self.reverse_complement:
+                settings['reverse_min_offset'] = self.reverse_min_offset
+                settings['reverse_max_offset'] = self.reverse_max_offset
+        elif self.offset:
+            settings = {'offset': self.offset}
+        else:
+            settings = {}
+        if self.quality_filter is not None:
+            settings['quality'] = self.quality_filter.settings()
+        return settings or None
+
+    def _search(self, fastq_batch, rows, first_anchor_start, positions, anchor):
+        """best anchor position of the reads of a batch at rows, from first_anchor_start on over positions
+
+        Returns:
+            tuple of index of the best position and its mismatches, per read
+        """
+        seq_starts = fastq_batch.seq_starts[rows]
+        anchor_starts = first_anchor_start + np.arange(positions)
+        mismatches = np.full((len(seq_starts), positions), len(anchor) + 1, dtype=np.uint8)
+        # anchors starting before the read are mismatches. only the window from the read start on is gathered, as
+        # a window starting before the first read of the batch would wrap around to the end of the buffer
+        skipped = min(max(-first_anchor_start, 0), positions)
+        if skipped < positions:
+            window = fastq_batch.fixed_width(seq_starts + anchor_starts[skipped], positions - skipped + len(anchor) - 1)
+            candidates = np.lib.stride_tricks.sliding_window_view(window, len(anchor), axis=1)
+            mismatches[:, skipped:] = (candidates != anchor).sum(axis=2, dtype=np.uint8)
+        outside = anchor_starts + len(anchor) > fastq_batch.seq_lengths[rows, None]
+        mismatches[outside] = len(anchor) + 1
+        best = mismatches.argmin(axis=1)
+        return best, mismatches[np.arange(len(best)), best]
+
+    def extract(self, fastq_batch, match_counter=None):
+        """Barcodes of all reads of a batch
+
+        Args:
+            fastq_batch: fastq_reader.FastqBatch
+            match_counter: optional Counter incremented with barcode_offset_forward_<offset>,
+                barcode_offset_reverse_<offset>, barcode_flank_not_found and barcode_low_quality read counts
+
+        Returns:
+            numpy bytes array (dtype S<barcode_length>), empty strings for reads without a barcode
+        """
+        if not self.flank:
+            barcodes = fastq_batch.sequence_window(self.offset, self.barcode_length)
+            if self.quality_filter is not None:
+                found = np.flatnonzero(fastq_batch.seq_lengths >= self.offset + self.barcode_length)
+                self._filter_quality(fastq_batch, barcodes, found, self.offset, match_counter)
+            return barcodes
+        length = self.barcode_length
+        barcodes = np.zeros((len(fastq_batch), length), dtype=np.uint8)
+        best, best_mismatches = self._search(fastq_batch, slice(None), self.min_offset + length,
+                                             self.max_offset - self.min_offset + 1, self.anchor)
+        forward = np.flatnonzero(best_mismatches <= self.flank_mismatches)
+        offsets = self.min_offset + best[forward]
+        barcodes[forward] = fastq_batch.fixed_width(fastq_batch.seq_starts[forward] + offsets, length)
+        reverse = np.zeros(0, dtype=np.int64)
+        reverse_offsets = np.zeros(0, dtype=np.int64)
+        if self.reverse_complement:
+            # only reads without a forward flank are searched again. the reverse complemented anchor ends right
+            # before the reverse complemented barcode
+            remaining = np.flatnonzero(best_mismatches > self.flank_mismatches)
+            reverse_best, reverse_mismatches = self._search(
+                fastq_batch, remaining, self.reverse_min_offset - self.anchor_length,
+                self.reverse_max_offset - self.reverse_min_offset + 1, self.reverse_anchor)
+            reverse_offsets = self.reverse_min_offset + reverse_best
+            found = (reverse_mismatches <= self.flank_mismatches) & \
+                (reverse_offsets + length <= fastq_batch.seq_lengths[remaining])
+            reverse, reverse_offsets = remaining[found], reverse_offsets[found]
+            barcodes[reverse] = COMPLEMENT[fastq_batch.fixed_width(
+                fastq_batch.seq_starts[reverse] + reverse_offsets, length)][:, ::-1]
+        if match_counter is not None:
+            for strand, strand_offsets in (('forward', offsets), ('reverse', reverse_offsets)):
+                offset_counts = np.bincount(strand_offsets)
+                for offset in np.flatnonzero(offset_counts).tolist():
+                    match_counter['barcode_offset_{0}_{1}'.format(strand, offset)] += int(offset_counts[offset])
+            match_counter['barcode_flank_not_found'] += len(fastq_batch) - len(forward) - len(reverse)
+        barcodes = np.ascontiguousarray(barcodes).view('S{0}'.format(length)).ravel()
+        if self.quality_filter is not None:
+            self._filter_quality(fastq_batch, barcodes, np.concatenate((forward, reverse)),
+                                 np.concatenate((offsets, reverse_offsets)), match_counter)
+        return barcodes
+
+    def _filter_quality(self, fastq_batch, barcodes, rows, offsets, match_counter):
+        """empties the barcodes at rows, starting at offsets of their reads, that fail the quality filter"""
+        qualities = fastq_batch.fixed_width(fastq_batch.qual_starts[rows] + offsets, self.barcode_length)
+        low_quality = rows[~self.quality_filter.passing(qualities)]
+        barcodes[low_quality] = b''
+        if match_counter is not None:
+            match_counter['barcode_low_quality'] += len(low_quality)
+
+
+def offset_distribution(match_counter):
+    """dict of (strand, offset) and read count from the barcode_offset counts of a match counter"""
+    distribution = {}
+    for name, count in match_counter.items():
+        if name.startswith('barcode_offset_'):
+            strand, offset = name[len('barcode_offset_'):].rsplit('_', 1)
+            distribution[(strand, int(offset))] = count
+    return dict(sorted(distribution.items()))
+
+
+def print_offset_distribution(fastq_files, match_counters):
+    print('fastq\tstrand\tbarcode offset\treads')
+    for fastq_file, match_counter in zip(fastq_files, match_counters):
+        for (strand, offset), count in offset_distribution(match_counter).items():
+            print('{0}\t{1}\t{2}\t{3}'.format(fastq_file, strand, offset, count))
+        print('{0}\tnot found\t\t{1}'.format(fastq_file, match_counter['barcode_flank_not_found']))
+
+
+def add_extraction_arguments(parser):
+    """adds the barcode extraction options of the counting scripts"""
+    parser.add_argument('--barcode_offset', type=int, default=0,
+                        help='start of the barcode in reads when no flank is given')
+    parser.add_argument('--flank', nargs='?', const=FLANK,
+                        help='locate barcodes by the constant sequence following them. without a value the '
+                             'library flank {0} is used'.format(FLANK))
+    parser.add_argument('--min_offset', type=int, default=0,
+                        help='first barcode start searched with a flank, in bases from the read start')
+    parser.add_argument('--max_offset', type=int, default=10,
+                        help='last barcode start searched with a flank, in bases from the read start')
+    parser.add_argument('--flank_mismatches', type=int, default=1,
+                        help='substitutions allowed between read and the first bases of the flank')
+    parser.add_argument('--reverse_complement', action='store_true',
+                        help='also search for the reverse complemented flank and barcode')
+    parser.add_argument('--reverse_min_offset', type=int,
+                        help='first reverse complemented barcode start searched, in bases from the read start. the '
+                             'reverse complemented anchor ends right before it, so it has to leave room for the '
+                             '{0} anchor bases. default min_offset plus the anchor length'.format(
+                                 DEFAULT_ANCHOR_LENGTH))
+    parser.add_argument('--reverse_max_offset', type=int,
+                        help='last reverse complemented barcode start searched, in bases from the read start, at '
+                             'least the anchor length. default max_offset plus the anchor length')
+
+
+def extractor_from_arguments(args, barcode_length=None, quality_filter=None):
+    """extractor of the extraction options, with the barcode length of the index when barcode_length is None"""
+    return BarcodeExtractor(barcode_length, args.barcode_offset, args.flank, args.min_offset, args.max_offset,
+                            args.flank_mismatches, reverse_complement=args.reverse_complement,
+                            quality_filter=quality_filter, reverse_min_offset=args.reverse_min_offset,
+                            reverse_max_offset=args.reverse_max_offset)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to print the distribution of barcode offsets found by
+    their flank in fastq files, to choose offsets and check read layouts before counting""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-f', '--fastq_files', nargs='*', required=True, help='plain or gzipped fastq files')
+    parser.add_argument('-l', '--barcode_length', type=int, default=20, help='bases per barcode')
+    parser.add_argument('-r', '--reads', type=int, help='only search the first this many reads of every file')
+    add_extraction_arguments(parser)
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    if not args.flank:
+        args.flank = FLANK
+    barcode_extractor = extractor_from_arguments(args, args.barcode_length)
+    file_match_counters = []
+    with metrics.stage('extract barcodes', profile=True) as extraction:
+        for fastq_file in args.fastq_files:
+            file_match_counter = collections.Counter()
+            for fastq_batch in fastq_batches(fastq_file):
+                barcode_extractor.extract(fastq_batch, file_match_counter)
+                file_match_counter['reads'] += len(fastq_batch)
+                if args.reads and file_match_counter['reads'] >= args.reads:
+                    break
+            file_match_counters.append(file_match_counter)
+            run_metrics.count('reads', file_match_counter['reads'])
+            run_metrics.count('reads_flank_not_found', file_match_counter['barcode_flank_not_found'])
+        extraction['records'] = metrics.counters['reads']
+    print_offset_distribution(args.fastq_files, file_match_counters)
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import hashlib
+import json
+import pickle
+import struct
+
+import numpy as np
+
+import run_metrics
+
+INDEX_MAGIC = b'BCIDX001'
+ALIGNMENT = 64
+MAX_BARCODE_LENGTH = 32
+NOT_FOUND = -1
+AMBIGUOUS = -2
+
+# 2 bit codes for A, C, G, T. every other byte, including N, is marked invalid
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+
+def encode_barcodes(window):
+    """2 bit encodes fixed length barcodes into uint64 keys, first base in the most significant bits
+
+    Args:
+        window: (barcodes, length) uint8 array of ascii bases or a numpy bytes array (dtype S<length>)
+
+    Returns:
+        tuple of uint64 key array and boolean array, False for barcodes containing a base other than A, C, G, T
+    """
+    if window.dtype.kind == 'S':
+        window = np.ascontiguousarray(window).view(np.uint8).reshape(len(window), window.dtype.itemsize)
+    assert window.shape[1] <= MAX_BARCODE_LENGTH, \
+        'Barcodes longer than {0} bases do not fit in a uint64 key'.format(MAX_BARCODE_LENGTH)
+    codes = BASE_CODES[window]
+    length = codes.shape[1]
+    valid = (np.bitwise_or.reduce(codes, axis=1) if length else np.zeros(len(codes), dtype=np.uint8)) < 4
+    packed_length = -(-length // 4) * 4
+    if packed_length != length:
+        # leading A codes are zero bits and leave the key unchanged
+        codes = np.concatenate((np.zeros((len(codes), packed_length - length), dtype=np.uint8), codes), axis=1)
+    codes &= np.uint8(3)
+    # pack 4 bases per byte, then read 8 bytes as one big endian integer
+    pairs = (codes[:, 0::2] << 2) | codes[:, 1::2]
+    packed = np.zeros((len(codes), 8), dtype=np.uint8)
+    packed[:, 8 - packed_length // 4:] = (pairs[:, 0::2] << 4) | pairs[:, 1::2]
+    return packed.view('>u8').ravel().astype(np.uint64), valid
+
+
+def substitution_deltas(barcode_length):
+    """uint64 values that turn a key into each of its 3 * barcode_length single substitution neighbors by xor"""
+    shifts = 2 * np.arange(barcode_length, dtype=np.uint64)
+    return (np.arange(1, 4, dtype=np.uint64)[None, :] << shifts[:, None]).ravel()
+
+
+def decode_barcodes(keys, barcode_length):
+    """Converts uint64 keys back into a list of barcode strings"""
+    keys = np.asarray(keys, dtype=np.uint64)
+    shifts = np.arange(2 * (barcode_length - 1), -1, -2, dtype=np.uint64)
+    codes = (keys[:, None] >> shifts) & np.uint64(3)
+    window = np.frombuffer(b'ACGT', dtype=np.uint8)[codes]
+    return [barcode.decode() for barcode in window.view('S{0}'.format(barcode_length)).ravel().tolist()]
+
+
+class BarcodeIndex(object):
+    """Sorted uint64 barcode keys next to an int32 array of variant ids. variants holds the (position, amino acid)
+    tuple of every variant id. lookups return rows into keys so per barcode results stay addressable"""
+
+    def __init__(self, keys, variant_ids, variants, barcode_length, neighbor_keys=None, neighbor_rows=None):
+        self.keys = keys
+        self.variant_ids = variant_ids
+        self.variants = variants
+        self.barcode_length = barcode_length
+        # sorted keys one substitution away from an index barcode and the row they resolve to, see build_neighbors
+        self.neighbor_keys = neighbor_keys
+        self.neighbor_rows = neighbor_rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def version(self):
+        """Digest of the barcode to variant assignment, changes whenever the index content changes"""
+        digest = hashlib.sha1()
+        digest.update(json.dumps([self.barcode_length, self.variants]).encode())
+        digest.update(np.ascontiguousarray(self.keys).tobytes())
+        digest.update(np.ascontiguousarray(self.variant_ids).tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def from_dict(cls, barcode_variant_dict, barcode_length=20):
+        """Builds an index from a dictionary of barcode strings and variant tuples. barcodes of a different
+        length or with bases other than A, C, G, T can never match a read and are left out"""
+        variants = sorted(set(barcode_variant_dict.values()))
+        variant_id_dict = {variant: variant_id for variant_id, variant in enumerate(variants)}
+        barcodes = [barcode for barcode in barcode_variant_dict if len(barcode) == barcode_length]
+        window = np.array([barcode.encode() for barcode in barcodes], dtype='S{0}'.format(barcode_length))
+        keys, valid = encode_barcodes(window)
+        variant_ids = np.array([variant_id_dict[barcode_variant_dict[barcode]] for barcode in barcodes],
+                               dtype=np.int32)
+        keys = keys[valid]
+        variant_ids = variant_ids[valid]
+        order = np.argsort(keys, kind='stable')
+        skipped = len(barcode_variant_dict) - len(keys)
+        if skipped:
+            print('Barcodes left out of index (length other than {0} or ambiguous bases): {1}'.format(
+                barcode_length, skipped))
+        return cls(keys[order], variant_ids[order], [tuple(variant) for variant in variants], barcode_length)
+
+    def to_dict(self):
+        """Dictionary of barcode strings and variant tuples, the format of the legacy barcode pickles"""
+        return {barcode: self.variants[variant_id] for barcode, variant_id in
+                zip(decode_barcodes(self.keys, self.barcode_length), self.variant_ids.tolist())}
+
+    def lookup_keys(self, keys, valid=None):
+        """Batched exact lookup of uint64 keys
+
+        Returns:
+            int64 array of rows into the index, NOT_FOUND for keys that are not in the index or not valid
+        """
+        rows = np.searchsorted(self.keys, keys)
+        rows[rows == len(self.keys)] = 0
+        found = self.keys[rows] == keys if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        if valid is not None:
+            found &= valid
+        return np.where(found, rows, NOT_FOUND)
+
+    def build_neighbors(self):
+        """Precomputes every key one substitution away from an index barcode. a neighbor of barcodes of a single
+        variant resolves to the lowest of their rows, a neighbor of barcodes of two or more variants resolves to
+        AMBIGUOUS. neighbors that are index barcodes themselves are left out, exact matches always win"""
+        deltas = substitution_deltas(self.barcode_length)
+        neighbor_keys = (np.asarray(self.keys)[:, None] ^ deltas).ravel()
+        neighbor_rows = np.repeat(np.arange(len(self.keys)), len(deltas))
+        order = np.lexsort((neighbor_rows, neighbor_keys))
+        neighbor_keys = neighbor_keys[order]
+        neighbor_rows = neighbor_rows[order]
+        neighbor_variants = np.asarray(self.variant_ids)[neighbor_rows]
+
+        starts = np.flatnonzero(np.concatenate(([True], neighbor_keys[1:] != neighbor_keys[:-1])))
+        ambiguous = np.minimum.reduceat(neighbor_variants, starts) != np.maximum.reduceat(neighbor_variants, starts)
+        # rows are sorted within each key, so the first row of a group is the lowest
+        rows = np.where(ambiguous, AMBIGUOUS, neighbor_rows[starts])
+        keys = neighbor_keys[starts]
+        not_exact = self.lookup_keys(keys) == NOT_FOUND
+        self.neighbor_keys = keys[not_exact]
+        self.neighbor_rows = rows[not_exact].astype(np.int32)
+
+    def _lookup_neighbors(self, keys):
+        rows = np.searchsorted(self.neighbor_keys, keys)
+        rows[rows == len(self.neighbor_keys)] = 0
+        found = self.neighbor_keys[rows] == keys if len(self.neighbor_keys) else np.zeros(len(keys), dtype=bool)
+        return np.where(found, self.neighbor_rows[rows], NOT_FOUND)
+
+    def assign_keys(self, keys, max_mismatches=0):
+        """Batched lookup of uint64 keys allowing up to max_mismatches (0, 1 or 2) substitutions. each key takes a
+        fixed number of index probes: one exact, one in the precomputed neighbor index, and for 2 mismatches one per
+        substitution of the key itself. the closest match wins; matches at the same distance to barcodes of
+        different variants are ambiguous
+
+        Returns:
+            tuple of int64 array of rows into the index (NOT_FOUND or AMBIGUOUS if unassigned) and int8 array of
+            mismatches to the assigned barcode
+        """
+        assert max_mismatches in (0, 1, 2), 'Only 0, 1 or 2 mismatches are supported'
+        rows = self.lookup_keys(keys)
+        mismatches = np.zeros(len(keys), dtype=np.int8)
+        if max_mismatches and self.neighbor_keys is None:
+            self.build_neighbors()
+        if max_mismatches >= 1:
+            unresolved = np.flatnonzero(rows == NOT_FOUND)
+            neighbor_rows = self._lookup_neighbors(keys[unresolved])
+            rows[unresolved] = neighbor_rows
+            mismatches[unresolved[neighbor_rows >= 0]] = 1
+        if max_mismatches >= 2:
+            unresolved = np.flatnonzero(rows == NOT_FOUND)
+            # a key two substitutions from a barcode is one substitution from one of its neighbors
+            candidates = keys[unresolved][:, None] ^ substitution_deltas(self.barcode_length)
+            hits = self._lookup_neighbors(candidates.ravel()).reshape(candidates.shape)
+            found = hits >= 0
+            hit_variants = np.asarray(self.variant_ids)[np.maximum(hits, 0)]
+            lowest_variant = np.where(found, hit_variants, len(self.variants)).min(axis=1)
+            highest_variant = np.where(found, hit_variants, -1).max(axis=1)
+            ambiguous = (hits == AMBIGUOUS).any(axis=1) | (found.any(axis=1) & (lowest_variant != highest_variant))
+            lowest_row = np.where(found, hits, len(self.keys)).min(axis=1)
+            rows[unresolved] = np.where(ambiguous, AMBIGUOUS, np.where(found.any(axis=1), lowest_row, NOT_FOUND))
+            mismatches[unresolved[rows[unresolved] >= 0]] = 2
+        return rows, mismatches
+
+    def count_keys(self, keys, valid=None, max_mismatches=0, match_counter=None):
+        """Counts occurrences of every index barcode among a batch of uint64 keys. the keys are sorted and reduced
+        to unique keys first, which makes the search over the index sequential instead of random and runs the
+        mismatch search once per distinct key
+
+        Args:
+            keys: uint64 keys of a batch of reads
+            valid: boolean array, False for reads with bases other than A, C, G, T. these are never rescued
+            max_mismatches: substitutions allowed between a read and a barcode, see assign_keys
+            match_counter: optional collections.Counter incremented with the number of reads matched exactly,
+                rescued with 1 or 2 mismatches, or left ambiguous
+
+        Returns:
+            int64 array of counts aligned with the rows of the index
+        """
+        if valid is not None:
+            keys = keys[valid]
+        if not len(keys):
+            return np.zeros(len(self), dtype=np.int64)
+        keys = np.sort(keys)
+        starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+        unique_keys = keys[starts]
+        unique_counts = np.diff(np.append(starts, len(keys)))
+        rows, mismatches = self.assign_keys(unique_keys, max_mismatches)
+        found = rows >= 0
+        if match_counter is not None:
+            for mismatch_count, name in enumerate(['exact', 'one_mismatch', 'two_mismatches']):
+                match_counter[name] += int(unique_counts[found & (mismatches == mismatch_count)].sum())
+            match_counter['ambiguous'] += int(unique_counts[rows == AMBIGUOUS].sum())
+        return np.bincount(rows[found], weights=unique_counts[found], minlength=len(self)).astype(np.int64)
+
+    def lookup(self, window):
+        """Batched exact lookup of barcode windows, see encode_barcodes for accepted inputs"""
+        return self.lookup_keys(*encode_barcodes(window))
+
+    def variant_counts(self, barcode_counts):
+        """Sums per barcode counts (array aligned with keys) into per variant id counts"""
+        return np.bincount(self.variant_ids, weights=barcode_counts, minlength=len(self.variants))
+
+    def save(self, index_file):
+        """Writes the index as a json header followed by 64 byte aligned raw arrays that load() memory maps. the
+        neighbor index is stored as well if it has been built"""
+        arrays = [('keys', self.keys, '<u8'), ('variant_ids', self.variant_ids, '<i4')]
+        if self.neighbor_keys is not None:
+            arrays.extend([('neighbor_keys', self.neighbor_keys, '<u8'), ('neighbor_rows', self.neighbor_rows, '<i4')])
+        header = {
+            'barcode_length': self.barcode_length,
+            'variants': self.variants,
+            'version': self.version,
+            'arrays': [[name, dtype, len(array)] for name, array, dtype in arrays],
+        }
+        header_bytes = json.dumps(header).encode()
+        with open(index_file, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for name, array, dtype in arrays:
+                f.write(b'\0' * (-f.tell() % ALIGNMENT))
+                f.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+
+    @classmethod
+    def load(cls, index_file):
+        """Memory maps an index written by save(). loading only parses the header, and processes mapping the same
+        file share its pages"""
+        with open(index_file, 'rb') as f:
+            assert f.read(len(INDEX_MAGIC)) == INDEX_MAGIC, '{0} is not a barcode index file'.format(index_file)
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length).decode())
+        offset = len(INDEX_MAGIC) + 8 + header_length
+        arrays = {}
+        for name, dtype, length in header['arrays']:
+            offset += -offset % ALIGNMENT
+            if length:
+                arrays[name] = np.memmap(index_file, dtype=dtype, mode='r', offset=offset, shape=(length,))
+            else:
+                arrays[name] = np.zeros(0, dtype=dtype)
+            offset += length * np.dtype(dtype).itemsize
+        variants = [tuple(variant) for variant in header['variants']]
+        return cls(arrays['keys'], arrays['variant_ids'], variants, header['barcode_length'],
+                   arrays.get('neighbor_keys'), arrays.get('neighbor_rows'))
+
+
+def is_barcode_index(path):
+    with open(path, 'rb') as f:
+        return f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+
+def load_barcode_index(path, barcode_length=20):
+    """Loads a barcode index file, or builds an index in memory from a legacy barcode dictionary pickle"""
+    if is_barcode_index(path):
+        return BarcodeIndex.load(path)
+    with open(path, 'rb') as f:
+        barcode_variant_dict = pickle.load(f)
+    return BarcodeIndex.from_dict(barcode_variant_dict, barcode_length)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to convert a pickled barcode dictionary into a 2 bit
+    packed, memory mappable barcode index""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-p', '--pickle_file', required=True,
+                          help='pickle containing a dictionary with barcode as keys and library variants as values')
+    required.add_argument('-o', '--output', required=True, help='barcode index file to write')
+    parser.add_argument('-l', '--barcode_length', type=int, default=20,
+                        help='length of barcodes kept in the index, at most 32')
+    parser.add_argument('--neighbors', action='store_true',
+                        help='precompute and store the single substitution neighbor index used for mismatch '
+                             'tolerant barcode assignment')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    with metrics.stage('build index'):
+        barcode_index = load_barcode_index(args.pickle_file, args.barcode_length)
+    if args.neighbors:
+        with metrics.stage('build neighbor index', len(barcode_index), profile=True):
+            barcode_index.build_neighbors()
+        print('Neighbor keys in index: {0}'.format(len(barcode_index.neighbor_keys)))
+        print('Ambiguous neighbor keys: {0}'.format(int((barcode_index.neighbor_rows == AMBIGUOUS).sum())))
+    barcode_index.save(args.output)
+    variant_barcode_counter = collections.Counter(barcode_index.variant_ids.tolist())
+    print('Barcodes in index: {0}'.format(len(barcode_index)))
+    print('Variants in index: {0}'.format(len(variant_barcode_counter)))
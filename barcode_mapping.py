@@ -3,16 +3,39 @@
 import argparse
 import collections
 import itertools
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pylab as plt
 import numpy as np
 import pickle
 
+import run_metrics
+from barcode_consensus import ConsensusStats, print_consensus_summary
+from columnar import is_table
+
 # TODO: histogram of number of barcodes per sequence
 # TODO: number of variants present
 # TODO: avg number of barcodes present plus minus std and max min - have comparison to uniform dist
 
+# TODO: put this in a different file that would be more generally useful
+AA_NAME_MAP = {'A': 'ALA', 'P': 'PRO', 'V': 'VAL', 'L': 'LEU', 'I': 'ILE', 'M': 'MET',
+               'F': 'PHE', 'Y': 'TYR', 'W': 'TRP', 'S': 'SER', 'T': 'THR', 'C': 'CYS',
+               'K': 'LYS', 'R': 'ARG', 'H': 'HIS', 'D': 'ASP', 'E': 'GLU', 'N': 'ASN',
+               'Q': 'GLN', 'G': 'GLY'}
+
+
+def read_wt_sequence(wt_fasta):
+    with open(wt_fasta, 'r') as f:
+        return f.readlines()[-1].rstrip()
+
+
+def expected_library_variants(wt_seq):
+    """set of (position, amino acid) tuples of every single substitution and stop codon of the wt protein"""
+    possible_mutations = list(AA_NAME_MAP.keys())
+    possible_mutations.extend(['*'])
+    expected_library_set = set(itertools.product(range(1, len(wt_seq) + 1), possible_mutations))
+    for index, amino_acid in enumerate(wt_seq):
+        expected_library_set.remove((index + 1, amino_acid))
+    assert len(expected_library_set) == len(wt_seq) * 20, 'Expected library size is not correct'
+    return expected_library_set
+
 
 def library_coverage(library_barcode_counter, expected_library_set):
     library_barcode_set = set(library_barcode_counter.keys())
@@ -23,6 +46,9 @@ def library_coverage(library_barcode_counter, expected_library_set):
     print('Number of barcoded library seqs: {0}'.format(len(library_barcode_counter.keys()) - 1))
     print('Number of wild type barcodes: {0}'.format(library_barcode_counter[(0, 'WT')]))
     print('Number of missing library seqs: {0}'.format(len(missing_library_seqs)))
+    run_metrics.count('missing_library_variants', len(missing_library_seqs))
+    run_metrics.count('additional_library_variants', len(additional_seqs))
+    run_metrics.record('missing_library_variants', sorted(missing_library_seqs))
     print('Missing library seqs:')
     for index, amino_acid in sorted(missing_library_seqs):
         library_barcode_counter[(index, amino_acid)] = 0
@@ -33,10 +59,16 @@ def library_coverage(library_barcode_counter, expected_library_set):
     return library_barcode_counter
 
 
-def counter_histogram(library_barcode_counter, total_element_count, xlabel):
+def counter_histogram(library_barcode_counter, total_element_count, xlabel, filename='hist_barcode_per_variant.png',
+                      library_size=2800):
+    """histogram of the per variant counts, with the count expected if total_element_count was spread evenly over
+    the library_size variants of the library"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pylab as plt
     median = np.median(list(library_barcode_counter.values()))
     stdev = np.std(list(library_barcode_counter.values()))
-    expected_per_variant = total_element_count / 2800
+    expected_per_variant = total_element_count / library_size
     bins = np.linspace(0, max(library_barcode_counter.values()), 100)
     plt.hist(list(library_barcode_counter.values()), bins=bins, density=True)
     plt.axvline(expected_per_variant, color='k', linestyle='dashed')
@@ -44,7 +76,7 @@ def counter_histogram(library_barcode_counter, total_element_count, xlabel):
     plt.ylabel('Count')
     plt.text(50, 0.14, 'Median: {0}\nExpected: {1}'.format(
         round(median, 2), round(expected_per_variant, 2)))
-    plt.savefig('hist_barcode_per_variant.png', dpi=300)
+    plt.savefig(filename, dpi=300)
     plt.close()
 
 
@@ -53,51 +85,53 @@ if __name__ == '__main__':
     barcodes to expected library sequences""")
     required = parser.add_argument_group('required')
     required.add_argument("-p", "--pickle_file", required=True,
-                          help="input pickle file containing dictionary of 26 nucleotide barcodes ")
+                          help="input pickle file containing dictionary of 26 nucleotide barcodes, or "
+                               "barcode_consensus.col stats table from the consensus stage")
     required.add_argument("-w", "--wt_fasta", required=True,
                           help="fasta sequence of wt protein")
+    parser.add_argument('-n', '--no_histogram', action='store_true',
+                        help='only print library statistics, without drawing hist_barcode_per_variant.png')
+    run_metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
-
-    with open(args.wt_fasta, 'r') as f:
-        wt_seq = f.readlines()[-1].rstrip()
-
-    with open(args.pickle_file, 'rb') as f:
-        # keys: 26 randomized nucleotides; values: tuple (index, amino acid)
-        barcode_mutation_dict = pickle.load(f)
-
-    library_barcode_counter = collections.Counter()
-    incorrect_length_counter = collections.Counter()
-    ambiguous_barcode_counter = collections.Counter()
-    for barcode, index_aa_tup in barcode_mutation_dict.items():
-        if len(barcode) == 26 and 'N' not in barcode:
-            library_barcode_counter[index_aa_tup] += 1
-        elif len(barcode) != 26:
-            incorrect_length_counter[index_aa_tup] += 1
-        elif 'N' in barcode:
-            ambiguous_barcode_counter[index_aa_tup] += 1
-        else:
-            print('Barcode does not match any of the tests')
-            print(barcode)
-            print(index_aa_tup)
-            raise Exception('Add case to handle this example')
-
-    # TODO: put this in a different file that would be more generally useful
-    aa_name_map = {'A': 'ALA', 'P': 'PRO', 'V': 'VAL', 'L': 'LEU', 'I': 'ILE', 'M': 'MET',
-                   'F': 'PHE', 'Y': 'TYR', 'W': 'TRP', 'S': 'SER', 'T': 'THR', 'C': 'CYS',
-                   'K': 'LYS', 'R': 'ARG', 'H': 'HIS', 'D': 'ASP', 'E': 'GLU', 'N': 'ASN',
-                   'Q': 'GLN', 'G': 'GLY'}
-
-    possible_mutations = list(aa_name_map.keys())
-    possible_mutations.extend(['*'])
-    expected_library_set = set(itertools.product(range(1, 141), possible_mutations))
-    for index, amino_acid in enumerate(wt_seq):
-        expected_library_set.remove((index + 1, amino_acid))
-    assert len(expected_library_set) == 140 * 20, 'Expected library size is not correct'
-
+    metrics = run_metrics.start_run(args)
+
+    wt_seq = read_wt_sequence(args.wt_fasta)
+
+    if is_table(args.pickle_file):
+        # per variant barcode counts of the consensus stage, barcodes are already filtered
+        consensus_stats = ConsensusStats.load(args.pickle_file)
+        print_consensus_summary(consensus_stats)
+        library_barcode_counter = consensus_stats.variant_barcode_counter()
+        barcode_count = sum(library_barcode_counter.values())
+    else:
+        with open(args.pickle_file, 'rb') as f:
+            # keys: 26 randomized nucleotides; values: tuple (index, amino acid)
+            barcode_mutation_dict = pickle.load(f)
+        barcode_count = len(barcode_mutation_dict.keys())
+
+        library_barcode_counter = collections.Counter()
+        incorrect_length_counter = collections.Counter()
+        ambiguous_barcode_counter = collections.Counter()
+        for barcode, index_aa_tup in barcode_mutation_dict.items():
+            if len(barcode) == 26 and 'N' not in barcode:
+                library_barcode_counter[index_aa_tup] += 1
+            elif len(barcode) != 26:
+                incorrect_length_counter[index_aa_tup] += 1
+            elif 'N' in barcode:
+                ambiguous_barcode_counter[index_aa_tup] += 1
+            else:
+                print('Barcode does not match any of the tests')
+                print(barcode)
+                print(index_aa_tup)
+                raise Exception('Add case to handle this example')
+
+    expected_library_set = expected_library_variants(wt_seq)
     library_barcode_counter = library_coverage(library_barcode_counter, expected_library_set)
 
-    counter_histogram(
-        library_barcode_counter,
-        len(barcode_mutation_dict.keys()),
-        xlabel='Number of Barcodes per Variant',
-    )
\ No newline at end of file
+    if not args.no_histogram:
+        counter_histogram(
+            library_barcode_counter,
+            barcode_count,
+            xlabel='Number of Barcodes per Variant',
+            library_size=len(expected_library_set),
+        )
\ No newline at end of file
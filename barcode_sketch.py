@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import itertools
+import json
+import struct
+
+import numpy as np
+
+import run_metrics
+from barcode_index import BASE_CODES
+from barcode_mapping import counter_histogram, expected_library_variants, library_coverage, read_wt_sequence
+from bowtie_barcode_library_dict import MISMATCH_TAGS, iter_ordered_barcode_variants, iter_sorted_barcode_variants
+from quality_filter import add_quality_arguments, print_quality_summary, quality_filter_from_arguments
+
+SKETCH_MAGIC = b'BCSKT001'
+ALIGNMENT = 64
+# 2 ^ 14 registers estimate all barcodes with about 1 % error, 2 ^ 8 registers per variant about 6 %, less below
+# a few hundred barcodes where the zero registers are counted instead
+DEFAULT_PRECISION = 14
+DEFAULT_VARIANT_PRECISION = 8
+MAX_PRECISION = 14
+# the hash bits below the register bits whose leading zeros are counted
+RANK_BITS = 64 - MAX_PRECISION
+DEFAULT_COUNT_MIN_WIDTH = 2 ** 20
+DEFAULT_COUNT_MIN_DEPTH = 4
+# barcode variant pairs hashed per numpy batch
+SKETCH_BATCH_SIZE = 100000
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def hash_barcodes(barcodes):
+    """64 bit hashes of a numpy bytes array of barcodes, fnv-1a over the bases followed by the splitmix64
+    finalizer. the hash only depends on the bases, not on the process or the width of the array, so sketches of
+    different runs can be merged"""
+    window = np.ascontiguousarray(barcodes).view(np.uint8).reshape(len(barcodes), barcodes.dtype.itemsize)
+    hashes = np.full(len(barcodes), FNV_OFFSET, dtype=np.uint64)
+    for column in range(window.shape[1]):
+        # padding of shorter barcodes leaves their hash unchanged
+        inside = window[:, column] != 0
+        hashes[inside] = (hashes[inside] ^ window[inside, column]) * FNV_PRIME
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= np.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+class HyperLogLog(object):
+    """Rows of hyperloglog registers estimating distinct counts in 2 ^ precision bytes each, whatever the count.
+    a hash goes to the register of its top precision bits, which keeps the largest rank, one plus the leading
+    zeros of its low RANK_BITS bits, seen. registers merge by their maximum, so merged sketches estimate the union
+
+    Args:
+        precision: register bits, 4 to MAX_PRECISION. the standard error is 1.04 / sqrt(2 ^ precision)
+        sketches: number of register rows, e.g. one per variant
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, sketches=1):
+        assert 4 <= precision <= MAX_PRECISION, 'precision has to be between 4 and {0}'.format(MAX_PRECISION)
+        self.precision = precision
+        self.registers = np.zeros((sketches, 2 ** precision), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.registers)
+
+    def grow(self, sketches):
+        """adds empty register rows up to sketches rows"""
+        if sketches > len(self.registers):
+            self.registers = np.concatenate((self.registers, np.zeros(
+                (max(sketches, 2 * len(self.registers)) - len(self.registers), self.registers.shape[1]),
+                dtype=np.uint8)))
+
+    def add(self, hashes, rows=None):
+        """adds uint64 hashes to row 0, or to the row of every hash"""
+        registers = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+        # frexp returns the bit length of values below 2 ^ 53 exactly
+        ranks = RANK_BITS + 1 - np.frexp((hashes & np.uint64(2 ** RANK_BITS - 1)).astype(np.float64))[1]
+        if rows is not None:
+            registers += rows * self.registers.shape[1]
+        np.maximum.at(self.registers.ravel(), registers, ranks.astype(np.uint8))
+
+    def merge(self, other, rows=None):
+        """takes the register maximum with the first rows of other, placed at rows of this sketch, or with all
+        rows of other in the same order"""
+        if other.precision != self.precision:
+            raise IOError('can not merge sketches of precision {0} and {1}'.format(self.precision, other.precision))
+        rows = np.arange(len(other)) if rows is None else rows
+        self.grow(int(rows.max(initial=-1)) + 1)
+        self.registers[rows] = np.maximum(self.registers[rows], other.registers[:len(rows)])
+
+    def estimate(self, rows=None):
+        """distinct count estimates of all rows, or of the given rows. small counts are estimated from the number of
+        empty registers, which is more accurate while most registers are empty
+
+        Returns:
+            float64 array of estimates
+        """
+        registers = self.registers if rows is None else self.registers[rows]
+        m = registers.shape[1]
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        raw = alpha * m * m / np.ldexp(1.0, -registers.astype(np.int64)).sum(axis=1)
+        zeros = (registers == 0).sum(axis=1)
+        with np.errstate(divide='ignore'):
+            linear = m * np.log(m / zeros)
+        return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class CountMinSketch(object):
+    """Approximate read counts of every barcode in depth rows of width counters. a barcode increments one counter
+    per row, picked by double hashing its 64 bit hash, and its estimate is the smallest of them. estimates never
+    undercount, and overcount by more than e * total / width with probability at most exp(-depth). counters
+    merge by addition
+
+    Args:
+        width: counters per row, a power of 2
+        depth: rows
+    """
+
+    def __init__(self, width=DEFAULT_COUNT_MIN_WIDTH, depth=DEFAULT_COUNT_MIN_DEPTH):
+        assert width & (width - 1) == 0, 'count-min width has to be a power of 2'
+        self.counters = np.zeros((depth, width), dtype=np.uint32)
+
+    @property
+    def width(self):
+        return self.counters.shape[1]
+
+    @property
+    def depth(self):
+        return self.counters.shape[0]
+
+    def _columns(self, hashes):
+        first, step = hashes & np.uint64(0xffffffff), (hashes >> np.uint64(32)) | np.uint64(1)
+        return [((first + np.uint64(row) * step) & np.uint64(self.width - 1)).astype(np.intp)
+                for row in range(self.depth)]
+
+    def add(self, hashes):
+        for row, columns in enumerate(self._columns(hashes)):
+            self.counters[row] += np.bincount(columns, minlength=self.width).astype(np.uint32)
+
+    def estimate(self, hashes):
+        return np.min([self.counters[row, columns] for row, columns in enumerate(self._columns(hashes))], axis=0)
+
+    def merge(self, other):
+        if other.counters.shape != self.counters.shape:
+            raise IOError('can not merge count-min sketches of shape {0} and {1}'.format(
+                self.counters.shape, other.counters.shape))
+        self.counters += other.counters
+
+
+class BarcodeSketch(object):
+    """Fixed memory summary of the barcode variant pairs of mapping reads, for library qc without building the full
+    barcode dictionary: a hyperloglog of all barcodes, a hyperloglog of the barcodes of every variant, a count-min
+    sketch of reads per barcode and exact read counts per variant. like the consensus stage, barcodes of the wrong
+    length or with bases other than A, C, G and T are only counted as invalid reads. with min_reads above 1, a
+    barcode enters the hyperloglogs once its count-min estimate reaches min_reads. sketches of different lanes
+    merge into the sketch of all their reads, except that min_reads is then applied per lane
+
+    Args:
+        variants: optional list of (position, amino acid) tuples, variants seen later are appended
+        precision: register bits of the hyperloglog of all barcodes
+        variant_precision: register bits of the hyperloglog of every variant
+        count_min_width: counters per count-min row
+        count_min_depth: count-min rows
+        min_reads: reads a barcode needs to be counted
+        barcode_length: optional length barcodes need to be counted
+    """
+
+    def __init__(self, variants=(), precision=DEFAULT_PRECISION, variant_precision=DEFAULT_VARIANT_PRECISION,
+                 count_min_width=DEFAULT_COUNT_MIN_WIDTH, count_min_depth=DEFAULT_COUNT_MIN_DEPTH, min_reads=1,
+                 barcode_length=None):
+        self.variants = [tuple(variant) for variant in variants]
+        self.variant_rows = {variant: row for row, variant in enumerate(self.variants)}
+        self.min_reads = min_reads
+        self.barcode_length = barcode_length
+        self.barcodes = HyperLogLog(precision)
+        self.variant_barcodes = HyperLogLog(variant_precision, len(self.variants))
+        self.barcode_reads = CountMinSketch(count_min_width, count_min_depth)
+        self.variant_reads = np.zeros(len(self.variants), dtype=np.int64)
+        self.invalid_reads = 0
+
+    def settings(self):
+        """json serializable sketch parameters, sketches with the same settings can be merged"""
+        return {'precision': self.barcodes.precision, 'variant_precision': self.variant_barcodes.precision,
+                'count_min_width': self.barcode_reads.width, 'count_min_depth': self.barcode_reads.depth,
+                'min_reads': self.min_reads, 'barcode_length': self.barcode_length}
+
+    def _variant_row(self, variant):
+        row = self.variant_rows.get(variant)
+        if row is None:
+            row = self.variant_rows[variant] = len(self.variants)
+            self.variants.append(variant)
+        return row
+
+    def _grow(self):
+        self.variant_barcodes.grow(len(self.variants))
+        if len(self.variant_reads) < len(self.variants):
+            self.variant_reads = np.concatenate((self.variant_reads, np.zeros(
+                len(self.variants) - len(self.variant_reads), dtype=np.int64)))
+
+    def add(self, barcode_variants):
+        """adds an iterable of barcode string, variant tuple pairs, e.g. a mapping join, in batches"""
+        barcode_variants = iter(barcode_variants)
+        while True:
+            batch = list(itertools.islice(barcode_variants, SKETCH_BATCH_SIZE))
+            if not batch:
+                break
+            barcodes, variants = zip(*batch)
+            rows = np.array([self._variant_row(variant) for variant in variants], dtype=np.intp)
+            self.add_batch(np.array([barcode.encode() for barcode in barcodes], dtype='S'), rows)
+
+    def add_batch(self, barcodes, rows):
+        """adds a numpy bytes array of barcodes and the variant row of every barcode"""
+        self._grow()
+        window = np.ascontiguousarray(barcodes).view(np.uint8).reshape(len(barcodes), barcodes.dtype.itemsize)
+        lengths = (window != 0).sum(axis=1)
+        valid = ((BASE_CODES[window] < 4) | (window == 0)).all(axis=1) & (lengths > 0)
+        if self.barcode_length is not None:
+            valid &= lengths == self.barcode_length
+        self.invalid_reads += int(len(valid) - valid.sum())
+        hashes, rows = hash_barcodes(barcodes[valid]), rows[valid]
+        self.variant_reads[:len(self.variants)] += np.bincount(rows, minlength=len(self.variants))
+        self.barcode_reads.add(hashes)
+        if self.min_reads > 1:
+            counted = self.barcode_reads.estimate(hashes) >= self.min_reads
+            hashes, rows = hashes[counted], rows[counted]
+        self.barcodes.add(hashes)
+        self.variant_barcodes.add(hashes, rows)
+
+    def merge(self, other):
+        """adds the reads of another sketch with the same settings"""
+        if other.settings() != self.settings():
+            raise IOError('can not merge sketches with settings {0} and {1}'.format(other.settings(),
+                                                                                   self.settings()))
+        rows = np.array([self._variant_row(variant) for variant in other.variants], dtype=np.intp)
+        self._grow()
+        self.barcodes.merge(other.barcodes)
+        self.variant_barcodes.merge(other.variant_barcodes, rows)
+        self.barcode_reads.merge(other.barcode_reads)
+        self.variant_reads[rows] += other.variant_reads[:len(rows)]
+        self.invalid_reads += other.invalid_reads
+
+    def distinct_barcodes(self):
+        return float(self.barcodes.estimate()[0])
+
+    def reads(self):
+        return int(self.variant_reads[:len(self.variants)].sum())
+
+    def variant_barcode_counter(self):
+        """Counter of variants and their estimated number of barcodes, the library_barcode_counter that
+        barcode_mapping.library_coverage takes"""
+        estimates = np.rint(self.variant_barcodes.estimate(np.arange(len(self.variants)))).astype(np.int64)
+        return collections.Counter({variant: count for variant, count in zip(self.variants, estimates.tolist())
+                                    if count})
+
+    def save(self, sketch_file):
+        """Writes the sketch as a json header followed by 64 byte aligned raw arrays"""
+        arrays = [('barcode_registers', self.barcodes.registers),
+                  ('variant_registers', self.variant_barcodes.registers[:len(self.variants)]),
+                  ('count_min', self.barcode_reads.counters),
+                  ('variant_reads', self.variant_reads[:len(self.variants)])]
+        header = {
+            'settings': self.settings(),
+            'variants': self.variants,
+            'invalid_reads': self.invalid_reads,
+            'arrays': [[name, array.dtype.str, list(array.shape)] for name, array in arrays],
+        }
+        header_bytes = json.dumps(header).encode()
+        with open(sketch_file, 'wb') as f:
+            f.write(SKETCH_MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for name, array in arrays:
+                f.write(b'\0' * (-f.tell() % ALIGNMENT))
+                f.write(np.ascontiguousarray(array).tobytes())
+
+    @classmethod
+    def load(cls, sketch_file):
+        with open(sketch_file, 'rb') as f:
+            assert f.read(len(SKETCH_MAGIC)) == SKETCH_MAGIC, '{0} is not a barcode sketch file'.format(sketch_file)
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length).decode())
+            arrays = {}
+            for name, dtype, shape in header['arrays']:
+                f.seek(-f.tell() % ALIGNMENT, 1)
+                dtype = np.dtype(dtype)
+                arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        sketch = cls(header['variants'], **header['settings'])
+        sketch.barcodes.registers = arrays['barcode_registers']
+        sketch.variant_barcodes.registers = arrays['variant_registers']
+        sketch.barcode_reads.counters = arrays['count_min']
+        sketch.variant_reads = arrays['variant_reads']
+        sketch.invalid_reads = header['invalid_reads']
+        return sketch
+
+
+def sketch_mapping_reads(bowtie_output, index_fastq, max_mismatch, chunk_size=5000000, tmp_dir=None,
+                         quality_filter=None, bowtie_options=None, **sketch_options):
+    """Streams the barcode, variant pairs of every aligned read into a BarcodeSketch. alignments and index reads
+    are joined in read order, falling back to the external sort of the mapping stage, so memory stays bounded
+
+    Args:
+        quality_filter: optional quality_filter.QualityFilter, index reads failing it are not sketched
+        bowtie_options: optional dict of keyword arguments of iter_bowtie_output, workers and mismatch_tag
+        sketch_options: keyword arguments of BarcodeSketch
+
+    Returns:
+        BarcodeSketch
+    """
+    sketch = BarcodeSketch(**sketch_options)
+    index_match_counter = collections.Counter()
+    try:
+        with run_metrics.stage('sketch reads in read order', profile=True):
+            sketch.add(iter_ordered_barcode_variants(bowtie_output, index_fastq, max_mismatch, quality_filter,
+                                                     index_match_counter, bowtie_options))
+    except KeyError:
+        print('Reads are not in the same order, matching barcodes to variants by external sort')
+        run_metrics.count('join_read_order_fallbacks')
+        sketch = BarcodeSketch(**sketch_options)
+        index_match_counter = collections.Counter()
+        with run_metrics.stage('sketch reads by external sort', profile=True):
+            sketch.add(iter_sorted_barcode_variants(bowtie_output, index_fastq, max_mismatch, chunk_size, tmp_dir,
+                                                    quality_filter, index_match_counter, bowtie_options))
+    if quality_filter is not None:
+        print_quality_summary([index_fastq], [index_match_counter])
+    return sketch
+
+
+def print_sketch_summary(sketch):
+    print('Reads: {0}'.format(sketch.reads()))
+    print('Invalid barcode reads: {0}'.format(sketch.invalid_reads))
+    print('Estimated distinct barcodes: {0} +- {1}%'.format(
+        int(round(sketch.distinct_barcodes())), round(104 / np.sqrt(sketch.barcodes.registers.shape[1]), 1)))
+    print('Variants with reads: {0}'.format(int((sketch.variant_reads > 0).sum())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to estimate library coverage and barcodes per variant
+    from bowtie output and index fastqs in fixed memory, before building the barcode dictionary. every lane is
+    summarized in a mergeable sketch, and the sketches of all lanes and of earlier runs are merged into the
+    coverage report and histogram of barcode_mapping.py""")
+    parser.add_argument('-b', '--bowtie_outputs', nargs='*', default=[], help='bowtie output file of every lane')
+    parser.add_argument('-i', '--index_fastqs', nargs='*', default=[],
+                        help='index fastq of every lane, in the order of the bowtie outputs')
+    parser.add_argument('-s', '--sketch_files', nargs='*', default=[], help='sketches of earlier runs to merge')
+    parser.add_argument('-o', '--output', help='file to write the merged sketch to')
+    parser.add_argument('-w', '--wt_fasta', help='fasta sequence of wt protein, for the library coverage report')
+    parser.add_argument('-n', '--no_histogram', action='store_true',
+                        help='only print library statistics, without drawing hist_barcode_per_variant.png')
+    parser.add_argument('-m', '--max_mismatch', type=int, default=0,
+                        help='max number of mismatches allowed between read and expected fasta sequence')
+    parser.add_argument('--mismatch_tag', choices=MISMATCH_TAGS, default='AS',
+                        help='count mismatches of a read pair from the AS:i or NM:i tags of its mates')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes parsing byte ranges of the bowtie output')
+    parser.add_argument('-c', '--chunk_size', type=int, default=5000000,
+                        help='number of reads sorted in memory per spilled run of the external sort')
+    parser.add_argument('-t', '--tmp_dir', help='directory for external sort runs, defaults to the system temp dir')
+    parser.add_argument('-r', '--min_reads', type=int, default=1, help='reads a barcode needs to be counted')
+    parser.add_argument('-l', '--barcode_length', type=int, help='length barcodes need to be counted')
+    parser.add_argument('--precision', type=int, default=DEFAULT_PRECISION,
+                        help='register bits of the sketch of all barcodes')
+    parser.add_argument('--variant_precision', type=int, default=DEFAULT_VARIANT_PRECISION,
+                        help='register bits of the sketch of every variant')
+    parser.add_argument('--count_min_width', type=int, default=DEFAULT_COUNT_MIN_WIDTH,
+                        help='counters per row of the reads per barcode sketch, a power of 2')
+    parser.add_argument('--count_min_depth', type=int, default=DEFAULT_COUNT_MIN_DEPTH,
+                        help='rows of the reads per barcode sketch')
+    add_quality_arguments(parser)
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if len(args.bowtie_outputs) != len(args.index_fastqs):
+        raise IOError('give one index fastq per bowtie output')
+    if not args.bowtie_outputs and not args.sketch_files:
+        raise IOError('give bowtie outputs and index fastqs, or sketch files')
+    metrics = run_metrics.start_run(args)
+
+    sketch_options = {'precision': args.precision, 'variant_precision': args.variant_precision,
+                      'count_min_width': args.count_min_width, 'count_min_depth': args.count_min_depth,
+                      'min_reads': args.min_reads, 'barcode_length': args.barcode_length}
+    library_sketch = BarcodeSketch(**sketch_options)
+    for bowtie_output, index_fastq in zip(args.bowtie_outputs, args.index_fastqs):
+        print('Sketching {0}'.format(bowtie_output))
+        library_sketch.merge(sketch_mapping_reads(
+            bowtie_output, index_fastq, args.max_mismatch, args.chunk_size, args.tmp_dir,
+            quality_filter_from_arguments(args), {'workers': args.workers, 'mismatch_tag': args.mismatch_tag},
+            **sketch_options))
+    for sketch_file in args.sketch_files:
+        library_sketch.merge(BarcodeSketch.load(sketch_file))
+    if args.output:
+        library_sketch.save(args.output)
+    print_sketch_summary(library_sketch)
+    run_metrics.count('sketch_reads', library_sketch.reads())
+    run_metrics.count('sketch_distinct_barcodes', int(round(library_sketch.distinct_barcodes())))
+
+    if args.wt_fasta:
+        expected_library_set = expected_library_variants(read_wt_sequence(args.wt_fasta))
+        library_barcode_counter = library_coverage(library_sketch.variant_barcode_counter(), expected_library_set)
+        if not args.no_histogram:
+            counter_histogram(library_barcode_counter, library_sketch.distinct_barcodes(),
+                              xlabel='Estimated Number of Barcodes per Variant',
+                              library_size=len(expected_library_set))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+from run_metrics import peak_rss_bytes, reset_peak_rss
+from synthetic_data import MANIFEST, generate, load_manifest
+
+STAGES = ['parse_bowtie_output', 'bowtie_barcode_library_dict', 'variant_counter_from_fastqs',
+          'calculate_variant_fitness', 'compare_duplicates']
+
+
+def _fastq_read_count(manifest):
+    return manifest['parameters']['reads'] * len(manifest['fastq_files'])
+
+
+def _setup_parse_bowtie_output(manifest, work_dir):
+    return (manifest['bowtie_output'], 2), manifest['parameters']['mapping_reads']
+
+
+def _run_parse_bowtie_output(bowtie_output, max_mismatch):
+    from bowtie_barcode_library_dict import parse_bowtie_output
+    return parse_bowtie_output(bowtie_output, max_mismatch)
+
+
+def _setup_bowtie_barcode_library_dict(manifest, work_dir):
+    return (manifest['bowtie_output'], manifest['index_fastq'], 2, manifest['parameters']['barcode_length']), \
+        manifest['parameters']['mapping_reads']
+
+
+def _run_bowtie_barcode_library_dict(bowtie_output, index_fastq, max_mismatch, barcode_length):
+    from bowtie_barcode_library_dict import bowtie_barcode_library_dict
+    bowtie_barcode_library_dict(bowtie_output, index_fastq, max_mismatch, barcode_length=barcode_length)
+
+
+def _setup_variant_counter_from_fastqs(manifest, work_dir):
+    return (manifest['fastq_files'], manifest['barcode_index']), _fastq_read_count(manifest)
+
+
+def _run_variant_counter_from_fastqs(fastq_files, barcode_index):
+    from variant_fitness import variant_counter_from_fastqs
+    return variant_counter_from_fastqs(fastq_files, barcode_index)
+
+
+def _teardown_variant_counter_from_fastqs(variant_counter, work_dir):
+    # the fitness stage reuses the counts instead of counting again
+    import pickle
+    with open(os.path.join(work_dir, 'variant_counter.pkl'), 'wb') as f:
+        pickle.dump(dict(variant_counter), f)
+
+
+def _setup_calculate_variant_fitness(manifest, work_dir):
+    import pickle
+    from variant_fitness import variant_counter_from_fastqs
+    counter_file = os.path.join(work_dir, 'variant_counter.pkl')
+    if os.path.exists(counter_file):
+        with open(counter_file, 'rb') as f:
+            variant_counter = pickle.load(f)
+    else:
+        variant_counter = variant_counter_from_fastqs(manifest['fastq_files'], manifest['barcode_index'])
+    return (variant_counter, manifest['parameters']['timepoints']), len(variant_counter)
+
+
+def _run_calculate_variant_fitness(variant_counter, timepoints):
+    from variant_fitness import calculate_variant_fitness
+    return calculate_variant_fitness(variant_counter, timepoints)
+
+
+def _setup_compare_duplicates(manifest, work_dir):
+    from columnar import load_variant_dict
+    fitness_dicts = [load_variant_dict(replicate_file) for replicate_file in manifest['replicate_fitness']]
+    return (manifest['replicate_fitness'], fitness_dicts), sum(len(fitness_dict) for fitness_dict in fitness_dicts)
+
+
+def _run_compare_duplicates(replicate_names, fitness_dicts):
+    from compare_duplicates import write_replicate_table
+    write_replicate_table(replicate_names, fitness_dicts, name_suffix='benchmark')
+
+
+def _stage_process(stage, manifest, work_dir, connection):
+    """Runs one stage in a fresh process: untimed setup of its inputs, the timed stage call, then an untimed
+    teardown that keeps results later stages reuse"""
+    os.chdir(work_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        stage_args, items = globals()['_setup_' + stage](manifest, work_dir)
+        reset_peak_rss()
+        start_rss = peak_rss_bytes()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        stage_result = globals()['_run_' + stage](*stage_args)
+        wall_seconds = time.perf_counter() - start_wall
+        cpu_seconds = time.process_time() - start_cpu
+        peak_rss = peak_rss_bytes()
+        if '_teardown_' + stage in globals():
+            globals()['_teardown_' + stage](stage_result, work_dir)
+    connection.send({
+        'stage': stage,
+        'items': items,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds,
+        'items_per_second': items / wall_seconds if wall_seconds else None,
+        'start_rss_mb': start_rss / 2 ** 20,
+        'peak_rss_mb': peak_rss / 2 ** 20,
+    })
+    connection.close()
+
+
+def run_stage(stage, manifest, work_dir):
+    """Times one stage in a child process so its memory peak is measured on its own
+
+    Returns:
+        dict of stage name, items processed, wall and cpu seconds, items per second and rss in MB
+    """
+    parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_stage_process, args=(stage, manifest, work_dir, child_connection))
+    process.start()
+    child_connection.close()
+    try:
+        result = parent_connection.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        raise RuntimeError('Benchmark stage {0} failed with exit code {1}'.format(stage, process.exitcode))
+    return result
+
+
+def code_version():
+    """git commit of the repository, with a +dirty suffix for uncommitted changes, or None outside git"""
+    repository = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repository,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=repository, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+dirty' if dirty else '')
+
+
+def run_benchmark(data_dir, stages=None, repeats=1):
+    """Runs the benchmark stages on a synthetic data set
+
+    Args:
+        data_dir: directory written by synthetic_data.generate
+        stages: stage names to run, all STAGES by default
+        repeats: runs per stage, the fastest run is reported
+
+    Returns:
+        results dictionary with code version, environment, data set parameters and one entry per stage
+    """
+    manifest = load_manifest(data_dir)
+    work_dir = os.path.join(os.path.abspath(data_dir), 'benchmark_work')
+    os.makedirs(work_dir, exist_ok=True)
+    stage_results = []
+    for stage in stages or STAGES:
+        runs = [run_stage(stage, manifest, work_dir) for _ in range(repeats)]
+        stage_results.append(min(runs, key=lambda run: run['wall_seconds']))
+    return {
+        'version': code_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'data': manifest['parameters'],
+        'stages': stage_results,
+    }
+
+
+def print_results(results, baseline=None):
+    baseline_stages = {stage['stage']: stage for stage in baseline['stages']} if baseline else {}
+    print('stage\titems\twall s\tcpu s\titems/s\tpeak rss MB\tvs baseline')
+    for stage in results['stages']:
+        previous = baseline_stages.get(stage['stage'])
+        ratio = '{0}x'.format(round(previous['wall_seconds'] / stage['wall_seconds'], 2)) if previous else ''
+        print('{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}'.format(
+            stage['stage'], stage['items'], round(stage['wall_seconds'], 3), round(stage['cpu_seconds'], 3),
+            round(stage['items_per_second'] or 0), round(stage['peak_rss_mb'], 1), ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to time and memory profile pipeline stages on a
+    synthetic data set and store the results as json, so runs of different versions can be compared""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-d', '--data_dir', required=True,
+                          help='synthetic data set directory. generated with the options below if it has no '
+                               'manifest')
+    parser.add_argument('-o', '--output', help='json file to write results to')
+    parser.add_argument('-c', '--compare', help='json results of an earlier run to compare wall times against')
+    parser.add_argument('-s', '--stages', nargs='*', choices=STAGES, help='stages to run, default all')
+    parser.add_argument('--repeats', type=int, default=1, help='runs per stage, the fastest is reported')
+    parser.add_argument('-r', '--reads', type=int, default=1000000, help='reads per timepoint fastq when generating')
+    parser.add_argument('-m', '--mapping_reads', type=int, default=1000000,
+                        help='bowtie read pairs when generating')
+    parser.add_argument('-e', '--error_rate', type=float, default=0.001, help='per base error rate when generating')
+    parser.add_argument('-b', '--barcodes_per_variant', type=float, default=20,
+                        help='mean barcodes per variant when generating')
+    parser.add_argument('--seed', type=int, default=0, help='random seed when generating')
+    parser.add_argument('--mate_sequences', action='store_true',
+                        help='write sequence and quality fields of both mates into the bowtie output when '
+                             'generating, so bowtie parsing is timed on lines as long as real ones')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.data_dir, MANIFEST)):
+        print('Generating synthetic data set in {0}'.format(args.data_dir))
+        generate(args.data_dir, args.reads, args.mapping_reads, barcodes_per_variant=args.barcodes_per_variant,
+                 error_rate=args.error_rate, seed=args.seed, mate_sequences=args.mate_sequences)
+    benchmark_results = run_benchmark(args.data_dir, args.stages, args.repeats)
+    baseline_results = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline_results = json.load(f)
+    print_results(benchmark_results, baseline_results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_results, f, indent=2)
@@ -2,86 +2,473 @@
 
 import argparse
 import collections
+import heapq
 import itertools
-import pickle
+import multiprocessing
+import os
+import tempfile
 
+import numpy as np
 
-def parse_bowtie_output(bowtie_output_file, max_mismatch):
-    """Extracts read headers and fasta identifiers from bowtie output file
-    makes a lot of assumptions about file format based on bowtie version 1.2.2 and output format ____
+import run_metrics
+from barcode_consensus import (BarcodeConsensus, DEFAULT_MAX_BARCODES_IN_MEMORY, LIBRARY_BARCODE_LENGTH,
+                               print_consensus_summary)
+from columnar import write_barcode_variant_counter
+from fastq_reader import fastq_batches
+from quality_filter import add_quality_arguments, print_quality_summary, quality_filter_from_arguments
+
+
+# bytes of bowtie output per shard of the parallel parser, smaller files are parsed in one process. shards are cut
+# to about BOWTIE_SHARD_SIZE bytes, so the parsed pairs of the shards in flight stay small whatever the file size
+MIN_BOWTIE_SHARD_SIZE = 16 * 1024 * 1024
+BOWTIE_SHARD_SIZE = 64 * 1024 * 1024
+MISMATCH_TAGS = ['AS', 'NM']
+# index reads the read order join skips looking for the next alignment header before deciding the files are not in
+# the same read order. longer runs of unaligned or filtered reads send the join to the external sort, which is
+# slower but gives the same counts
+MAX_SEARCH_AHEAD = 100000
+
+
+def _tag_value(fields, needle):
+    """integer value of an optional SAM tag, e.g. AS:i:-2, looked up by its needle, e.g. tab AS:i:, in the tab
+    separated tail of an alignment line, None if the line does not have it. a value at the end of the line keeps
+    its line ending, which int() skips"""
+    start = fields.find(needle)
+    if start < 0:
+        return None
+    start += len(needle)
+    end = fields.find(b'\t', start)
+    return int(fields[start:end] if end >= 0 else fields[start:])
+
+
+def _twist_variant(twist_tag):
+    """(position, amino acid) variant of a twist fasta identifier, None if it can not be parsed"""
+    twist_tag = twist_tag.decode()
+    try:
+        return int(twist_tag.split('REGION01_GROUP')[-1].split(':')[0]), twist_tag.split('-->')[-1]
+    except ValueError:
+        return None
+
+
+def _pair_start(f, offset):
+    """offset of the first mate pair starting at or after offset. the pair boundary is found from two
+    consecutive lines: if they share a read name they are a pair, otherwise the first is the second mate of the
+    previous pair"""
+    if offset == 0:
+        return 0
+    f.seek(offset - 1)
+    f.readline()
+    position = f.tell()
+    line1 = f.readline()
+    line2 = f.readline()
+    if not line2:
+        return position + len(line1)
+    if line1.split(b'\t', 1)[0] == line2.split(b'\t', 1)[0]:
+        return position
+    return position + len(line1)
+
+
+def bowtie_byte_ranges(bowtie_output_file, shard_count):
+    """Splits bowtie output into up to shard_count byte ranges starting at mate pair boundaries
+
+    Returns:
+        list of (start, end) tuples; end is None for the last range
+    """
+    size = os.path.getsize(bowtie_output_file)
+    shard_count = max(1, min(shard_count, size // MIN_BOWTIE_SHARD_SIZE))
+    with open(bowtie_output_file, 'rb') as f:
+        starts = sorted(set(_pair_start(f, size * shard // shard_count) for shard in range(shard_count)))
+    starts = [start for start in starts if start < size] or [0]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def _iter_bowtie_range(bowtie_output_file, max_mismatch, start=0, end=None, mismatch_tag='AS', funnel=None):
+    """Yields header, variant tuples of the mate pairs starting in a byte range of bowtie output. pairs with an
+    unaligned mate or with mates aligned to different variant sequences are dropped and counted in the funnel.
+    only the read name and reference name are split off the lines, the mismatch tag is found by name in the rest.
+    variants are parsed once per fasta identifier, the library has a few thousand of them
+
+    Raises:
+        AssertionError: Read headers do not appear on sequential lines
+    """
+    funnel = collections.Counter() if funnel is None else funnel
+    needle = b'\t' + mismatch_tag.encode() + b':i:'
+    # bowtie counts alignment scores descending from 0, NM counts edits
+    sign = -1 if mismatch_tag == 'AS' else 1
+    variant_cache = {}
+    # the pairs read and kept are counted locally and added to the funnel once, as they are counted for every pair
+    alignment_pairs = kept = 0
+    try:
+        with open(bowtie_output_file, 'rb') as f:
+            f.seek(start)
+            position = start
+            for line1, line2 in itertools.zip_longest(f, f, fillvalue=None):
+                if end is not None:
+                    if position >= end:
+                        break
+                    position += len(line1) + len(line2 or b'')
+                assert line2 is not None, 'Bowtie output ends with an unpaired line\n{0}'.format(line1.decode())
+                alignment_pairs += 1
+                header1, flag1, twist_tag1, rest1 = line1.split(b'\t', 3)
+                header2, flag2, twist_tag2, rest2 = line2.split(b'\t', 3)
+                assert header1 == header2, 'Read headers do not appear on sequential lines\n{0}\n{1}'.format(
+                    header1.decode(), header2.decode())
+                if twist_tag1 == b'*' or twist_tag2 == b'*':
+                    funnel['dropped_unaligned_mate'] += 1
+                    continue
+                if twist_tag1 != twist_tag2:
+                    funnel['dropped_discordant_mates'] += 1
+                    continue
+                value1 = _tag_value(rest1, needle)
+                value2 = _tag_value(rest2, needle)
+                if value1 is None or value2 is None:
+                    funnel['dropped_missing_score'] += 1
+                    continue
+                if sign * (value1 + value2) > max_mismatch:
+                    funnel['dropped_mismatches'] += 1
+                    continue
+                try:
+                    variant = variant_cache[twist_tag1]
+                except KeyError:
+                    variant = variant_cache[twist_tag1] = _twist_variant(twist_tag1)
+                if variant is None:
+                    funnel['variant_parse_failures'] += 1
+                    continue
+                kept += 1
+                yield header1.decode(), variant
+    finally:
+        funnel['alignment_pairs'] += alignment_pairs
+        funnel['kept'] += kept
+
+
+def _parse_bowtie_shard(shard):
+    bowtie_output_file, max_mismatch, start, end, mismatch_tag = shard
+    funnel = collections.Counter()
+    pairs = list(_iter_bowtie_range(bowtie_output_file, max_mismatch, start, end, mismatch_tag, funnel))
+    return pairs, funnel
+
+
+def iter_bowtie_output(bowtie_output_file, max_mismatch, workers=1, mismatch_tag='AS', report=True):
+    """Extracts read headers and fasta identifiers from bowtie output file in file order
+    makes a lot of assumptions about file format based on bowtie version 1.2.2 and output format ____.
+    with more than one worker, mate pair aligned byte ranges are parsed in a process pool and yielded in file order.
+    at most workers shards are parsed ahead of the consumer, so a slow consumer does not pile up parsed shards.
+    with report, dropped pairs, e.g. with mates aligned to different variant sequences, are counted in the run
+    metrics once the whole file is read. passes stopped early, like a read order join falling back to the external
+    sort, are not counted, and repeated passes over the same output pass report=False
 
     Args:
         bowtie_output_file: a string for the path to output from Bowtie software
         max_mismatch: maximum number of mismatched positions in alignment.
             If mismatches exceed this number, the alignment is discarded
+        workers: number of parsing processes
+        mismatch_tag: AS counts mismatches from the alignment scores of both mates, NM from their edit distances
+        report: print dropped pairs and count the bowtie_ funnel of the run metrics
 
-    Returns:
-        A dict with keys of illumina sequencing headers and values of variant mutations from fasta header
+    Yields:
+        tuples of illumina sequencing header and variant mutation from fasta header
 
     Raises:
         AssertionError: Read headers do not appear on sequential lines
-        AssertionError: Paired reads do not align to the same variant sequence
     """
-    header_variant_dict = {}
-    with open(bowtie_output_file, 'r') as f:
-        for line1, line2 in itertools.zip_longest(f, f, fillvalue=None):
-            split_line1 = line1.rstrip().split()
-            split_line2 = line2.rstrip().split()
-            header1 = split_line1[0]
-            header2 = split_line2[0]
-            assert header1 == header2, \
-                'Read headers do not appear on sequential lines\n{0}\n{1}'.format(header1, header2)
-            twist_tag1 = split_line1[2]
-            twist_tag2 = split_line1[2]
-            assert twist_tag1 == twist_tag2, 'Paired reads do not align to the same variant sequence'
-
-            # bowtie counts mismatches descending from 0
-            try:
-                mismatches = -1 * (int(split_line1[-10].split(':')[-1]) + int(split_line2[-10].split(':')[-1]))
-            except ValueError:
-                # print("Read {0} missing alignment score".format(header1))
-                continue
-
-            if mismatches <= max_mismatch:
-                try:
-                    variant = (int(twist_tag1.split('REGION01_GROUP')[-1].split(':')[0]), twist_tag1.split('-->')[-1])
-                except ValueError:
-                    continue
-                header_variant_dict[header1] = variant
-    return header_variant_dict
+    assert mismatch_tag in MISMATCH_TAGS, 'Mismatch tag must be one of {0}'.format(MISMATCH_TAGS)
+    funnel = collections.Counter()
+    if workers > 1:
+        shard_count = max(4 * workers, -(-os.path.getsize(bowtie_output_file) // BOWTIE_SHARD_SIZE))
+        byte_ranges = bowtie_byte_ranges(bowtie_output_file, shard_count)
+    else:
+        byte_ranges = [(0, None)]
+    if len(byte_ranges) > 1:
+        shards = collections.deque((bowtie_output_file, max_mismatch, start, end, mismatch_tag)
+                                   for start, end in byte_ranges)
+        in_flight = collections.deque()
+        with multiprocessing.Pool(workers) as pool:
+            while shards or in_flight:
+                while shards and len(in_flight) < workers:
+                    in_flight.append(pool.apply_async(_parse_bowtie_shard, (shards.popleft(),)))
+                pairs, shard_funnel = in_flight.popleft().get()
+                funnel.update(shard_funnel)
+                for pair in pairs:
+                    yield pair
+    else:
+        for pair in _iter_bowtie_range(bowtie_output_file, max_mismatch, mismatch_tag=mismatch_tag, funnel=funnel):
+            yield pair
+    if report:
+        if funnel['dropped_discordant_mates']:
+            print('Dropped {0} of {1} read pairs with mates aligned to different variant sequences'.format(
+                funnel['dropped_discordant_mates'], funnel['alignment_pairs']))
+        for name, value in funnel.items():
+            run_metrics.count('bowtie_' + name, value)
+
 
+def parse_bowtie_output(bowtie_output_file, max_mismatch, workers=1, mismatch_tag='AS', report=True):
+    """Extracts read headers and fasta identifiers from bowtie output file, see iter_bowtie_output for arguments
+
+    Returns:
+        A dict with keys of illumina sequencing headers and values of variant mutations from fasta header
+    """
+    return dict(iter_bowtie_output(bowtie_output_file, max_mismatch, workers, mismatch_tag, report))
+
+
+def _batch_id_seq(fastq_batch, quality_filter, match_counter):
+    """identifiers and sequences of a batch, with empty sequences for reads failing the quality filter"""
+    sequences = fastq_batch.sequences()
+    if quality_filter is not None:
+        low_quality = np.flatnonzero(~quality_filter.read_mask(fastq_batch)).tolist()
+        for i in low_quality:
+            sequences[i] = ''
+        if match_counter is not None:
+            match_counter['barcode_low_quality'] += len(low_quality)
+    if match_counter is not None:
+        match_counter['reads'] += len(fastq_batch)
+    return zip(fastq_batch.identifiers(), sequences)
+
+
+def iter_fastq_id_seq(fastq, quality_filter=None, match_counter=None):
+    """Yields identifier, sequence tuples from a plain or gzipped fastq file in file order. identifiers do not
+    have the @ symbol and are cutoff after the first space. with a quality filter, reads whose qualities fail it
+    are yielded with an empty sequence, so joins can tell them from reads missing from the file
+
+    Args:
+        fastq: fastq formatted file, plain or gzipped
+        quality_filter: optional quality_filter.QualityFilter applied to the qualities of whole reads
+        match_counter: optional Counter incremented with reads and barcode_low_quality counts
+    """
+    for fastq_batch in fastq_batches(fastq):
+        for identifier_sequence in _batch_id_seq(fastq_batch, quality_filter, match_counter):
+            yield identifier_sequence
 
-def fastq_to_id_seq_dict(fastq):
+
+def fastq_to_id_seq_dict(fastq, quality_filter=None, match_counter=None):
     """Create a dictionary of identifiers and sequences from fastq file. identifiers do not have the @ symbol and
     are cutoff after the first space
 
     Args:
-        fastq: fastq formatted file - cannot be gzipped
+        fastq: fastq formatted file, plain or gzipped
+        quality_filter: optional quality_filter.QualityFilter, reads failing it get an empty sequence
+        match_counter: optional Counter incremented with reads and barcode_low_quality counts
 
     Returns:
         dictionary with keys as the sequence identifiers and values as sequences
     """
     identifier_sequence_dict = {}
-    with open(fastq, 'r') as f:
-        for identifier, sequence, spacer, quality_str in itertools.zip_longest(*[f] * 4, fillvalue=None):
-            identifier_sequence_dict[identifier.split()[0].split('@')[-1]] = sequence.rstrip()
+    for fastq_batch in fastq_batches(fastq):
+        identifier_sequence_dict.update(_batch_id_seq(fastq_batch, quality_filter, match_counter))
     return identifier_sequence_dict
 
 
-def bowtie_barcode_library_dict(bowtie_output, index_fastq, max_mismatch):
+def iter_ordered_barcode_variants(bowtie_output, index_fastq, max_mismatch, quality_filter=None,
+                                  match_counter=None, bowtie_options=None, max_search_ahead=MAX_SEARCH_AHEAD):
+    """Joins alignments and index reads by walking both files together. bowtie writes alignments in the order of
+    its input reads, so the index read for every alignment is found by skipping forward over index reads that
+    did not align or were filtered. at most max_search_ahead index reads are skipped per alignment, so files in
+    different read orders are detected early instead of after reading the rest of the index fastq
+
+    Yields:
+        tuples of barcode and variant, one per aligned read whose index read passes the quality filter
+
+    Raises:
+        KeyError: an alignment header is not found within max_search_ahead index reads of the current one, i.e.
+            the files are not in the same read order
+    """
+    index_reads = iter_fastq_id_seq(index_fastq, quality_filter, match_counter)
+    for header, variant in iter_bowtie_output(bowtie_output, max_mismatch, **(bowtie_options or {})):
+        for identifier, barcode in itertools.islice(index_reads, max_search_ahead + 1):
+            if identifier == header:
+                if barcode:
+                    yield barcode, variant
+                break
+        else:
+            raise KeyError(header)
+
+
+def ordered_barcode_variant_counter(bowtie_output, index_fastq, max_mismatch, quality_filter=None,
+                                    bowtie_options=None):
+    """Counts the read order join of iter_ordered_barcode_variants
+
+    Returns:
+        defaultdict of barcode keys and Counter values of variants, or None if the files are not in the same read
+        order
+    """
+    barcode_variant_counter = collections.defaultdict(collections.Counter)
+    try:
+        for barcode, variant in iter_ordered_barcode_variants(bowtie_output, index_fastq, max_mismatch,
+                                                              quality_filter, bowtie_options=bowtie_options):
+            barcode_variant_counter[barcode][variant] += 1
+    except KeyError:
+        return None
+    return barcode_variant_counter
+
+
+def _sorted_runs(records, chunk_size, tmp_dir):
+    """Sorts records of string fields in chunks of chunk_size, spills each chunk to a temporary tab separated
+    file and returns an iterator merging the runs back in sorted order"""
+    runs = []
+    chunk = list(itertools.islice(records, chunk_size))
+    while chunk:
+        chunk.sort()
+        run = tempfile.TemporaryFile('w+', dir=tmp_dir)
+        run.writelines('\t'.join(record) + '\n' for record in chunk)
+        run.seek(0)
+        runs.append(run)
+        chunk = list(itertools.islice(records, chunk_size))
+    return heapq.merge(*((tuple(line.rstrip('\n').split('\t')) for line in run) for run in runs))
+
+
+def iter_sorted_barcode_variants(bowtie_output, index_fastq, max_mismatch, chunk_size=5000000, tmp_dir=None,
+                                 quality_filter=None, match_counter=None, bowtie_options=None):
+    """Joins alignments and index reads in any read order with an external sort. both inputs are sorted by read
+    header in spilled runs of chunk_size records and merge joined, so memory holds one chunk
+
+    Yields:
+        tuples of barcode and variant, one per aligned read whose index read passes the quality filter, in read
+        header order
+
+    Raises:
+        KeyError: an aligned read header is missing from the index fastq
+    """
+    alignments = iter_bowtie_output(bowtie_output, max_mismatch, **(bowtie_options or {}))
+    alignments = _sorted_runs(((header, str(position), amino_acid) for header, (position, amino_acid) in alignments),
+                              chunk_size, tmp_dir)
+    index_reads = _sorted_runs(iter_fastq_id_seq(index_fastq, quality_filter, match_counter), chunk_size, tmp_dir)
+
+    identifier = None
+    for header, position, amino_acid in alignments:
+        while identifier is None or identifier < header:
+            identifier, barcode = next(index_reads, (None, None))
+            if identifier is None:
+                raise KeyError(header)
+        if identifier != header:
+            raise KeyError(header)
+        if barcode:
+            yield barcode, (int(position), amino_acid)
+
+
+def sorted_barcode_variant_counter(bowtie_output, index_fastq, max_mismatch, chunk_size=5000000, tmp_dir=None,
+                                   quality_filter=None, bowtie_options=None):
+    """Counts the external sort join of iter_sorted_barcode_variants
+
+    Returns:
+        defaultdict of barcode keys and Counter values of variants
+
+    Raises:
+        KeyError: an aligned read header is missing from the index fastq
+    """
+    barcode_variant_counter = collections.defaultdict(collections.Counter)
+    for barcode, variant in iter_sorted_barcode_variants(bowtie_output, index_fastq, max_mismatch, chunk_size,
+                                                         tmp_dir, quality_filter, bowtie_options=bowtie_options):
+        barcode_variant_counter[barcode][variant] += 1
+    return barcode_variant_counter
+
+
+def iter_memory_barcode_variants(bowtie_output, index_fastq, max_mismatch, quality_filter=None,
+                                 match_counter=None, bowtie_options=None):
+    """Joins alignments and index reads through dictionaries of every read header, skipping index reads that fail
+    the quality filter"""
     print('Parsing index reads')
-    header_barcode_dict = fastq_to_id_seq_dict(index_fastq)
+    header_barcode_dict = fastq_to_id_seq_dict(index_fastq, quality_filter, match_counter)
     print('Parsing bowtie file')
-    header_variant_dict = parse_bowtie_output(bowtie_output, max_mismatch)
+    header_variant_dict = parse_bowtie_output(bowtie_output, max_mismatch, **(bowtie_options or {}))
     print('Matching barcodes to variants')
-    barcode_variant_counter = collections.defaultdict(collections.Counter)
     for header, variant in header_variant_dict.items():
         barcode = header_barcode_dict[header]
+        if barcode:
+            yield barcode, variant
+
+
+def memory_barcode_variant_counter(bowtie_output, index_fastq, max_mismatch, quality_filter=None,
+                                   bowtie_options=None):
+    """Counts the dictionary join of iter_memory_barcode_variants"""
+    barcode_variant_counter = collections.defaultdict(collections.Counter)
+    for barcode, variant in iter_memory_barcode_variants(bowtie_output, index_fastq, max_mismatch,
+                                                         quality_filter, bowtie_options=bowtie_options):
         barcode_variant_counter[barcode][variant] += 1
-    with open('barcode_variant_counter.pkl', 'wb') as f:
-        pickle.dump(barcode_variant_counter, f)
+    return barcode_variant_counter
+
+
+def barcode_variant_consensus(bowtie_output, index_fastq, max_mismatch, join='stream', chunk_size=5000000,
+                              tmp_dir=None, quality_filter=None, bowtie_options=None, **consensus_options):
+    """Streams the barcode, variant pairs of every aligned read into a BarcodeConsensus and resolves it
+
+    Args:
+        join: stream walks alignments and index reads together and falls back to an external sort when they are not
+            in the same read order. memory joins through dictionaries of every read header
+        quality_filter: optional quality_filter.QualityFilter. index reads failing it are not mapped and the
+            filtered fraction is printed
+        bowtie_options: optional dict of keyword arguments of iter_bowtie_output, workers, mismatch_tag and report
+        consensus_options: keyword arguments of BarcodeConsensus, e.g. min_reads, min_purity,
+            max_barcodes_in_memory
+
+    Returns:
+        tuple of BarcodeIndex of accepted barcodes and ConsensusStats
+    """
+    consensus = BarcodeConsensus(tmp_dir=tmp_dir, **consensus_options)
+    index_match_counter = collections.Counter()
+    if join == 'stream':
+        print('Matching barcodes to variants in read order')
+        try:
+            with run_metrics.stage('join reads in read order', profile=True):
+                consensus.add(iter_ordered_barcode_variants(bowtie_output, index_fastq, max_mismatch, quality_filter,
+                                                            index_match_counter, bowtie_options))
+        except KeyError:
+            print('Reads are not in the same order, matching barcodes to variants by external sort')
+            run_metrics.count('join_read_order_fallbacks')
+            consensus = BarcodeConsensus(tmp_dir=tmp_dir, **consensus_options)
+            index_match_counter = collections.Counter()
+            with run_metrics.stage('join reads by external sort', profile=True):
+                consensus.add(iter_sorted_barcode_variants(bowtie_output, index_fastq, max_mismatch, chunk_size,
+                                                           tmp_dir, quality_filter, index_match_counter,
+                                                           bowtie_options))
+    else:
+        with run_metrics.stage('join reads in memory', profile=True):
+            consensus.add(iter_memory_barcode_variants(bowtie_output, index_fastq, max_mismatch, quality_filter,
+                                                       index_match_counter, bowtie_options))
+    if quality_filter is not None:
+        print_quality_summary([index_fastq], [index_match_counter])
+        run_metrics.count('index_reads_low_quality', index_match_counter['barcode_low_quality'])
+    with run_metrics.stage('resolve barcode consensus'):
+        return consensus.resolve()
+
+
+def bowtie_barcode_library_dict(bowtie_output, index_fastq, max_mismatch, join='stream', chunk_size=5000000,
+                                tmp_dir=None, min_reads=1, min_purity=0.9,
+                                max_barcodes_in_memory=DEFAULT_MAX_BARCODES_IN_MEMORY, counter_table=False,
+                                quality_filter=None, bowtie_options=None, barcode_length=LIBRARY_BARCODE_LENGTH):
+    """Resolves every barcode to a single variant and writes barcode_index.bcidx, the lookup table used by
+    variant_fitness.py, and barcode_consensus.col, per variant barcode and read counts by consensus outcome.
+    with counter_table, the raw barcode variant read counts are written to barcode_variant_counter.col as well.
+    with a quality filter, index reads whose barcode qualities fail it are not mapped. bowtie_options are keyword
+    arguments of iter_bowtie_output, e.g. parsing workers and the mismatch_tag. index reads of another length than
+    barcode_length are counted as invalid"""
+    metadata = {
+        'bowtie_output': bowtie_output,
+        'index_fastq': index_fastq,
+        'max_mismatch': max_mismatch,
+        'barcode_length': barcode_length,
+        'mismatch_tag': (bowtie_options or {}).get('mismatch_tag', 'AS'),
+        'barcode_quality': quality_filter.settings() if quality_filter is not None else None,
+    }
+    barcode_index, consensus_stats = barcode_variant_consensus(
+        bowtie_output, index_fastq, max_mismatch, join, chunk_size, tmp_dir, quality_filter, bowtie_options,
+        barcode_length=barcode_length, min_reads=min_reads, min_purity=min_purity,
+        max_barcodes_in_memory=max_barcodes_in_memory)
+    barcode_index.save('barcode_index.bcidx')
+    consensus_stats.save('barcode_consensus.col', metadata)
+    print_consensus_summary(consensus_stats)
 
-    # check barcodes only have one variant - based on count - different script
+    if counter_table:
+        # the alignments were reported by the consensus pass already
+        bowtie_options = dict(bowtie_options or {}, report=False)
+        if join == 'stream':
+            barcode_variant_counter = ordered_barcode_variant_counter(bowtie_output, index_fastq, max_mismatch,
+                                                                      quality_filter, bowtie_options)
+            if barcode_variant_counter is None:
+                barcode_variant_counter = sorted_barcode_variant_counter(
+                    bowtie_output, index_fastq, max_mismatch, chunk_size, tmp_dir, quality_filter, bowtie_options)
+        else:
+            barcode_variant_counter = memory_barcode_variant_counter(bowtie_output, index_fastq, max_mismatch,
+                                                                     quality_filter, bowtie_options)
+        write_barcode_variant_counter('barcode_variant_counter.col', barcode_variant_counter, metadata)
 
 
 if __name__ == '__main__':
@@ -92,8 +479,35 @@ if __name__ == '__main__':
                           help='bowtie output file, which must include the illumina read header, the twist library'
                                'fasta identifier. Best alignment only')
     required.add_argument('-i', '--index_fastq', required=True,
-                          help='indexing fastq file from illumina sequencer')
+                          help='indexing fastq file from illumina sequencer, plain or gzipped')
     parser.add_argument('-m', '--max_mismatch', type=int, default=0,
                         help='max number of mismatches allowed between read and expected fasta sequence')
+    parser.add_argument('-l', '--barcode_length', type=int, default=LIBRARY_BARCODE_LENGTH,
+                        help='bases of the barcodes in the index reads, reads of other lengths are not mapped')
+    parser.add_argument('--mismatch_tag', choices=MISMATCH_TAGS, default='AS',
+                        help='count mismatches of a read pair from the AS:i alignment scores or the NM:i edit '
+                             'distances of its mates')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes parsing byte ranges of the bowtie output')
+    parser.add_argument('-j', '--join', choices=['stream', 'memory'], default='stream',
+                        help='stream: walk alignments and index reads together, falling back to an external sort '
+                             'when they are not in the same read order. memory: load both files into dictionaries')
+    parser.add_argument('-c', '--chunk_size', type=int, default=5000000,
+                        help='number of reads sorted in memory per spilled run of the external sort')
+    parser.add_argument('-t', '--tmp_dir', help='directory for external sort runs, defaults to the system temp dir')
+    parser.add_argument('-r', '--min_reads', type=int, default=1, help='reads a barcode needs to be accepted')
+    parser.add_argument('-p', '--min_purity', type=float, default=0.9,
+                        help='fraction of reads of a barcode that has to support its most frequent variant. '
+                             'barcodes below it are rejected as collisions')
+    parser.add_argument('--max_barcodes_in_memory', type=int, default=DEFAULT_MAX_BARCODES_IN_MEMORY,
+                        help='distinct barcode variant pairs held in memory before spilling to tmp_dir')
+    parser.add_argument('--counter_table', action='store_true',
+                        help='also write the raw barcode variant read counts to barcode_variant_counter.col')
+    add_quality_arguments(parser)
+    run_metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
-    bowtie_barcode_library_dict(args.bowtie_output, args.index_fastq, args.max_mismatch)
+    run_metrics.start_run(args)
+    bowtie_barcode_library_dict(args.bowtie_output, args.index_fastq, args.max_mismatch, args.join,
+                                args.chunk_size, args.tmp_dir, args.min_reads, args.min_purity,
+                                args.max_barcodes_in_memory, args.counter_table, quality_filter_from_arguments(args),
+                                {'workers': args.workers, 'mismatch_tag': args.mismatch_tag}, args.barcode_length)
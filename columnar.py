@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import pickle
+import struct
+
+import numpy as np
+
+TABLE_MAGIC = b'DMSCOL01'
+ALIGNMENT = 64
+VARIANT_COLUMNS = ['position', 'amino_acid']
+
+
+def write_table(table_file, columns, metadata=None):
+    """Writes equal length numpy columns as a json header followed by 64 byte aligned raw little endian arrays
+
+    Args:
+        table_file: path of the table to write
+        columns: dict of column name and numpy array. arrays may have extra dimensions after the row dimension,
+            e.g. a (variants, timepoints) count column. object and unicode arrays are stored as bytes
+        metadata: json serializable dict, e.g. sample name and timepoints
+    """
+    arrays = []
+    row_count = None
+    for name, array in columns.items():
+        array = np.asarray(array)
+        if array.dtype.kind in 'OU':
+            array = np.asarray(array.astype(str), dtype='S')
+        row_count = len(array) if row_count is None else row_count
+        assert len(array) == row_count, 'Column {0} has {1} rows, expected {2}'.format(name, len(array), row_count)
+        arrays.append((name, np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))))
+    header = {
+        'row_count': row_count or 0,
+        'metadata': metadata or {},
+        'columns': [{'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape)} for name, array in arrays],
+    }
+    header_bytes = json.dumps(header).encode()
+    with open(table_file, 'wb') as f:
+        f.write(TABLE_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays:
+            f.write(b'\0' * (-f.tell() % ALIGNMENT))
+            f.write(array.tobytes())
+
+
+def read_table(table_file, column_names=None, mmap=True):
+    """Reads a table written by write_table. only the header is parsed; columns are memory mapped, so reading a
+    subset of columns or rows only touches those pages
+
+    Args:
+        table_file: path of the table
+        column_names: optional list of columns to return, all columns by default
+        mmap: False copies the columns into memory
+
+    Returns:
+        tuple of dict of column name and numpy array, and metadata dict
+    """
+    with open(table_file, 'rb') as f:
+        assert f.read(len(TABLE_MAGIC)) == TABLE_MAGIC, '{0} is not a columnar table'.format(table_file)
+        header_length, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_length).decode())
+    offset = len(TABLE_MAGIC) + 8 + header_length
+    columns = collections.OrderedDict()
+    for column in header['columns']:
+        offset += -offset % ALIGNMENT
+        dtype = np.dtype(column['dtype'])
+        shape = tuple(column['shape'])
+        size = int(np.prod(shape)) * dtype.itemsize
+        if column_names is None or column['name'] in column_names:
+            if size:
+                array = np.memmap(table_file, dtype=dtype, mode='r', offset=offset, shape=shape)
+                columns[column['name']] = array if mmap else np.array(array)
+            else:
+                columns[column['name']] = np.zeros(shape, dtype=dtype)
+        offset += size
+    return columns, header['metadata']
+
+
+def is_table(path):
+    with open(path, 'rb') as f:
+        return f.read(len(TABLE_MAGIC)) == TABLE_MAGIC
+
+
+def variant_columns(variants):
+    """position and amino acid columns for a list of (position, amino acid) tuples"""
+    return collections.OrderedDict([
+        ('position', np.array([position for position, amino_acid in variants], dtype=np.int16)),
+        ('amino_acid', np.array([amino_acid.encode() for position, amino_acid in variants], dtype='S')),
+    ])
+
+
+def table_variants(columns):
+    """list of (position, amino acid) tuples from the position and amino acid columns of a table"""
+    return list(zip(columns['position'].tolist(), (amino_acid.decode() for amino_acid in
+                                                   columns['amino_acid'].tolist())))
+
+
+def write_variant_dict(table_file, variant_value_dict, value_column='fitness', metadata=None):
+    """Writes a dictionary of (position, amino acid) keys and float values as a variant table"""
+    variants = list(variant_value_dict.keys())
+    columns = variant_columns(variants)
+    columns[value_column] = np.array([variant_value_dict[variant] for variant in variants], dtype=float)
+    write_table(table_file, columns, metadata)
+
+
+def fitness_dict_from_text_file(fitness_text_file):
+    """parses text file of one tuple and one float per line into a dictionary
+
+    Args:
+        fitness_text_file: txt file with each line formatted as follows
+            (integer, 'Capital single character amino acid'),fitness_value
+
+    Returns:
+        A dict with keys of tuples (position, amino acid char) and values of variant fitness floats
+
+    Raises:
+
+    """
+    fitness_dict = {}
+    with open(fitness_text_file, 'r') as f:
+        for line in f:
+            position, amino_acid, fitness = line.rstrip().split(',')
+            position = int(position.split('(')[-1])
+            amino_acid = amino_acid.split("'")[1]
+            fitness = float(fitness)
+            fitness_dict[(position, amino_acid)] = fitness
+    return fitness_dict
+
+
+def load_variant_dict(path, value_column='fitness'):
+    """Loads a dictionary of (position, amino acid) keys and float values from a variant table, or from the
+    legacy pickle and text formats. table rows with a NaN value, e.g. variants filtered out of a replicate
+    comparison, are left out
+
+    Raises:
+        IOError: file is not a variant table, pickle or text file
+    """
+    if is_table(path):
+        columns, metadata = read_table(path, VARIANT_COLUMNS + [value_column])
+        values = columns[value_column]
+        keep = ~np.isnan(values)
+        return dict(zip((variant for variant, kept in zip(table_variants(columns), keep.tolist()) if kept),
+                        values[keep].tolist()))
+    elif path.endswith('.pkl'):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    elif path.endswith('.txt'):
+        return fitness_dict_from_text_file(path)
+    raise IOError('Please give fitness dictionary as a variant table, pickle or text file')
+
+
+def write_barcode_variant_counter(table_file, barcode_variant_counter, metadata=None):
+    """Writes a dictionary of barcode keys and Counter values of variant read counts as a long table with one
+    row per barcode and variant"""
+    rows = [(barcode, variant, count) for barcode, variant_counter in barcode_variant_counter.items()
+            for variant, count in variant_counter.items()]
+    columns = variant_columns([variant for barcode, variant, count in rows])
+    columns['barcode'] = np.array([barcode.encode() for barcode, variant, count in rows], dtype='S')
+    columns['count'] = np.array([count for barcode, variant, count in rows], dtype=np.int64)
+    write_table(table_file, columns, metadata)
+
+
+def load_barcode_variant_counter(path):
+    """Loads a barcode variant counter table, or a legacy pickle of a dictionary of barcode keys and Counter
+    values"""
+    if not is_table(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    columns, metadata = read_table(path)
+    barcode_variant_counter = collections.defaultdict(collections.Counter)
+    for barcode, variant, count in zip(columns['barcode'].tolist(), table_variants(columns),
+                                       columns['count'].tolist()):
+        barcode_variant_counter[barcode.decode()][variant] += count
+    return barcode_variant_counter
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to convert legacy fitness pickles or text files into
+    variant tables, or to print the contents of a table""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-i', '--input', required=True,
+                          help='columnar table, or pickle / text file of a variant fitness dictionary')
+    parser.add_argument('-o', '--output', help='variant table to write. prints the input table if not given')
+    parser.add_argument('-c', '--value_column', default='fitness', help='name of the value column')
+    args = parser.parse_args()
+
+    if args.output:
+        write_variant_dict(args.output, load_variant_dict(args.input, args.value_column), args.value_column,
+                           {'source': args.input})
+    else:
+        table_columns, table_metadata = read_table(args.input)
+        print(json.dumps(table_metadata))
+        print('\t'.join(table_columns))
+        for row in zip(*(column.tolist() for column in table_columns.values())):
+            print('\t'.join(value.decode() if isinstance(value, bytes) else str(value) for value in row))
@@ -1,67 +1,248 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
 import numpy as np
-import pickle
 
+import run_metrics
+from columnar import is_table, load_variant_dict, variant_columns, write_table
 
-def compare_duplicates(fitness_dict1, fitness_dict2, max_percent_difference, name_suffix):
-    variants_missing_from_rep = set(fitness_dict2.keys()) - set(fitness_dict1.keys())
-    percent_diffs = []
-    output_dict = {}
-    print('Variants with percent difference greater than max')
-    print('variant\tfitness1\tfitness2\tpercent difference')
-    for variant1, fitness1 in fitness_dict1.items():
-        if variant1 in fitness_dict2.keys():
-            fitness2 = fitness_dict2[variant1]
-            percent_diff = 100 * (abs(fitness1 - fitness2) / ((fitness1 + fitness2) / 2))
-            percent_diffs.append(percent_diff)
-            if percent_diff: #< max_percent_difference:
-                output_dict[variant1] = np.average([fitness1, fitness2])
-            else:
-                print('{0}\t{1}\t{2}\t{3}'.format(variant1,
-                                                  round(fitness1, 2),
-                                                  round(fitness2, 2),
-                                                  round(percent_diff), 2)
-                      )
+CONSENSUS_METHODS = ['mean', 'median', 'weighted']
+# smallest standard error weighted by the weighted consensus. fits through every point, e.g. of two timepoints, have
+# a standard error of 0 and would otherwise get an infinite weight
+MIN_STD_ERR = 1e-3
+
+
+def replicate_matrix(fitness_dicts):
+    """aligns replicate fitness dictionaries by variant
+
+    Args:
+        fitness_dicts: list of dictionaries with (position, amino acid) keys and float values
+
+    Returns:
+        tuple of sorted list of all variants and (variants, replicates) float array, NaN where a replicate is
+        missing a variant
+    """
+    variants = sorted(set().union(*fitness_dicts))
+    row_of_variant = {variant: row for row, variant in enumerate(variants)}
+    matrix = np.full((len(variants), len(fitness_dicts)), np.nan)
+    for column, fitness_dict in enumerate(fitness_dicts):
+        rows = [row_of_variant[variant] for variant in fitness_dict]
+        matrix[rows, column] = list(fitness_dict.values())
+    return variants, matrix
+
+
+def pairwise_percent_differences(matrix):
+    """percent difference 100 * |a - b| / |mean(a, b)| between every pair of replicate columns
+
+    Returns:
+        tuple of list of (replicate, replicate) pairs and (variants, pairs) float array, NaN where either
+        replicate is missing
+    """
+    pairs = list(itertools.combinations(range(matrix.shape[1]), 2))
+    first, second = np.array(pairs, dtype=int).reshape(-1, 2).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent_differences = 100 * np.abs(matrix[:, first] - matrix[:, second]) / \
+            np.abs((matrix[:, first] + matrix[:, second]) / 2)
+    return pairs, percent_differences
+
+
+def pairwise_correlations(matrix):
+    """pearson correlation between every pair of replicate columns over the variants present in both
+
+    Returns:
+        (replicates, replicates) float array
+    """
+    present = ~np.isnan(matrix)
+    values = np.where(present, matrix, 0)
+    both = present.T.astype(float) @ present
+    sums = values.T @ present
+    squares = (values ** 2).T @ present
+    products = values.T @ values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums * sums.T / both
+        variance = squares - sums ** 2 / both
+        return covariance / np.sqrt(variance * variance.T)
+
+
+def consensus_fitness(matrix, std_err_matrix=None, min_std_err=MIN_STD_ERR):
+    """mean, median and inverse variance weighted mean of the present replicates of every variant. the weighted
+    mean needs a finite standard error for every present replicate and is NaN otherwise. standard errors below
+    min_std_err, including those of perfect fits, are weighted as min_std_err
+
+    Returns:
+        dict of consensus method and (variants,) float array
+    """
+    present = ~np.isnan(matrix)
+    replicate_count = present.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(present, matrix, 0).sum(axis=1) / replicate_count
+        sorted_matrix = np.sort(matrix, axis=1)
+        rows = np.arange(len(matrix))
+        lower = sorted_matrix[rows, np.maximum(replicate_count - 1, 0) // 2]
+        upper = sorted_matrix[rows, replicate_count // 2]
+        median = np.where(replicate_count > 0, (lower + upper) / 2, np.nan)
+        if std_err_matrix is None:
+            weighted = np.full(len(matrix), np.nan)
         else:
-            variants_missing_from_rep.add(variant1)
-    print()
-    print('Number of variants not present in both replicates: {0}'.format(len(variants_missing_from_rep)))
-    print('Variants not present in both replicates:')
-    print(variants_missing_from_rep)
+            weights = 1 / np.maximum(std_err_matrix, min_std_err) ** 2
+            weighted = np.where(present, matrix * weights, 0).sum(axis=1) / np.where(present, weights, 0).sum(axis=1)
+            weighted[(present & ~np.isfinite(std_err_matrix)).any(axis=1)] = np.nan
+    return {'mean': mean, 'median': median, 'weighted': weighted}
+
+
+def compare_replicates(fitness_dicts, max_percent_difference=50, consensus='mean', std_err_dicts=None,
+                       min_replicates=None):
+    """compares any number of replicate fitness dictionaries in one pass over a (variants, replicates) matrix.
+    variants with any pairwise percent difference above max_percent_difference are flagged as outliers and, like
+    variants measured in fewer than min_replicates replicates, get no consensus fitness
+
+    Args:
+        fitness_dicts: list of dictionaries with (position, amino acid) keys and float values
+        max_percent_difference: largest pairwise percent difference of a variant that is not an outlier
+        consensus: mean, median or weighted (inverse variance weighted mean)
+        std_err_dicts: optional list of dictionaries of fitness standard errors, needed for weighted consensus
+        min_replicates: replicates a variant has to be present in, all replicates by default
+
+    Returns:
+        tuple of list of variants, dict of (variants,) or (variants, replicates) column arrays, and
+        (replicates, replicates) correlation matrix
+    """
+    assert consensus in CONSENSUS_METHODS, 'Consensus method must be one of {0}'.format(CONSENSUS_METHODS)
+    assert len(fitness_dicts) >= 2, 'At least two replicates are needed for comparison'
+    if min_replicates is None:
+        min_replicates = len(fitness_dicts)
+    variants, matrix = replicate_matrix(fitness_dicts)
+    std_err_matrix = None
+    if std_err_dicts is not None:
+        row_of_variant = {variant: row for row, variant in enumerate(variants)}
+        std_err_matrix = np.full(matrix.shape, np.nan)
+        for column, std_err_dict in enumerate(std_err_dicts):
+            rows = [row_of_variant[variant] for variant in std_err_dict if variant in row_of_variant]
+            std_err_matrix[rows, column] = [std_err_dict[variants[row]] for row in rows]
+
+    replicate_count = (~np.isnan(matrix)).sum(axis=1)
+    pairs, percent_differences = pairwise_percent_differences(matrix)
+    compared = ~np.isnan(percent_differences)
+    max_differences = np.where(compared, percent_differences, -np.inf).max(axis=1, initial=-np.inf)
+    max_differences[~compared.any(axis=1)] = np.nan
+    outlier = max_differences > max_percent_difference
+    consensus_columns = consensus_fitness(matrix, std_err_matrix)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        squared_deviations = np.nansum((matrix - consensus_columns['mean'][:, None]) ** 2, axis=1)
+        std = np.where(replicate_count > 1, np.sqrt(squared_deviations / (replicate_count - 1)), np.nan)
+        cv = std / np.abs(consensus_columns['mean'])
+
+    passed = ~outlier & (replicate_count >= min_replicates)
+    columns = {
+        'fitness': np.where(passed, consensus_columns[consensus], np.nan),
+        'mean': consensus_columns['mean'],
+        'median': consensus_columns['median'],
+        'weighted': consensus_columns['weighted'],
+        'std': std,
+        'cv': cv,
+        'replicates': replicate_count,
+        'max_percent_difference': max_differences,
+        'outlier': outlier,
+        'replicate_fitness': matrix,
+        'percent_differences': percent_differences,
+    }
+    return variants, columns, pairwise_correlations(matrix)
+
+
+def print_replicate_summary(replicate_names, variants, columns, correlations, max_percent_difference):
+    replicate_count = len(replicate_names)
+    present_in_all = columns['replicates'] == replicate_count
+    print('Variants not present in all replicates: {0} of {1}'.format(
+        int((~present_in_all).sum()), len(variants)))
+    print('Variants with percent difference greater than {0}: {1}'.format(
+        max_percent_difference, int(columns['outlier'].sum())))
     print()
-    print('Average percent difference: {0} +/- {1}'.format(
-        round(np.average(percent_diffs), 3),
-        round(np.std(percent_diffs), 3)
-    ))
+    print('replicate 1\treplicate 2\tvariants\tpearson r\taverage percent difference')
+    pairs = itertools.combinations(range(replicate_count), 2)
+    for pair_index, (first, second) in enumerate(pairs):
+        percent_differences = columns['percent_differences'][:, pair_index]
+        percent_differences = percent_differences[np.isfinite(percent_differences)]
+        print('{0}\t{1}\t{2}\t{3}\t{4} +/- {5}'.format(
+            replicate_names[first], replicate_names[second], len(percent_differences),
+            round(float(correlations[first, second]), 3),
+            round(float(np.average(percent_differences)), 3) if len(percent_differences) else 'nan',
+            round(float(np.std(percent_differences)), 3) if len(percent_differences) else 'nan'))
+
+
+def compare_duplicates(fitness_dict1, fitness_dict2, max_percent_difference, name_suffix):
+    """compares two replicate fitness dictionaries and writes the consensus table"""
+    write_replicate_table(['replicate1', 'replicate2'], [fitness_dict1, fitness_dict2], max_percent_difference,
+                          name_suffix)
+
+
+def write_replicate_table(replicate_names, fitness_dicts, max_percent_difference=50, name_suffix=None,
+                          consensus='mean', std_err_dicts=None, min_replicates=None):
+    """compares replicates, prints a summary and writes one table of per variant consensus fitness, spread and
+    outlier flags with per replicate fitness and pairwise percent difference columns
+
+    Returns:
+        path of the written table
+    """
+    with run_metrics.stage('compare replicates', sum(len(fitness_dict) for fitness_dict in fitness_dicts)):
+        variants, columns, correlations = compare_replicates(
+            fitness_dicts, max_percent_difference, consensus, std_err_dicts, min_replicates)
+    run_metrics.count('variants', len(variants))
+    run_metrics.count('outlier_variants', int(columns['outlier'].sum()))
+    run_metrics.count('variants_not_in_all_replicates', int((columns['replicates'] < len(fitness_dicts)).sum()))
+    print_replicate_summary(replicate_names, variants, columns, correlations, max_percent_difference)
     if name_suffix:
-        output_file = 'avg_duplicates_{0}.pkl'.format(name_suffix)
+        output_file = 'avg_duplicates_{0}.col'.format(name_suffix)
     else:
-        output_file = 'avg_duplicates.pkl'
-    with open(output_file, 'wb') as f:
-        pickle.dump(output_dict, f)
+        output_file = 'avg_duplicates.col'
+    table_columns = variant_columns(variants)
+    table_columns.update(columns)
+    write_table(output_file, table_columns, {
+        'sample': name_suffix,
+        'replicates': replicate_names,
+        'pairs': [[replicate_names[first], replicate_names[second]] for first, second in
+                  itertools.combinations(range(len(replicate_names)), 2)],
+        'consensus': consensus,
+        'max_percent_difference': max_percent_difference,
+        'min_replicates': min_replicates or len(replicate_names),
+        'correlations': np.where(np.isnan(correlations), None, correlations).tolist(),
+    })
+    return output_file
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="""script to compare fitness dictionaries between two replicates. 
-    currently only supports dictionaries with a single floating point number as the key 
-    and only supports two replicates""")
+    parser = argparse.ArgumentParser(description="""script to compare fitness values of any number of replicates.
+    writes one table with the consensus fitness of every variant present in enough replicates and not flagged as
+    an outlier, along with per replicate values, pairwise percent differences, cv and outlier flags""")
     required = parser.add_argument_group('required')
     required.add_argument('-f', '--fitness_pickles', nargs='*', required=True,
-                          help='fitness dictionary in pickle format with keys as variant descriptors '
-                               'and values as floats')
-    parser.add_argument('-p', '--max_percent_difference', default=50,
-                        help='output fitness values will be the average of fitness values with percent '
-                             'difference less than this cutoff')
+                          help='variant fitness tables, or fitness dictionaries in pickle format with keys as '
+                               'variant descriptors and values as floats')
+    parser.add_argument('-p', '--max_percent_difference', type=float, default=50,
+                        help='variants with a pairwise percent difference above this cutoff are flagged as '
+                             'outliers and get no consensus fitness')
+    parser.add_argument('-c', '--consensus', choices=CONSENSUS_METHODS, default='mean',
+                        help='consensus fitness of replicates. weighted uses the inverse squared standard error '
+                             'column of variant fitness tables')
+    parser.add_argument('-s', '--std_err_column', default='std_err',
+                        help='standard error column of weighted consensus, std_err of the regression or fitness_se '
+                             'of tables written with resampled counts')
+    parser.add_argument('-m', '--min_replicates', type=int,
+                        help='replicates a variant has to be present in to get a consensus fitness. default all')
     parser.add_argument('-n', '--name_suffix')
+    run_metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
+    run_metrics.start_run(args)
 
-    if len(args.fitness_pickles) != 2:
-        raise IOError('two pickle files containing fitness values are reqquired')
-    with open(args.fitness_pickles[0], 'rb') as f:
-        fitness_dict1 = pickle.load(f)
-    with open(args.fitness_pickles[1], 'rb') as f:
-        fitness_dict2 = pickle.load(f)
-    compare_duplicates(fitness_dict1, fitness_dict2, args.max_percent_difference, args.name_suffix)
-
+    if len(args.fitness_pickles) < 2:
+        raise IOError('at least two files containing fitness values are required')
+    replicate_fitness_dicts = [load_variant_dict(fitness_file) for fitness_file in args.fitness_pickles]
+    replicate_std_err_dicts = None
+    if args.consensus == 'weighted':
+        if not all(is_table(fitness_file) for fitness_file in args.fitness_pickles):
+            raise IOError('weighted consensus needs variant fitness tables with a {0} column'.format(
+                args.std_err_column))
+        replicate_std_err_dicts = [load_variant_dict(fitness_file, args.std_err_column)
+                                   for fitness_file in args.fitness_pickles]
+    write_replicate_table(args.fitness_pickles, replicate_fitness_dicts, args.max_percent_difference,
+                          args.name_suffix, args.consensus, replicate_std_err_dicts, args.min_replicates)
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 import argparse
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pylab as plt
 
+from variant_annotation import REGIONS, load_annotated_fitness
+
 
 def correlate_helical_propensity(helical_propensity_df, x, y):
     """
@@ -24,98 +27,23 @@ def correlate_helical_propensity(helical_propensity_df, x, y):
     sns.regplot(x=x, y=y, data=helical_propensity_df)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="""script to generate figures analyzing alpha synuclein fitness 
-    values and alpha helix propensity""")
-    required = parser.add_argument_group('required')
-    required.add_argument('-f', '--fitness_csv', required=True,
-                          help="csv file containing at least 3 columns: fitness, variant_aa, variant_num")
-    parser.add_argument('-p', '--helical_propensity_csv', default='helical_propensity.csv',
-                        help='csv file containing at least 2 columns: One letter, Helical Penalty (kJ/mol)')
-    args = parser.parse_args()
-
-    fitness_df = pd.read_csv(args.fitness_csv, header=0)
-    fitness_df.dropna(inplace=True)
-    fitness_df = fitness_df[fitness_df['variant_aa'] != '*']
+def helix_group_boxplot(fitness_csv, filename='helix_groups_untreated.png'):
+    """box plot of fitness of mutations to G or P, to D or E and to other amino acids, in the KxKEGV repeats and
+    past them. Other holds the mutations to any amino acid but G, P, D and E
 
-    helical_propensity_df = pd.read_csv(args.helical_propensity_csv, header=0)
-    helical_propensity_df.set_index('One letter', inplace=True)
+    Args:
+        fitness_csv: csv file containing at least 3 columns: fitness, variant_aa, variant_num, or a variant table
+        filename: image to write
+    """
+    fitness_df = load_annotated_fitness(fitness_csv)
+    fitness_df = fitness_df[(fitness_df['amino_acid'] != '*') & (fitness_df['position'] > 0)]
 
-    # N terminal helix last position
-    n_term_helix_end = 32
-
-    # KxKEGV repeat last position
-    repeat_end = 63
-
-    # df_allaa_allpos = fitness_df
-    # df_allaa_allpos['Group'] = 'All pos All AAs'
-    #
-    # df_gp_allpos = fitness_df[
-    #         (fitness_df['variant_aa'] == 'P') |
-    #         (fitness_df['variant_aa'] == 'G')
-    #     ]
-    # df_gp_allpos['Group'] = 'All pos G P'
-    #
-    # df_de_allpos = fitness_df[
-    #     (fitness_df['variant_aa'] == 'D') |
-    #     (fitness_df['variant_aa'] == 'E')
-    # ]
-    # df_de_allpos['Group'] = 'All pos D E'
-
-    df_allaa_1_63 = fitness_df[fitness_df['variant_num'] < repeat_end + 1]
-    df_other_1_63 = df_allaa_1_63[
-        (df_allaa_1_63['variant_aa'] != 'P') |
-        (df_allaa_1_63['variant_aa'] != 'G') |
-        (df_allaa_1_63['variant_aa'] != 'D') |
-        (df_allaa_1_63['variant_aa'] != 'E')
-    ]
-    df_other_1_63['Group'] = 'Repeat Other'
-    df_other_1_63['AAs'] = 'Other'
-
-    df_gp_1_63 = df_allaa_1_63[
-        (df_allaa_1_63['variant_aa'] == 'P') |
-        (df_allaa_1_63['variant_aa'] == 'G')
-    ]
-    df_gp_1_63['Group'] = 'Repeat G P'
-    df_gp_1_63['AAs'] = 'G P'
-
-    df_de_1_63 = df_allaa_1_63[
-        (df_allaa_1_63['variant_aa'] == 'D') |
-        (df_allaa_1_63['variant_aa'] == 'E')
-        ]
-    df_de_1_63['Group'] = 'Repeat D E'
-    df_de_1_63['AAs'] = 'D E'
-
-    df_allaa_140 = fitness_df[fitness_df['variant_num'] > repeat_end]
-    df_other_140 = df_allaa_140[
-        (df_allaa_140['variant_aa'] != 'P') |
-        (df_allaa_140['variant_aa'] != 'G') |
-        (df_allaa_140['variant_aa'] != 'D') |
-        (df_allaa_140['variant_aa'] != 'E')
-    ]
-    df_other_140['Group'] = 'Past Other'
-    df_other_140['AAs'] = 'Other'
-
-    df_gp_140 = df_allaa_140[
-        (df_allaa_140['variant_aa'] == 'P') |
-        (df_allaa_140['variant_aa'] == 'G')
-        ]
-    df_gp_140['Group'] = 'Past G P'
-    df_gp_140['AAs'] = 'G P'
-
-    df_de_140 = df_allaa_140[
-        (df_allaa_140['variant_aa'] == 'D') |
-        (df_allaa_140['variant_aa'] == 'E')
-        ]
-    df_de_140['Group'] = 'Past D E'
-    df_de_140['AAs'] = 'D E'
-
-    composite_df = pd.concat(
-        [df_other_1_63, df_gp_1_63, df_de_1_63, df_other_140, df_gp_140, df_de_140]
-    )
-
-    # composite_df = pd.concat(
-    #     [df_allaa_allpos, df_gp_allpos, df_de_allpos, df_allaa_1_63, df_gp_1_63, df_de_1_63])
+    # positions up to the end of the KxKEGV repeats, including the N terminal helix, against the positions past them
+    in_repeats = fitness_df['region'].cat.codes.to_numpy() <= REGIONS.index('KTKEGV repeats')
+    amino_acid_groups = np.select([fitness_df['variant_helix_breaker'], fitness_df['variant_acidic']],
+                                  ['G P', 'D E'], 'Other')
+    composite_df = fitness_df.assign(
+        Group=np.char.add(np.where(in_repeats, 'Repeat ', 'Past '), amino_acid_groups), AAs=amino_acid_groups)
 
     # violin_ax = sns.violinplot(x='Group', y='fitness', data=composite_df, scale='width')
     # violin_fig = violin_ax.get_figure()
@@ -125,10 +53,29 @@ if __name__ == '__main__':
                          y='fitness',
                          data=composite_df,
                          showfliers=False,
-                         hue='AAs'
+                         hue='AAs',
+                         order=['Repeat Other', 'Repeat G P', 'Repeat D E', 'Past Other', 'Past G P', 'Past D E'],
+                         hue_order=['Other', 'G P', 'D E']
                          )
     box_fig = box_ax.get_figure()
-    box_fig.savefig('helix_groups_untreated.png', dpi=500)
+    box_fig.savefig(filename, dpi=500)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to generate figures analyzing alpha synuclein fitness 
+    values and alpha helix propensity""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-f', '--fitness_csv', required=True,
+                          help="csv file containing at least 3 columns: fitness, variant_aa, variant_num, or a "
+                               "variant table")
+    parser.add_argument('-p', '--helical_propensity_csv', default='helical_propensity.csv',
+                        help='csv file containing at least 2 columns: One letter, Helical Penalty (kJ/mol)')
+    args = parser.parse_args()
+
+    helical_propensity_df = pd.read_csv(args.helical_propensity_csv, header=0)
+    helical_propensity_df.set_index('One letter', inplace=True)
+
+    helix_group_boxplot(args.fitness_csv)
 
 
 
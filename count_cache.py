@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from columnar import read_table, write_table
+
+FINGERPRINT_BLOCK_SIZE = 16 * 1024 * 1024
+DEFAULT_CHECKPOINT_BYTES = 1024 * 1024 * 1024
+
+
+def _write_atomic(write_function, path, *args):
+    """Writes to a temporary file next to path and renames it, so readers never see a partial file"""
+    tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+    write_function(tmp_path, *args)
+    os.replace(tmp_path, path)
+
+
+def file_fingerprint(path, memo_dir):
+    """blake2b digest of the full file contents. the digest is remembered in memo_dir next to the file's path,
+    size, modification time and inode, so it is only recomputed when the file changes"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    file_state = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    memo_file = os.path.join(memo_dir, hashlib.sha1(path.encode()).hexdigest() + '.json')
+    if os.path.exists(memo_file):
+        with open(memo_file, 'r') as f:
+            memo = json.load(f)
+        if memo['file_state'] == file_state:
+            return memo['fingerprint']
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(FINGERPRINT_BLOCK_SIZE), b''):
+            digest.update(block)
+    fingerprint = '{0}-{1}'.format(stat.st_size, digest.hexdigest())
+    os.makedirs(memo_dir, exist_ok=True)
+    _write_atomic(_write_json, memo_file, {'path': path, 'file_state': file_state, 'fingerprint': fingerprint})
+    return fingerprint
+
+
+def _write_json(json_file, value):
+    with open(json_file, 'w') as f:
+        json.dump(value, f)
+
+
+class Checkpoint(object):
+    """Partial barcode counts of one count job with the byte offset of the first record not yet counted"""
+
+    def __init__(self, checkpoint_file, interval=DEFAULT_CHECKPOINT_BYTES):
+        self.checkpoint_file = checkpoint_file
+        self.interval = interval
+
+    def load(self):
+        """Returns offset, barcode counts and match counter of the last checkpoint, or None"""
+        if not os.path.exists(self.checkpoint_file):
+            return None
+        columns, metadata = read_table(self.checkpoint_file, mmap=False)
+        return metadata['offset'], columns['barcode_counts'], collections.Counter(metadata['match_counter'])
+
+    def save(self, offset, barcode_counts, match_counter):
+        _write_atomic(write_table, self.checkpoint_file, {'barcode_counts': barcode_counts},
+                      {'offset': offset, 'match_counter': dict(match_counter)})
+
+    def clear(self):
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+
+class CountCache(object):
+    """Directory of per fastq barcode count tables keyed by a content fingerprint of the fastq, the barcode index
+    version and the counting parameters. unchanged inputs are never counted twice, and interrupted counts resume
+    from their last checkpoint. the byte ranges a fastq is counted in are stored until its count is finished, so a
+    count resumed with another number of workers reuses the ranges and checkpoints of the interrupted one.
+    extraction is the json serializable barcode extraction setting, None for the first bases of every read"""
+
+    def __init__(self, cache_dir, index_version, max_mismatches=0, checkpoint_bytes=DEFAULT_CHECKPOINT_BYTES,
+                 extraction=None):
+        self.cache_dir = cache_dir
+        self.index_version = index_version
+        self.max_mismatches = max_mismatches
+        self.extraction = extraction
+        self.checkpoint_bytes = checkpoint_bytes
+        os.makedirs(os.path.join(cache_dir, 'fingerprints'), exist_ok=True)
+
+    def fingerprint(self, fastq_file):
+        return file_fingerprint(fastq_file, os.path.join(self.cache_dir, 'fingerprints'))
+
+    def key(self, fingerprint, start=0, end=None):
+        """cache key of the counts of the records in byte range start, end of a fastq"""
+        key_fields = [fingerprint, self.index_version, self.max_mismatches, start, end]
+        if self.extraction is not None:
+            # keys of counts of the first bases of reads stay the same as before extraction was configurable
+            key_fields.append(self.extraction)
+        return hashlib.sha1(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+
+    def _count_file(self, key):
+        return os.path.join(self.cache_dir, key + '.col')
+
+    def _byte_ranges_file(self, fingerprint):
+        return os.path.join(self.cache_dir, self.key(fingerprint) + '.ranges.json')
+
+    def byte_ranges(self, fingerprint):
+        """(start, end) byte ranges an unfinished count of a fastq was split into, None if none was started"""
+        if not os.path.exists(self._byte_ranges_file(fingerprint)):
+            return None
+        with open(self._byte_ranges_file(fingerprint), 'r') as f:
+            return [tuple(byte_range) for byte_range in json.load(f)]
+
+    def save_byte_ranges(self, fingerprint, byte_ranges):
+        _write_atomic(_write_json, self._byte_ranges_file(fingerprint),
+                      [list(byte_range) for byte_range in byte_ranges])
+
+    def clear_byte_ranges(self, fingerprint):
+        if os.path.exists(self._byte_ranges_file(fingerprint)):
+            os.remove(self._byte_ranges_file(fingerprint))
+
+    def checkpoint(self, key):
+        return Checkpoint(os.path.join(self.cache_dir, key + '.partial.col'), self.checkpoint_bytes)
+
+    def load(self, key):
+        """Returns barcode counts and match counter of a finished count, or None"""
+        if not os.path.exists(self._count_file(key)):
+            return None
+        columns, metadata = read_table(self._count_file(key), mmap=False)
+        return columns['barcode_counts'], collections.Counter(metadata['match_counter'])
+
+    def store(self, key, barcode_counts, match_counter, metadata=None):
+        metadata = dict(metadata or {}, match_counter=dict(match_counter), index_version=self.index_version,
+                        max_mismatches=self.max_mismatches)
+        _write_atomic(write_table, self._count_file(key), {'barcode_counts': np.asarray(barcode_counts)}, metadata)
+        self.checkpoint(key).clear()
+
+    def remove(self, key):
+        if os.path.exists(self._count_file(key)):
+            os.remove(self._count_file(key))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to list the per fastq barcode counts in a count cache
+    directory""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-c', '--cache_dir', required=True, help='count cache directory')
+    args = parser.parse_args()
+
+    print('cache file\tfastq\treads\tbarcode hits\tindex version')
+    for cache_file in sorted(os.listdir(args.cache_dir)):
+        if not cache_file.endswith('.col') or cache_file.endswith('.partial.col'):
+            continue
+        cache_columns, cache_metadata = read_table(os.path.join(args.cache_dir, cache_file), ['barcode_counts'])
+        print('{0}\t{1}\t{2}\t{3}\t{4}'.format(
+            cache_file,
+            cache_metadata.get('fastq_file', ''),
+            cache_metadata['match_counter'].get('reads', 0),
+            int(cache_columns['barcode_counts'].sum()),
+            cache_metadata.get('index_version', '')))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import run_metrics
+from barcode_counts import BarcodeCountMatrix
+from barcode_extraction import BarcodeExtractor, add_extraction_arguments, extractor_from_arguments
+from barcode_index import BarcodeIndex, encode_barcodes
+from fastq_reader import fastq_batches, fastq_byte_ranges
+from quality_filter import add_quality_arguments, print_quality_summary, quality_filter_from_arguments
+from variant_fitness import write_count_table
+
+INDEX_SEPARATOR = ord(':')
+
+
+class SampleSheet(object):
+    """Sample index of every timepoint of every sample of a multiplexed lane. every (sample, timepoint) pair is a
+    slot, numbered in sample order and timepoint order within a sample
+
+    Args:
+        sample_indexes: OrderedDict of sample name and list of index sequences in timepoint order, e.g. CGTGAT, or
+            i7+i5 for dual indexes as written at the end of illumina headers. all indexes have the same length
+
+    Raises:
+        IOError: indexes differ in length or an index is used by two slots
+    """
+
+    def __init__(self, sample_indexes):
+        self.sample_indexes = sample_indexes
+        self.slots = [(sample, timepoint, index.upper()) for sample, indexes in sample_indexes.items()
+                      for timepoint, index in enumerate(indexes)]
+        index_lengths = set(len(index) for sample, timepoint, index in self.slots)
+        if len(index_lengths) != 1:
+            raise IOError('sample indexes need to have the same length, found {0}'.format(sorted(index_lengths)))
+        self.index_length = index_lengths.pop()
+        duplicates = [index for index, count in collections.Counter(
+            index for sample, timepoint, index in self.slots).items() if count > 1]
+        if duplicates:
+            raise IOError('sample indexes used more than once: {0}'.format(', '.join(duplicates)))
+        self.indexes = np.frombuffer(''.join(index for sample, timepoint, index in self.slots).encode(),
+                                     dtype=np.uint8).reshape(len(self.slots), self.index_length)
+        # exact matches are found by binary search over the sorted indexes
+        index_strings = self.indexes.view('S{0}'.format(self.index_length)).ravel()
+        self.sorted_slots = np.argsort(index_strings)
+        self.sorted_indexes = index_strings[self.sorted_slots]
+
+    def __len__(self):
+        return len(self.slots)
+
+    @classmethod
+    def load(cls, sample_sheet_file):
+        """Reads a json dict of sample name and list of index sequences in timepoint order, or a dict with such a
+        samples dict"""
+        with open(sample_sheet_file, 'r') as f:
+            sample_sheet = json.load(f, object_pairs_hook=collections.OrderedDict)
+        return cls(sample_sheet.get('samples', sample_sheet))
+
+    def sample_slots(self):
+        """OrderedDict of sample name and list of its slots in timepoint order"""
+        sample_slots = collections.OrderedDict((sample, []) for sample in self.sample_indexes)
+        for slot, (sample, timepoint, index) in enumerate(self.slots):
+            sample_slots[sample].append(slot)
+        return sample_slots
+
+    def assign(self, fastq_batch, max_mismatches=0, match_counter=None):
+        """Slot of every read of a batch by the index at the end of its header. reads without an exact index match
+        are assigned to the only index within max_mismatches substitutions
+
+        Args:
+            fastq_batch: fastq_reader.FastqBatch
+            max_mismatches: substitutions allowed between header and sample index
+            match_counter: optional Counter incremented with index_exact, index_corrected, index_ambiguous and
+                index_not_found read counts
+
+        Returns:
+            int64 array of slots, -1 for reads that were not assigned
+        """
+        length = self.index_length
+        windows = fastq_batch.fixed_width(np.maximum(fastq_batch.id_ends - length, 0), length)
+        has_index = fastq_batch.buffer[np.maximum(fastq_batch.id_ends - length - 1, 0)] == INDEX_SEPARATOR
+        index_strings = np.ascontiguousarray(windows).view('S{0}'.format(length)).ravel()
+        positions = np.minimum(np.searchsorted(self.sorted_indexes, index_strings), len(self) - 1)
+        exact = has_index & (self.sorted_indexes[positions] == index_strings)
+        slots = np.where(exact, self.sorted_slots[positions], -1)
+        corrected = ambiguous = 0
+        if max_mismatches:
+            # only reads without an exact match are compared to every index
+            inexact = np.flatnonzero(has_index & ~exact)
+            mismatches = (windows[inexact, None, :] != self.indexes[None]).sum(axis=2, dtype=np.uint8)
+            best = mismatches.argmin(axis=1)
+            best_mismatches = mismatches[np.arange(len(inexact)), best]
+            close = best_mismatches <= max_mismatches
+            unique = (mismatches == best_mismatches[:, None]).sum(axis=1) == 1
+            slots[inexact[close & unique]] = best[close & unique]
+            corrected = int((close & unique).sum())
+            ambiguous = int((close & ~unique).sum())
+        if match_counter is not None:
+            match_counter['index_exact'] += int(exact.sum())
+            match_counter['index_corrected'] += corrected
+            match_counter['index_ambiguous'] += ambiguous
+            match_counter['index_not_found'] += len(fastq_batch) - int(exact.sum()) - corrected - ambiguous
+        return slots
+
+
+def demultiplex_counts(fastq_file, barcode_index, sample_sheet, start=0, end=None, index_mismatches=0,
+                       max_mismatches=0, extractor=None):
+    """Counts reads per barcode and slot in one pass over a lane fastq or a byte range of it. every batch of reads
+    is assigned to slots by header index, barcodes are extracted once for the whole batch and the reads of every
+    slot are counted against the index
+
+    Args:
+        fastq_file: plain or gzipped undemultiplexed fastq
+        barcode_index: BarcodeIndex to search
+        sample_sheet: SampleSheet of the lane
+        start: first byte of the range to count
+        end: byte after the range to count, None counts to the end of the file
+        index_mismatches: substitutions allowed between header and sample index
+        max_mismatches: substitutions allowed between read and barcode
+        extractor: optional barcode_extraction.BarcodeExtractor locating barcodes in reads
+
+    Returns:
+        tuple of (slots, barcodes) int64 count array, list of per slot match counters and a match counter of index
+        assignment and barcode extraction counts of the whole range
+    """
+    if extractor is None:
+        extractor = BarcodeExtractor(barcode_index.barcode_length)
+    slot_counts = np.zeros((len(sample_sheet), len(barcode_index)), dtype=np.int64)
+    slot_match_counters = [collections.Counter() for _ in range(len(sample_sheet))]
+    lane_match_counter = collections.Counter()
+    for fastq_batch in fastq_batches(fastq_file, start=start, end=end):
+        slots = sample_sheet.assign(fastq_batch, index_mismatches, lane_match_counter)
+        keys, valid = encode_barcodes(extractor.extract(fastq_batch, lane_match_counter))
+        lane_match_counter['reads'] += len(fastq_batch)
+        order = np.argsort(slots, kind='stable')
+        boundaries = np.searchsorted(slots[order], np.arange(len(sample_sheet) + 1))
+        for slot in range(len(sample_sheet)):
+            rows = order[boundaries[slot]:boundaries[slot + 1]]
+            slot_counts[slot] += barcode_index.count_keys(keys[rows], valid[rows], max_mismatches,
+                                                          slot_match_counters[slot])
+            slot_match_counters[slot]['reads'] += len(rows)
+    return slot_counts, slot_match_counters, lane_match_counter
+
+
+_worker_barcode_index = None
+
+
+def _init_demultiplex_worker(barcode_index):
+    global _worker_barcode_index
+    if not isinstance(barcode_index, BarcodeIndex):
+        barcode_index = BarcodeIndex.load(barcode_index)
+    _worker_barcode_index = barcode_index
+
+
+def _demultiplex_shard(shard):
+    fastq_file, sample_sheet, start, end, index_mismatches, max_mismatches, extractor = shard
+    return demultiplex_counts(fastq_file, _worker_barcode_index, sample_sheet, start, end, index_mismatches,
+                              max_mismatches, extractor)
+
+
+def _add_shard_result(shard_result, slot_counts, slot_match_counters, lane_match_counter):
+    """adds the counts and match counters of one demultiplex_counts result to the lane totals"""
+    shard_counts, shard_match_counters, shard_lane_match_counter = shard_result
+    slot_counts += shard_counts
+    for slot_match_counter, shard_match_counter in zip(slot_match_counters, shard_match_counters):
+        slot_match_counter.update(shard_match_counter)
+    lane_match_counter.update(shard_lane_match_counter)
+
+
+def demultiplex_lane(fastq_file, barcode_index_file, sample_sheet, workers=1, index_mismatches=0, max_mismatches=0,
+                     extractor=None):
+    """Counts every slot of an undemultiplexed lane fastq. with more than one worker, byte ranges of a plain fastq
+    are counted in a process pool that memory maps the barcode index
+
+    Returns:
+        tuple of BarcodeIndex, (slots, barcodes) count array, per slot match counters and the lane match counter
+    """
+    barcode_index = BarcodeIndex.load(barcode_index_file)
+    # workers memory map the index file themselves, unless the neighbor index is built here and has to be sent
+    index_file = barcode_index_file
+    if extractor is not None and extractor.barcode_length is None:
+        extractor.barcode_length = barcode_index.barcode_length
+    if max_mismatches and barcode_index.neighbor_keys is None:
+        print('Building barcode neighbor index')
+        barcode_index.build_neighbors()
+        index_file = None
+    slot_counts = np.zeros((len(sample_sheet), len(barcode_index)), dtype=np.int64)
+    slot_match_counters = [collections.Counter() for _ in range(len(sample_sheet))]
+    lane_match_counter = collections.Counter()
+    byte_ranges = fastq_byte_ranges(fastq_file, 4 * workers) if workers > 1 else [(0, None)]
+    if len(byte_ranges) > 1:
+        worker_index = index_file if index_file is not None else barcode_index
+        shards = [(fastq_file, sample_sheet, start, end, index_mismatches, max_mismatches, extractor)
+                  for start, end in byte_ranges]
+        with multiprocessing.Pool(workers, _init_demultiplex_worker, (worker_index,)) as pool:
+            # shard results are added as they arrive, so only the count arrays of the running shards are kept
+            for shard_result in pool.imap_unordered(_demultiplex_shard, shards):
+                _add_shard_result(shard_result, slot_counts, slot_match_counters, lane_match_counter)
+    else:
+        _add_shard_result(demultiplex_counts(fastq_file, barcode_index, sample_sheet, 0, None, index_mismatches,
+                                             max_mismatches, extractor),
+                          slot_counts, slot_match_counters, lane_match_counter)
+    return barcode_index, slot_counts, slot_match_counters, lane_match_counter
+
+
+def sample_count_matrices(sample_sheet, barcode_index, slot_counts):
+    """OrderedDict of sample name and barcode_counts.BarcodeCountMatrix of its timepoints"""
+    return collections.OrderedDict(
+        (sample, BarcodeCountMatrix.from_barcode_counts(barcode_index, slot_counts[slots]))
+        for sample, slots in sample_sheet.sample_slots().items())
+
+
+def print_demultiplex_summary(fastq_file, sample_sheet, slot_counts, slot_match_counters, lane_match_counter):
+    print('sample\ttimepoint\tindex\treads\tbarcode hits\tfraction of lane')
+    lane_reads = lane_match_counter['reads']
+    for (sample, timepoint, index), barcode_counts, slot_match_counter in zip(
+            sample_sheet.slots, slot_counts, slot_match_counters):
+        print('{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(
+            sample, timepoint, index, slot_match_counter['reads'], int(barcode_counts.sum()),
+            round(slot_match_counter['reads'] / lane_reads, 4) if lane_reads else 0))
+    print('{0}: {1} reads, {2} exact index, {3} corrected index, {4} ambiguous index, {5} without sample index'.format(
+        fastq_file, lane_reads, lane_match_counter['index_exact'], lane_match_counter['index_corrected'],
+        lane_match_counter['index_ambiguous'], lane_match_counter['index_not_found']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to count variants of every sample and timepoint of an
+    undemultiplexed lane fastq in one pass. reads are routed by the sample index at the end of their header and
+    one count table per sample, variant_counts_<sample>.col, and its barcode count matrix,
+    barcode_counts_<sample>.col, are written without writing per sample fastqs""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-f', '--fastq_file', required=True, help='lane fastq file, plain or gzipped')
+    required.add_argument('-b', '--barcode_index', required=True, help='barcode index file written by barcode_index.py')
+    required.add_argument('-s', '--sample_sheet', required=True,
+                          help='json dict of sample name and list of sample indexes in timepoint order')
+    parser.add_argument('-o', '--output_dir', default='.', help='directory of the count tables')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes counting byte ranges of an uncompressed lane fastq')
+    parser.add_argument('-i', '--index_mismatches', type=int, choices=[0, 1], default=0,
+                        help='assign reads whose header index is one substitution from a single sample index')
+    parser.add_argument('-m', '--max_mismatches', type=int, choices=[0, 1, 2], default=0,
+                        help='assign reads whose barcode is up to this many substitutions from a library barcode')
+    add_extraction_arguments(parser)
+    add_quality_arguments(parser)
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    lane_sample_sheet = SampleSheet.load(args.sample_sheet)
+    barcode_extractor = extractor_from_arguments(args, quality_filter=quality_filter_from_arguments(args))
+    with metrics.stage('demultiplex and count', profile=True) as counting:
+        lane_barcode_index, lane_slot_counts, lane_slot_match_counters, lane_counter = demultiplex_lane(
+            args.fastq_file, args.barcode_index, lane_sample_sheet, args.workers, args.index_mismatches,
+            args.max_mismatches, barcode_extractor)
+        counting['records'] = lane_counter['reads']
+    for name in ['reads', 'index_exact', 'index_corrected', 'index_ambiguous', 'index_not_found']:
+        run_metrics.count(name if name == 'reads' else 'reads_' + name, lane_counter[name])
+    print_demultiplex_summary(args.fastq_file, lane_sample_sheet, lane_slot_counts, lane_slot_match_counters,
+                              lane_counter)
+    if barcode_extractor.quality_filter is not None:
+        print_quality_summary([args.fastq_file], [lane_counter])
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for sample_name, sample_count_matrix in sample_count_matrices(
+            lane_sample_sheet, lane_barcode_index, lane_slot_counts).items():
+        sample_metadata = {
+            'sample': sample_name,
+            'fastq_files': [args.fastq_file],
+            'sample_indexes': list(lane_sample_sheet.sample_indexes[sample_name]),
+            'barcode_index': args.barcode_index,
+            'max_mismatches': args.max_mismatches,
+            'index_mismatches': args.index_mismatches,
+            'barcode_extraction': barcode_extractor.settings(),
+        }
+        sample_count_matrix.save(os.path.join(args.output_dir, 'barcode_counts_{0}.col'.format(sample_name)),
+                                 sample_metadata)
+        write_count_table(os.path.join(args.output_dir, 'variant_counts_{0}.col'.format(sample_name)),
+                          sample_count_matrix.variant_counter(lane_barcode_index), sample_metadata)
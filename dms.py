@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import os
+import runpy
+import subprocess
+import sys
+import time
+
+# subcommand, script module and description. scripts are only imported when their subcommand runs, so starting a
+# text only step never pays for the plotting stack
+COMMANDS = collections.OrderedDict([
+    ('synthetic', ('synthetic_data', 'generate a synthetic data set')),
+    ('map', ('bowtie_barcode_library_dict', 'map barcodes to variants from bowtie output and an index fastq')),
+    ('consensus', ('barcode_consensus', 'resolve a barcode variant counter to a barcode index')),
+    ('index', ('barcode_index', 'build a barcode index from a barcode pickle')),
+    ('library-stats', ('barcode_mapping', 'library coverage and barcodes per variant')),
+    ('sketch', ('barcode_sketch', 'estimate library coverage from mapping reads in fixed memory')),
+    ('count', ('variant_fitness', 'count variants in timepoint fastqs, fitness with the fitness subcommand')),
+    ('fitness', ('variant_fitness', 'count variants and fit fitness')),
+    ('preview', ('fitness_preview', 'fitness and its convergence on growing random samples of the reads')),
+    ('demultiplex', ('demultiplex', 'count every sample of an undemultiplexed lane fastq in one pass')),
+    ('reaggregate', ('barcode_counts', 'variant counts and fitness from a barcode count matrix with barcode filters')),
+    ('compare', ('compare_duplicates', 'compare replicate fitness tables')),
+    ('average', ('fitness_average', 'average fitness by position')),
+    ('matrix', ('variant_matrix', 'print the positions by amino acids fitness matrix')),
+    ('annotate', ('variant_annotation', 'fitness by region and amino acid class for any number of conditions')),
+    ('heatmap', ('fitness_heatmap', 'draw a fitness heatmap')),
+    ('helix', ('correlate_fitness_helix', 'box plot of fitness by helix region and amino acid group')),
+    ('oxidation', ('oxidation', 'violin plot of oxidation prone mutations, usage: FITNESS_CSV TREATED_CSV')),
+    ('scatter', ('quick_hist', 'untreated against treated fitness scatter, usage: FITNESS_CSV TREATED_CSV')),
+    ('render', ('render_batch', 'render the figures of a manifest')),
+    ('pipeline', ('pipeline', 'run an experiment spec with cached stages')),
+    ('benchmark', ('benchmark', 'time pipeline stages on synthetic data')),
+    ('metrics', ('run_metrics', 'print run metrics json files')),
+    ('cache', ('count_cache', 'list a count cache directory')),
+])
+# subcommands that never draw a figure, the ones whose startup time matters to workflow managers
+TEXT_COMMANDS = ['map', 'consensus', 'index', 'count', 'fitness', 'preview', 'demultiplex', 'reaggregate',
+                 'compare', 'average', 'matrix', 'annotate', 'pipeline', 'metrics', 'cache']
+# arguments a subcommand inserts before the user's arguments
+COMMAND_ARGUMENTS = {
+    'count': ['--counts_only'],
+}
+
+
+def run_command(command, arguments):
+    """Runs the script of a subcommand as __main__, with its own argument parser and help"""
+    module, description = COMMANDS[command]
+    sys.argv = [module + '.py'] + COMMAND_ARGUMENTS.get(command, []) + list(arguments)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def startup_times(commands, repeats=5):
+    """fastest wall time of a fresh python process running dms <command> --help, which imports the script and
+    builds its parser, for every command, plus a bare interpreter for reference
+
+    Returns:
+        OrderedDict of command and seconds
+    """
+    dms = os.path.abspath(__file__)
+    invocations = [('python', [sys.executable, '-c', 'pass'])] + \
+                  [(command, [sys.executable, dms, command, '--help']) for command in commands]
+    times = collections.OrderedDict()
+    for name, invocation in invocations:
+        runs = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(invocation, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+            runs.append(time.perf_counter() - start)
+        times[name] = min(runs)
+    return times
+
+
+def print_usage():
+    print('usage: dms <command> [arguments], dms <command> --help for the arguments of a command\n')
+    print('commands:')
+    for command, (module, description) in COMMANDS.items():
+        print('  {0:<15}{1}'.format(command, description))
+    print('  {0:<15}{1}'.format('startup', 'measure cold start time of subcommands'))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print_usage()
+    elif sys.argv[1] == 'startup':
+        parser = argparse.ArgumentParser(prog='dms startup', description="""measures the cold start time of
+        subcommands, a fresh interpreter running dms <command> --help""")
+        parser.add_argument('-c', '--commands', nargs='*', choices=list(COMMANDS), default=TEXT_COMMANDS,
+                            help='subcommands to time, default the ones that do not draw figures')
+        parser.add_argument('-r', '--repeats', type=int, default=5, help='runs per subcommand, the fastest is kept')
+        args = parser.parse_args(sys.argv[2:])
+        print('command\tstartup ms')
+        for command_name, seconds in startup_times(args.commands, args.repeats).items():
+            print('{0}\t{1}'.format(command_name, round(seconds * 1000)))
+    elif sys.argv[1] in COMMANDS:
+        run_command(sys.argv[1], sys.argv[2:])
+    else:
+        print_usage()
+        raise SystemExit('dms: unknown command {0}'.format(sys.argv[1]))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import os
+import time
+
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+NEWLINE = ord('\n')
+SYNC_SIZE = 64 * 1024
+MIN_SHARD_SIZE = 16 * 1024 * 1024
+
+
+def is_gzipped(fastq):
+    """Checks the first two bytes of a file for the gzip magic number"""
+    with open(fastq, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_fastq(fastq):
+    """Opens a plain or gzipped fastq file for binary reading. compression is detected from the file contents,
+    not the extension"""
+    if is_gzipped(fastq):
+        return gzip.open(fastq, 'rb')
+    return open(fastq, 'rb')
+
+
+class FastqBatch(object):
+    """A block of complete fastq records held as one byte buffer plus per-record start and end offsets for the
+    identifier, sequence and quality lines. ends are exclusive and do not include the newline. the identifier
+    slice starts after the @ symbol"""
+
+    def __init__(self, buffer, line_starts, line_ends, offset, end_offset=None):
+        self.buffer = buffer
+        self.id_starts = line_starts[0::4] + 1
+        self.id_ends = line_ends[0::4]
+        self.seq_starts = line_starts[1::4]
+        self.seq_ends = line_ends[1::4]
+        self.qual_starts = line_starts[3::4]
+        self.qual_ends = line_ends[3::4]
+        # byte offsets of this batch in the (decompressed) fastq stream. line ends exclude a \r before the newline,
+        # so readers of windows line endings pass the end offset after the last newline
+        self.offset = offset
+        self.end_offset = end_offset if end_offset is not None else \
+            offset + (int(line_ends[-1]) + 1 if len(line_ends) else 0)
+
+    def __len__(self):
+        return len(self.seq_starts)
+
+    @property
+    def seq_lengths(self):
+        return self.seq_ends - self.seq_starts
+
+    def fixed_width(self, starts, length):
+        """Gathers a window of length bytes at every start offset into a (records, length) uint8 array. windows
+        running past the end of the buffer are shifted back to fit and need to be masked by the caller"""
+        if len(self.buffer) < length:
+            positions = np.minimum(starts[:, None] + np.arange(length), len(self.buffer) - 1)
+            return self.buffer[positions]
+        windows = np.lib.stride_tricks.sliding_window_view(self.buffer, length)
+        return windows[np.minimum(starts, len(windows) - 1)]
+
+    def sequence_window(self, start, length):
+        """Fixed width slice seq[start:start + length] of every read as a numpy bytes array (dtype S<length>).
+        reads too short to contain the full window are returned as empty strings"""
+        window = self.fixed_width(self.seq_starts + start, length)
+        window[self.seq_lengths < start + length] = 0
+        return np.ascontiguousarray(window).view('S{0}'.format(length)).ravel()
+
+    def quality_window(self, start, length):
+        """Fixed width slice of every quality string as a (records, length) uint8 array of raw ascii values"""
+        return self.fixed_width(self.qual_starts + start, length)
+
+    def identifiers(self):
+        """Read identifiers without the @ symbol, cut off after the first space"""
+        data = self.buffer.tobytes()
+        return [data[start:end].split(None, 1)[0].decode()
+                for start, end in zip(self.id_starts.tolist(), self.id_ends.tolist())]
+
+    def headers(self):
+        """Full identifier lines without the @ symbol"""
+        data = self.buffer.tobytes()
+        return [data[start:end].decode() for start, end in zip(self.id_starts.tolist(), self.id_ends.tolist())]
+
+    def sequences(self):
+        data = self.buffer.tobytes()
+        return [data[start:end].decode() for start, end in zip(self.seq_starts.tolist(), self.seq_ends.tolist())]
+
+    def qualities(self):
+        data = self.buffer.tobytes()
+        return [data[start:end].decode() for start, end in zip(self.qual_starts.tolist(), self.qual_ends.tolist())]
+
+
+def _split_records(buffer, offset, end=None):
+    """Splits a uint8 buffer into a batch of complete records and the leftover bytes of a trailing partial record.
+    if end is given, records starting at or after that stream offset are dropped and the third return value is
+    True"""
+    newlines = np.flatnonzero(buffer == NEWLINE)
+    complete_lines = len(newlines) - len(newlines) % 4
+    done = False
+    if end is not None and complete_lines and offset + int(newlines[complete_lines - 1]) + 1 > end:
+        # records ending past the byte range keep only those that start inside it
+        record_starts = np.concatenate(([0], newlines[3:complete_lines - 4:4] + 1))
+        complete_lines = 4 * int(np.searchsorted(record_starts, end - offset))
+        done = True
+    if complete_lines == 0:
+        return None, buffer, done
+    line_ends = newlines[:complete_lines]
+    line_starts = np.empty_like(line_ends)
+    line_starts[0] = 0
+    line_starts[1:] = line_ends[:-1] + 1
+    if line_ends[0] and buffer[line_ends[0] - 1] == ord('\r'):
+        # tolerate windows line endings
+        line_ends = line_ends - (buffer[line_ends - 1] == ord('\r'))
+    assert buffer[0] == ord('@'), 'Fastq record does not start with @ at byte {0}'.format(offset)
+    records_end = int(newlines[complete_lines - 1]) + 1
+    batch = FastqBatch(buffer, line_starts, line_ends, offset, offset + records_end)
+    return batch, buffer[records_end:], done
+
+
+def _record_start(data):
+    """Index of the first fastq record starting after the first byte of data, or None if there is none. a record
+    start is a line beginning with @ followed two lines later by a line beginning with +, which cannot be matched
+    by a quality line that happens to begin with @"""
+    lines = data.split(b'\n')
+    position = len(lines[0]) + 1
+    for i in range(1, len(lines) - 3):
+        if lines[i].startswith(b'@') and lines[i + 2].startswith(b'+'):
+            return position
+        position += len(lines[i]) + 1
+    return None
+
+
+def fastq_byte_ranges(fastq, shard_count, min_shard_size=MIN_SHARD_SIZE):
+    """Splits a fastq file into up to shard_count byte ranges of at least min_shard_size bytes. ranges are not
+    record aligned themselves; fastq_batches assigns every record to the range containing its first byte. gzipped
+    files can only be seeked into by decompressing everything before the offset and are always returned as a
+    single range
+
+    Returns:
+        list of (start, end) tuples; end is None for the last range
+    """
+    if shard_count <= 1 or is_gzipped(fastq):
+        return [(0, None)]
+    size = os.path.getsize(fastq)
+    shard_count = max(1, min(shard_count, size // max(min_shard_size, 1)))
+    boundaries = [size * shard // shard_count for shard in range(shard_count)]
+    return list(zip(boundaries, boundaries[1:] + [None]))
+
+
+def sampled_byte_ranges(fastq, block_bytes, seed=0):
+    """Splits a plain fastq file into byte ranges of block_bytes in a random order, so that the records of the
+    first k ranges, read with fastq_batches, are a random sample of k blocks of the file that grows with k. gzipped
+    files can not be seeked into and are returned as a single range
+
+    Returns:
+        list of (start, end) tuples; end is None for the last range of the file
+    """
+    if is_gzipped(fastq):
+        return [(0, None)]
+    size = os.path.getsize(fastq)
+    boundaries = list(range(0, size, block_bytes)) or [0]
+    ranges = list(zip(boundaries, boundaries[1:] + [None]))
+    order = np.random.default_rng(seed).permutation(len(ranges))
+    return [ranges[i] for i in order.tolist()]
+
+
+def stream_size_estimate(fastq, sample_size=DEFAULT_BLOCK_SIZE):
+    """Bytes of the decompressed stream of a fastq file. for gzipped files the file size is scaled by the
+    compression ratio of the first sample_size decompressed bytes"""
+    size = os.path.getsize(fastq)
+    if not is_gzipped(fastq):
+        return size
+    with open(fastq, 'rb') as raw, gzip.GzipFile(fileobj=raw) as f:
+        decompressed = len(f.read(sample_size))
+        if decompressed < sample_size:
+            return decompressed
+        return int(size * decompressed / raw.tell())
+
+
+def fastq_batches(fastq, block_size=DEFAULT_BLOCK_SIZE, start=0, end=None):
+    """Reads a plain or gzipped fastq file in large blocks and yields FastqBatch objects of complete records
+
+    Args:
+        fastq: path to fastq file, optionally gzipped
+        block_size: number of bytes read per block. each batch holds roughly this many bytes of records
+        start: byte offset of the range to read. reading begins at the first record starting at or after it.
+            offsets of gzipped files are in the decompressed stream, which is decompressed up to the offset
+        end: records starting at or after this byte offset are not read. None reads to the end of the file
+
+    Yields:
+        FastqBatch for every block of complete records in file order
+
+    Raises:
+        AssertionError: file does not contain a whole number of 4 line fastq records
+        ValueError: no record start found within SYNC_SIZE bytes of the start offset
+    """
+    leftover = np.zeros(0, dtype=np.uint8)
+    done = False
+    with open_fastq(fastq) as f:
+        offset = 0
+        if start:
+            # start one byte early so a record starting exactly at start is found after its preceding newline
+            f.seek(start - 1)
+            data = f.read(SYNC_SIZE)
+            skip = _record_start(data)
+            if skip is None:
+                if len(data) < SYNC_SIZE:
+                    return
+                raise ValueError('Could not find a fastq record start after byte {0}'.format(start))
+            leftover = np.frombuffer(data[skip:], dtype=np.uint8)
+            offset = start - 1 + skip
+        while not done:
+            # every batch gets its own buffer so batches stay valid after the next block is read
+            buffer = np.empty(len(leftover) + block_size, dtype=np.uint8)
+            buffer[:len(leftover)] = leftover
+            read_size = f.readinto(memoryview(buffer)[len(leftover):])
+            if not read_size:
+                break
+            batch, leftover, done = _split_records(buffer[:len(leftover) + read_size], offset, end)
+            if batch is not None:
+                offset = batch.end_offset
+                yield batch
+    if len(leftover) and leftover.tobytes().strip() and not done:
+        # last record without trailing newline
+        buffer = np.frombuffer(leftover.tobytes().rstrip(b'\r\n') + b'\n', dtype=np.uint8)
+        batch, leftover, done = _split_records(buffer, offset, end)
+        assert done or not len(leftover), 'Truncated fastq record at byte {0}'.format(offset)
+        if batch is not None:
+            yield batch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to measure fastq parsing throughput of the bulk
+    fastq reader""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-f', '--fastq_files', nargs='*', required=True,
+                          help='plain or gzipped fastq files')
+    parser.add_argument('-s', '--block_size', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help='number of bytes read per block')
+    parser.add_argument('-r', '--byte_ranges', type=int, default=1,
+                        help='read plain files as this many byte ranges of any size and print the reads of every '
+                             'range, to check that ranges split files exactly')
+    args = parser.parse_args()
+
+    for fastq_file in args.fastq_files:
+        start = time.time()
+        read_count = 0
+        for range_start, range_end in fastq_byte_ranges(fastq_file, args.byte_ranges, min_shard_size=1):
+            range_read_count = 0
+            for fastq_batch in fastq_batches(fastq_file, args.block_size, range_start, range_end):
+                fastq_batch.sequence_window(0, 20)
+                range_read_count += len(fastq_batch)
+            if args.byte_ranges > 1:
+                print('{0}\tbytes {1}-{2}\t{3} reads'.format(fastq_file, range_start, range_end or '',
+                                                             range_read_count))
+            read_count += range_read_count
+        elapsed = time.time() - start
+        print('{0}\t{1} reads\t{2} reads/sec'.format(
+            fastq_file, read_count, round(read_count / elapsed if elapsed else 0)))
@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
-import numpy as np
-import pickle
 
-from fitness_heatmap import fitness_dict_from_text_file
+import run_metrics
+from variant_matrix import VariantMatrix, position_range_arguments
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="""script to average fitness values by position""")
@@ -13,37 +12,17 @@ if __name__ == '__main__':
 
     required = parser.add_argument_group('required')
     required.add_argument("-p", "--pickle_file", required=True,
-                          help="input pickle dictionary with keys as tuple of postion, amino acid and values "
-                               "as fitness floats")
-    wt_seq = 'MDVFMKGLSKAKEGVVAAAEKTKQGVAEAAGKTKEGVLYVGSKTKEGVVHGVATVAEKTKEQVTNVGGAVV' \
-             'TGVTAVAQKTVEGAGSIAAATGFVKKDQLGKNEEGAPQEGILEDMPVDPDNEAYEMPSEEGYQDYEPEA'
+                          help="input variant table, or legacy pickle / text dictionary with keys as tuple of "
+                               "postion, amino acid and values as fitness floats")
+    run_metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
-    if args.pickle_file.endswith('.pkl'):
-        with open(args.pickle_file, 'rb') as f:
-            variant_fitness_dict = pickle.load(f)
-    elif args.pickle_file.endswith('.txt'):
-        variant_fitness_dict = fitness_dict_from_text_file(args.pickle_file)
-    else:
-        raise IOError('Please give fitness dictionary as a pickle file')
+    metrics = run_metrics.start_run(args)
 
-    if args.position_range:
-        first_position, last_position = map(int, args.position_range.split('-'))
-    else:
-        first_position = 1
-        last_position = 140
-    position_range = range(first_position, last_position + 1)
-
-    # Using Robert's fitness dictionary, which does not normalize to wt fitness
-    wt_fitness = variant_fitness_dict[(0, 'WT')]
-    for position in position_range:
-        position_fitness_list = []
-        for amino_acid in 'AVILMFYWSTNQHKRDEGCP':
-            if (position, amino_acid) in variant_fitness_dict.keys():
-                fitness = variant_fitness_dict[(position, amino_acid)] - wt_fitness
-            elif amino_acid != wt_seq[position - 1]:
-                continue
-            else:
-                fitness = 0
-            position_fitness_list.append(fitness)
-        avg_fitness = np.average(position_fitness_list)
+    # Robert's fitness dictionary does not normalize to wt fitness, variant tables are already wt normalized
+    with metrics.stage('average fitness') as averaging:
+        variant_matrix = VariantMatrix.from_table(args.pickle_file).normalized()
+        variant_matrix = variant_matrix.sliced(*position_range_arguments(args.position_range))
+        position_means = variant_matrix.position_means()
+        averaging['records'] = len(variant_matrix.positions)
+    for position, avg_fitness in zip(variant_matrix.positions.tolist(), position_means.tolist()):
         print('{0}\t{1}'.format(position, avg_fitness))
@@ -1,9 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
-import itertools
-import pandas as pd
-import pickle
+
+from variant_matrix import VariantMatrix, WT_SEQ, position_range_arguments
 
 
 def heatmap_from_dataframe(dataframe, filename='heatmap.png'):
@@ -13,28 +12,11 @@ def heatmap_from_dataframe(dataframe, filename='heatmap.png'):
     figure.savefig(filename, dpi=300)
 
 
-def fitness_dict_from_text_file(fitness_text_file):
-    """parses text file of one tuple and one float per line into a dictionary
-
-    Args:
-        fitness_text_file: txt file with each line formatted as follows
-            (integer, 'Capital single character amino acid'),fitness_value
-
-    Returns:
-        A dict with keys of tuples (position, amino acid char) and values of variant fitness floats
-
-    Raises:
-
-    """
-    fitness_dict = {}
-    with open(fitness_text_file, 'r') as f:
-        for line in f:
-            position, amino_acid, fitness = line.rstrip().split(',')
-            position = int(position.split('(')[-1])
-            amino_acid = amino_acid.split("'")[1]
-            fitness = float(fitness)
-            fitness_dict[(position, amino_acid)] = fitness
-    return fitness_dict
+def fitness_dataframe(variant_fitness_dict, position_range=range(1, 141), wt_seq=WT_SEQ):
+    """positions by amino acids dataframe of fitness relative to wild type, 0 for the wild type amino acid and NaN
+    for variants without fitness"""
+    variant_matrix = VariantMatrix.from_dict(variant_fitness_dict, wt_seq).normalized()
+    return variant_matrix.sliced(position_range[0], position_range[-1]).to_dataframe()
 
 
 if __name__ == '__main__':
@@ -46,36 +28,11 @@ if __name__ == '__main__':
 
     required = parser.add_argument_group('required')
     required.add_argument("-p", "--pickle_file", required=True,
-                          help="input pickle dictionary with keys as tuple of postion, amino acid and values "
-                               "as fitness floats")
-    wt_seq = 'MDVFMKGLSKAKEGVVAAAEKTKQGVAEAAGKTKEGVLYVGSKTKEGVVHGVATVAEKTKEQVTNVGGAVV' \
-             'TGVTAVAQKTVEGAGSIAAATGFVKKDQLGKNEEGAPQEGILEDMPVDPDNEAYEMPSEEGYQDYEPEA'
+                          help="input variant table, or legacy pickle / text dictionary with keys as tuple of "
+                               "postion, amino acid and values as fitness floats")
     args = parser.parse_args()
-    if args.pickle_file.endswith('.pkl'):
-        with open(args.pickle_file, 'rb') as f:
-            variant_fitness_dict = pickle.load(f)
-    elif args.pickle_file.endswith('.txt'):
-        variant_fitness_dict = fitness_dict_from_text_file(args.pickle_file)
-    else:
-        raise IOError('Please give fitness dictionary as a pickle file')
-
-    if args.position_range:
-        first_position, last_position = map(int, args.position_range.split('-'))
-    else:
-        first_position = 1
-        last_position = 140
-    position_range = range(first_position, last_position + 1)
-    fitness_df = pd.DataFrame(0, index=position_range, columns=list('AVILMFYWSTNQHKRDECGP'))
-
-    # Using Robert's fitness dictionary, which does not normalize to wt fitness
-    wt_fitness = variant_fitness_dict[(0, 'WT')]
-    for position, amino_acid in itertools.product(position_range, list('AVILMFYWSTNQHKRDECGP')):
-        if (position, amino_acid) in variant_fitness_dict.keys():
-            fitness = variant_fitness_dict[(position, amino_acid)] - wt_fitness
-        elif amino_acid != wt_seq[position - 1]:
-            fitness = float('NaN')
-        else:
-            fitness = 0
-        fitness_df.loc[position, amino_acid] = fitness
 
-    heatmap_from_dataframe(fitness_df.T, args.name)
+    # Robert's fitness dictionary does not normalize to wt fitness, variant tables are already wt normalized
+    variant_matrix = VariantMatrix.from_table(args.pickle_file).normalized()
+    variant_matrix = variant_matrix.sliced(*position_range_arguments(args.position_range))
+    heatmap_from_dataframe(variant_matrix.to_dataframe().T, args.name or 'heatmap.png')
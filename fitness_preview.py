@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import math
+import multiprocessing
+import pickle
+import time
+
+import numpy as np
+
+import run_metrics
+import variant_fitness
+from barcode_counts import BarcodeCountMatrix
+from barcode_extraction import BarcodeExtractor, add_extraction_arguments, extractor_from_arguments
+from barcode_index import BarcodeIndex, is_barcode_index
+from fastq_reader import fastq_batches, is_gzipped, sampled_byte_ranges, stream_size_estimate
+from quality_filter import add_quality_arguments, quality_filter_from_arguments
+
+PREVIEW_FRACTIONS = [0.01, 0.02, 0.05, 0.1]
+# bytes per sampled block of plain fastqs. smaller blocks sample reads from more places of the flowcell at the cost
+# of one seek and record sync per block
+PREVIEW_BLOCK_BYTES = 1024 * 1024
+
+
+def preview_counts(fastq_file, barcode_index, fractions=PREVIEW_FRACTIONS, block_bytes=PREVIEW_BLOCK_BYTES, seed=0,
+                   max_mismatches=0, extractor=None):
+    """Counts barcodes in growing random samples of a fastq file without reading the rest of it. plain files are
+    cut into blocks of block_bytes in a seeded random order, and every fraction counts the blocks it adds to the
+    previous one, so all fractions together cost as much as the largest. gzipped files can not be seeked into and
+    are sampled by their leading records, up to each fraction of the estimated decompressed size
+
+    Args:
+        fastq_file: plain or gzipped fastq
+        barcode_index: BarcodeIndex to search
+        fractions: ascending fractions of the file to sample
+        block_bytes: bytes per sampled block of plain files
+        seed: seed of the block order
+        max_mismatches: substitutions allowed between read and barcode
+        extractor: optional barcode_extraction.BarcodeExtractor
+
+    Returns:
+        list with one tuple per fraction of sampled fraction, barcode counts array, match counter and seconds spent
+        counting up to it
+    """
+    if extractor is None:
+        extractor = BarcodeExtractor(barcode_index.barcode_length)
+    barcode_counts = np.zeros(len(barcode_index), dtype=np.int64)
+    match_counter = collections.Counter()
+    snapshots = []
+    start_time = time.perf_counter()
+    if is_gzipped(fastq_file):
+        stream_size = stream_size_estimate(fastq_file)
+        pending = list(fractions)
+        for fastq_batch in fastq_batches(fastq_file, block_size=block_bytes):
+            variant_fitness.count_fastq_batch(fastq_batch, barcode_index, barcode_counts, extractor, max_mismatches,
+                                              match_counter)
+            sampled = min(fastq_batch.end_offset / stream_size, 1.0)
+            # the whole file is only sampled at its end, whatever the estimate
+            while pending and pending[0] < 1 and sampled >= pending[0]:
+                snapshots.append((sampled, barcode_counts.copy(), collections.Counter(match_counter),
+                                  time.perf_counter() - start_time))
+                pending.pop(0)
+            if not pending:
+                break
+        # the whole file, and fractions of files shorter than their estimate, end with the stream
+        for _ in pending:
+            snapshots.append((1.0, barcode_counts.copy(), collections.Counter(match_counter),
+                              time.perf_counter() - start_time))
+        return snapshots
+    byte_ranges = sampled_byte_ranges(fastq_file, block_bytes, seed)
+    counted = 0
+    for fraction in fractions:
+        blocks = min(max(int(math.ceil(fraction * len(byte_ranges))), 1), len(byte_ranges))
+        for start, end in byte_ranges[counted:blocks]:
+            for fastq_batch in fastq_batches(fastq_file, block_bytes, start, end):
+                variant_fitness.count_fastq_batch(fastq_batch, barcode_index, barcode_counts, extractor,
+                                                  max_mismatches, match_counter)
+        counted = max(counted, blocks)
+        snapshots.append((counted / len(byte_ranges), barcode_counts.copy(), collections.Counter(match_counter),
+                          time.perf_counter() - start_time))
+    return snapshots
+
+
+def _preview_file(job):
+    fastq_file, fractions, block_bytes, seed, max_mismatches, extractor = job
+    return preview_counts(fastq_file, variant_fitness._worker_barcode_index, fractions, block_bytes, seed,
+                          max_mismatches, extractor)
+
+
+def preview_fitness(fastq_files, barcode_index, fractions=PREVIEW_FRACTIONS, timepoints=None, weights=None,
+                    block_bytes=PREVIEW_BLOCK_BYTES, seed=0, max_mismatches=0, extractor=None, workers=1):
+    """Fits fitness on growing random samples of the reads of every timepoint fastq, with the wild type normalized
+    regression of variant_fitness_statistics
+
+    Args:
+        fastq_files: fastq files in timepoint order
+        barcode_index: BarcodeIndex, or path of a barcode index file that workers memory map
+        workers: number of processes, each sampling whole fastq files
+        see preview_counts for the other arguments
+
+    Returns:
+        list with one dict per fraction of fraction (mean sampled fraction over the files), reads, counting seconds,
+        the variant_timepoint_counter, variants and fitness_statistics
+    """
+    fractions = sorted(fractions)
+    if not isinstance(barcode_index, BarcodeIndex):
+        index_file, barcode_index = barcode_index, BarcodeIndex.load(barcode_index)
+    else:
+        index_file = barcode_index
+    if extractor is not None and extractor.barcode_length is None:
+        extractor.barcode_length = barcode_index.barcode_length
+    if max_mismatches and barcode_index.neighbor_keys is None:
+        print('Building barcode neighbor index')
+        barcode_index.build_neighbors()
+        index_file = barcode_index
+    jobs = [(fastq_file, fractions, block_bytes, seed, max_mismatches, extractor) for fastq_file in fastq_files]
+    if workers > 1:
+        with multiprocessing.Pool(min(workers, len(jobs)), variant_fitness._init_counting_worker,
+                                  (index_file,)) as pool:
+            file_snapshots = pool.map(_preview_file, jobs)
+    else:
+        file_snapshots = [preview_counts(fastq_file, barcode_index, fractions, block_bytes, seed, max_mismatches,
+                                         extractor) for fastq_file in fastq_files]
+
+    steps = []
+    for step in range(len(fractions)):
+        snapshots = [file_snapshot[step] for file_snapshot in file_snapshots]
+        variant_timepoint_counter = BarcodeCountMatrix.from_barcode_counts(
+            barcode_index, [barcode_counts for sampled, barcode_counts, match_counter, seconds in snapshots]
+        ).variant_counter(barcode_index)
+        variants, fitness_statistics = variant_fitness.variant_fitness_statistics(variant_timepoint_counter,
+                                                                                 timepoints, weights)
+        steps.append({
+            'fraction': float(np.mean([sampled for sampled, barcode_counts, match_counter, seconds in snapshots])),
+            'reads': sum(match_counter['reads'] for sampled, barcode_counts, match_counter, seconds in snapshots),
+            'seconds': sum(seconds for sampled, barcode_counts, match_counter, seconds in snapshots),
+            'variant_timepoint_counter': variant_timepoint_counter,
+            'variants': variants,
+            'fitness_statistics': fitness_statistics,
+        })
+    return steps
+
+
+def convergence_report(steps, min_reads=10, pseudocount=0.5):
+    """Coverage and fitness change of every preview step. variants are covered with at least min_reads reads at
+    every timepoint, and fitness is compared with the previous step over the variants covered in both
+
+    Returns:
+        list of OrderedDicts, one per step: fraction, reads, covered variants, median reads per covered variant at
+        the first timepoint, median standard error of covered variants, correlation and median absolute difference
+        with the previous step, and counting seconds with the time projected for all reads
+    """
+    report = []
+    previous = None
+    for step in steps:
+        variants = step['variants']
+        counts = np.array([step['variant_timepoint_counter'][variant] for variant in variants]) - pseudocount
+        covered = (counts >= min_reads).all(axis=1) if len(variants) else np.zeros(0, dtype=bool)
+        fitness = dict(zip((variant for variant, is_covered in zip(variants, covered) if is_covered),
+                           step['fitness_statistics']['slope'][covered].tolist()))
+        std_err = np.median(step['fitness_statistics']['std_err'][covered]) if covered.any() else float('nan')
+        row = collections.OrderedDict([
+            ('fraction', round(step['fraction'], 4)),
+            ('reads', step['reads']),
+            ('covered_variants', int(covered.sum())),
+            ('median_first_reads', float(np.median(counts[covered, 0])) if covered.any() else 0.0),
+            ('median_std_err', round(float(std_err), 4)),
+            ('r_previous', float('nan')),
+            ('median_change', float('nan')),
+            ('seconds', round(step['seconds'], 2)),
+            ('projected_seconds', round(step['seconds'] / step['fraction'], 1) if step['fraction'] else float('nan')),
+        ])
+        if previous is not None:
+            shared = [variant for variant in fitness if variant in previous]
+            if len(shared) > 1:
+                current_fitness = np.array([fitness[variant] for variant in shared])
+                previous_fitness = np.array([previous[variant] for variant in shared])
+                row['r_previous'] = round(float(np.corrcoef(current_fitness, previous_fitness)[0, 1]), 4)
+                row['median_change'] = round(float(np.median(np.abs(current_fitness - previous_fitness))), 4)
+        report.append(row)
+        previous = fitness
+    return report
+
+
+def print_convergence_report(report):
+    if not report:
+        return
+    print('\t'.join(report[0].keys()))
+    for row in report:
+        print('\t'.join(str(value) for value in row.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to preview fitness of a run from growing random samples
+    of the reads of every timepoint fastq, and to report how coverage and fitness converge as the sample grows,
+    before counting all reads with variant_fitness.py""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-f', '--fastq_files', nargs='*', required=True,
+                          help='fastq files (plain or gzipped) in timepoint order')
+    required.add_argument('-b', '--barcode_pickle', required=True,
+                          help='barcode index file written by barcode_index.py, or pickle containing a dictionary '
+                               'with barcode as keys and library variants as values')
+    parser.add_argument('-p', '--fractions', nargs='*', type=float, default=PREVIEW_FRACTIONS,
+                        help='fractions of every fastq to sample, each sample extends the previous one')
+    parser.add_argument('--block_bytes', type=int, default=PREVIEW_BLOCK_BYTES,
+                        help='bytes per randomly sampled block of plain fastqs')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the sampled blocks')
+    parser.add_argument('-r', '--min_reads', type=int, default=10,
+                        help='reads a variant needs at every timepoint to be compared between fractions')
+    parser.add_argument('-n', '--name_suffix')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes sampling fastq files')
+    parser.add_argument('-m', '--max_mismatches', type=int, choices=[0, 1, 2], default=0,
+                        help='assign reads whose barcode is up to this many substitutions from a library barcode')
+    parser.add_argument('-t', '--timepoints', nargs='*', type=float,
+                        help='time of each fastq file, e.g. generations or hours. defaults to 0, 1, 2, ...')
+    parser.add_argument('--weights', nargs='*', type=float,
+                        help='weight of each timepoint in the fitness regression')
+    add_extraction_arguments(parser)
+    add_quality_arguments(parser)
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+    if args.timepoints and len(args.timepoints) != len(args.fastq_files):
+        raise IOError('one timepoint is required per fastq file')
+    if args.weights and len(args.weights) != len(args.fastq_files):
+        raise IOError('one weight is required per fastq file')
+    if not all(0 < fraction <= 1 for fraction in args.fractions):
+        raise IOError('fractions have to be above 0 and at most 1')
+    if is_barcode_index(args.barcode_pickle):
+        library_index = args.barcode_pickle
+    else:
+        with open(args.barcode_pickle, 'rb') as f:
+            library_index = BarcodeIndex.from_dict(pickle.load(f))
+
+    barcode_extractor = extractor_from_arguments(args, quality_filter=quality_filter_from_arguments(args))
+    with metrics.stage('preview fitness', profile=True):
+        preview_steps = preview_fitness(args.fastq_files, library_index, args.fractions, args.timepoints,
+                                        args.weights, args.block_bytes, args.seed, args.max_mismatches,
+                                        barcode_extractor, args.workers)
+    convergence = convergence_report(preview_steps, args.min_reads)
+    print_convergence_report(convergence)
+    run_metrics.record('preview_convergence', convergence)
+
+    last_step = preview_steps[-1]
+    output_file = 'variant_fitness_preview_{0}.col'.format(args.name_suffix) if args.name_suffix else \
+        'variant_fitness_preview.col'
+    variant_fitness.write_fitness_table(output_file, last_step['variant_timepoint_counter'], last_step['variants'],
+                                        last_step['fitness_statistics'], {
+                                            'sample': args.name_suffix,
+                                            'fastq_files': args.fastq_files,
+                                            'timepoints': args.timepoints or list(range(len(args.fastq_files))),
+                                            'weights': args.weights,
+                                            'preview_fraction': last_step['fraction'],
+                                            'preview_seed': args.seed,
+                                            'barcode_index': args.barcode_pickle,
+                                            'max_mismatches': args.max_mismatches,
+                                            'barcode_extraction': barcode_extractor.settings(),
+                                        })
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+
+import numpy as np
+
+RESAMPLING_METHODS = ['poisson', 'multinomial']
+# resamples fitted per array, bounds the (resamples, variants, timepoints) temporaries of fit_lines
+RESAMPLE_CHUNK_SIZE = 100
+
+
+def wt_log_ratios(count_matrix, wt_counts):
+    """Natural log of variant counts over wild type counts at every timepoint
+
+    Args:
+        count_matrix: (variants, timepoints) array of read counts, usually including a pseudocount
+        wt_counts: (timepoints,) array of wild type read counts
+
+    Returns:
+        (variants, timepoints) float array of log ratios
+    """
+    return np.log(np.asarray(count_matrix, dtype=float) / np.asarray(wt_counts, dtype=float))
+
+
+def fit_lines(y_matrix, timepoints, weights=None):
+    """Least squares line through every row of y_matrix against timepoints in one pass. matches
+    scipy.stats.linregress for unweighted fits
+
+    Args:
+        y_matrix: (variants, timepoints) array
+        timepoints: (timepoints,) array of x values, e.g. generations or hours
+        weights: optional (timepoints,) or (variants, timepoints) array of non negative weights
+
+    Returns:
+        dict of (variants,) arrays: slope, intercept, r_squared, std_err (standard error of the slope)
+    """
+    y_matrix = np.atleast_2d(np.asarray(y_matrix, dtype=float))
+    x = np.asarray(timepoints, dtype=float)
+    assert y_matrix.shape[1] == len(x), 'Number of timepoints does not match number of count columns'
+    assert len(x) >= 2, 'At least two timepoints are needed to fit fitness'
+    if weights is None:
+        weights = np.ones_like(y_matrix)
+    else:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), y_matrix.shape)
+    weights = weights / weights.sum(axis=1, keepdims=True)
+
+    x_mean = (weights * x).sum(axis=1, keepdims=True)
+    y_mean = (weights * y_matrix).sum(axis=1, keepdims=True)
+    x_centered = x - x_mean
+    y_centered = y_matrix - y_mean
+    ssxm = (weights * x_centered ** 2).sum(axis=1)
+    ssym = (weights * y_centered ** 2).sum(axis=1)
+    ssxym = (weights * x_centered * y_centered).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = ssxym / ssxm
+        r_value = np.where((ssxm == 0) | (ssym == 0), 0.0, ssxym / np.sqrt(ssxm * ssym))
+        r_value = np.clip(r_value, -1.0, 1.0)
+        intercept = y_mean[:, 0] - slope * x_mean[:, 0]
+        degrees_of_freedom = len(x) - 2
+        if degrees_of_freedom:
+            std_err = np.sqrt((1 - r_value ** 2) * ssym / ssxm / degrees_of_freedom)
+        else:
+            std_err = np.zeros_like(slope)
+    return {
+        'slope': slope,
+        'intercept': intercept,
+        'r_squared': r_value ** 2,
+        'std_err': std_err,
+    }
+
+
+def fitness_from_counts(count_matrix, wt_counts, timepoints, weights=None):
+    """uses method described in Doug Fowler's Enrich2 paper - fitness is the slope of the regression line of the
+    wild type normalized log ratio over time, computed for all variants at once
+
+    Returns:
+        dict of (variants,) arrays from fit_lines plus the (variants, timepoints) log_ratios
+    """
+    log_ratios = wt_log_ratios(count_matrix, wt_counts)
+    fit = fit_lines(log_ratios, timepoints, weights)
+    fit['log_ratios'] = log_ratios
+    return fit
+
+
+def resample_counts(count_matrix, wt_counts, resamples, method='poisson', pseudocount=0.5, rng=None):
+    """Draws resampled read counts of all variants and wild type at once
+
+    Args:
+        count_matrix: (variants, timepoints) array of read counts including the pseudocount
+        wt_counts: (timepoints,) array of wild type read counts including the pseudocount
+        resamples: number of resampled count sets
+        method: poisson draws every count from a poisson distribution around the observed count. multinomial
+            redistributes the reads of every timepoint over variants and wild type by their observed frequencies,
+            the nonparametric bootstrap of reads
+        pseudocount: removed before and added back after resampling
+        rng: numpy Generator
+
+    Returns:
+        tuple of (resamples, variants, timepoints) variant counts and (resamples, 1, timepoints) wild type counts
+    """
+    assert method in RESAMPLING_METHODS, 'Resampling method must be one of {0}'.format(RESAMPLING_METHODS)
+    rng = np.random.default_rng() if rng is None else rng
+    reads = np.maximum(np.vstack((count_matrix, wt_counts)) - pseudocount, 0)
+    if method == 'poisson':
+        counts = rng.poisson(reads, size=(resamples,) + reads.shape).astype(float)
+    else:
+        totals = reads.sum(axis=0)
+        counts = np.empty((resamples,) + reads.shape)
+        for timepoint, total in enumerate(totals.tolist()):
+            frequencies = reads[:, timepoint] / total if total else np.full(len(reads), 1 / len(reads))
+            counts[:, :, timepoint] = rng.multinomial(int(round(total)), frequencies, size=resamples)
+    counts += pseudocount
+    return counts[:, :-1], counts[:, -1:]
+
+
+def resampled_fitness(count_matrix, wt_counts, timepoints, weights=None, resamples=100, method='poisson',
+                      pseudocount=0.5, seed=None):
+    """fitness of every variant in every resample of the counts, fitted as one (resamples * variants) batch
+
+    Returns:
+        (resamples, variants) float array of slopes
+    """
+    variant_counts, resampled_wt_counts = resample_counts(count_matrix, wt_counts, resamples, method, pseudocount,
+                                                          np.random.default_rng(seed))
+    log_ratios = np.log(variant_counts / resampled_wt_counts)
+    if weights is not None and np.ndim(weights) > 1:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float), log_ratios.shape).reshape(-1, len(timepoints))
+        fit = fit_lines(log_ratios.reshape(-1, len(timepoints)), timepoints, weights)
+        return fit['slope'].reshape(resamples, len(count_matrix))
+    # with weights shared by all rows the slope is a fixed linear combination of the log ratios of a row
+    x = np.asarray(timepoints, dtype=float)
+    weights = np.ones_like(x) if weights is None else np.asarray(weights, dtype=float)
+    weights = weights / weights.sum()
+    x_centered = x - (weights * x).sum()
+    return log_ratios @ (weights * x_centered / (weights * x_centered ** 2).sum())
+
+
+def _resampled_fitness_chunk(arguments):
+    return resampled_fitness(*arguments)
+
+
+def fitness_uncertainty(count_matrix, wt_counts, timepoints, weights=None, resamples=1000, method='poisson',
+                        confidence=0.95, pseudocount=0.5, workers=1, seed=0, chunk_size=RESAMPLE_CHUNK_SIZE):
+    """Standard errors and percentile confidence intervals of fitness from resampled counts of variants and wild
+    type. resamples are fitted in chunks of chunk_size, optionally in a process pool. every chunk has its own seed
+    spawned from seed, so results do not depend on the number of workers
+
+    Args:
+        count_matrix: (variants, timepoints) array of read counts including the pseudocount
+        wt_counts: (timepoints,) array of wild type read counts including the pseudocount
+        timepoints: (timepoints,) array of x values
+        weights: optional weights of the least squares fit, see fit_lines
+        resamples: number of resampled count sets
+        method: poisson or multinomial, see resample_counts
+        confidence: coverage of the confidence interval
+        pseudocount: pseudocount included in the counts
+        workers: number of processes fitting chunks of resamples
+        seed: seed of the random draws
+
+    Returns:
+        dict of (variants,) arrays: fitness_se (standard deviation of the resampled fitness), ci_low and ci_high
+    """
+    count_matrix = np.asarray(count_matrix, dtype=float)
+    wt_counts = np.asarray(wt_counts, dtype=float)
+    chunk_sizes = [min(chunk_size, resamples - start) for start in range(0, resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunks = [(count_matrix, wt_counts, timepoints, weights, chunk_resamples, method, pseudocount, chunk_seed)
+              for chunk_resamples, chunk_seed in zip(chunk_sizes, seeds)]
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+            slopes = np.concatenate(pool.map(_resampled_fitness_chunk, chunks))
+    else:
+        slopes = np.concatenate([_resampled_fitness_chunk(chunk) for chunk in chunks])
+    ci_low, ci_high = np.percentile(slopes, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+    return {
+        'fitness_se': slopes.std(axis=0, ddof=1),
+        'ci_low': ci_low,
+        'ci_high': ci_high,
+    }
@@ -5,57 +5,31 @@ import pandas as pd
 import seaborn as sns
 import sys
 
-"""
-hydrophobic = {'A': 'ALA', 'P': 'PRO', 'V': 'VAL', 'L': 'LEU', 'I': 'ILE', 'M': 'MET',
-               'F': 'PHE', 'Y': 'TYR', 'W': 'TRP', 'S': 'SER', 'T': 'THR', 'C': 'CYS',
-               'K': 'LYS', 'R': 'ARG', 'H': 'HIS', 'D': 'ASP', 'E': 'GLU', 'N': 'ASN',
-               'Q': 'GLN', 'G': 'GLY'}
-               
-wt_seq = 'MDVFMKGLSKAKEGVVAAAEKTKQGVAEAAGKTKEGVLYVGSKTKEGVVHGVATVAEKTKEQVTNVGGAVV' \
-             'TGVTAVAQKTVEGAGSIAAATGFVKKDQLGKNEEGAPQEGILEDMPVDPDNEAYEMPSEEGYQDYEPEA'
-             
-"""
+from variant_annotation import load_annotated_fitness
+from variant_matrix import WT_SEQ
 
 
-if __name__ == '__main__':
-    wt_seq = 'MDVFMKGLSKAKEGVVAAAEKTKQGVAEAAGKTKEGVLYVGSKTKEGVVHGVATVAEKTKEQVTNVGGAVV' \
-             'TGVTAVAQKTVEGAGSIAAATGFVKKDQLGKNEEGAPQEGILEDMPVDPDNEAYEMPSEEGYQDYEPEA'
-
-    oxidation_prone = {'C': 'CYS', 'M': 'MET', 'F': 'PHE', 'Y': 'TYR', 'W': 'TRP'}
-
-    hydrophobic_non_aromatic = {'A': 'ALA', 'V': 'VAL', 'L': 'LEU', 'I': 'ILE'}
+def oxidation_groups(fitness_csv, wt_seq=WT_SEQ):
+    """fitness of mutations from hydrophobic non aromatic residues to hydrophobic non aromatic residues, and to
+    oxidation prone residues
 
-    sulfur = {'C': 'CYS', 'M': 'MET'}
+    Returns:
+        tuple of control and oxidation fitness lists
+    """
+    fitness_df = load_annotated_fitness(fitness_csv, wt_seq=wt_seq)
+    from_hydrophobic = fitness_df['wt_hydrophobic_non_aromatic']
+    control = fitness_df.loc[from_hydrophobic & fitness_df['variant_hydrophobic_non_aromatic'], 'fitness']
+    oxidation = fitness_df.loc[from_hydrophobic & fitness_df['variant_oxidation_prone'], 'fitness']
+    return control.tolist(), oxidation.tolist()
 
-    fitness_wt_csv = sys.argv[1]
-    fitness_mel_csv = sys.argv[2]
-
-    oxidation_wt_fit = []
-    control_wt_fit = []
-    oxidation_mel_fit = []
-    control_mel_fit = []
 
+def oxidation_violin(fitness_wt_csv, fitness_mel_csv, filename='test.png', wt_seq=WT_SEQ):
+    """violin plot of untreated and treated fitness of mutations from hydrophobic non aromatic residues to
+    oxidation prone residues, against mutations among hydrophobic non aromatic residues"""
     # df = pd.DataFrame(columns=['Mutation to C, M, F, Y, W', 'Mutation to A, V, I, L'])
 
-    for fitness_csv in [fitness_wt_csv, fitness_mel_csv]:
-        fitness_df = pd.read_csv(fitness_csv, header=0)
-        fitness_df.dropna(inplace=True)
-
-        for index, row in fitness_df.iterrows():
-            variant_aa = row['variant_aa']
-            wt_aa = wt_seq[int(row['variant_num']) - 1]
-            fitness = float(row['fitness'])
-
-            if wt_aa in hydrophobic_non_aromatic and variant_aa in oxidation_prone:
-                if fitness_csv == fitness_wt_csv:
-                    oxidation_wt_fit.append(fitness)
-                else:
-                    oxidation_mel_fit.append(fitness)
-            elif variant_aa in hydrophobic_non_aromatic and wt_aa in hydrophobic_non_aromatic:
-                if fitness_csv == fitness_wt_csv:
-                    control_wt_fit.append(fitness)
-                else:
-                    control_mel_fit.append(fitness)
+    control_wt_fit, oxidation_wt_fit = oxidation_groups(fitness_wt_csv, wt_seq)
+    control_mel_fit, oxidation_mel_fit = oxidation_groups(fitness_mel_csv, wt_seq)
     df = pd.DataFrame.from_dict({
         'Untreated NA': control_wt_fit,
         'Untreated Ox': oxidation_wt_fit,
@@ -68,4 +42,8 @@ if __name__ == '__main__':
                         palette="muted",
                         )
     figure = ax.get_figure()
-    figure.savefig('test.png', dpi=400)
+    figure.savefig(filename, dpi=400)
+
+
+if __name__ == '__main__':
+    oxidation_violin(sys.argv[1], sys.argv[2])
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import time
+import traceback
+
+import run_metrics
+from barcode_consensus import LIBRARY_BARCODE_LENGTH
+from count_cache import file_fingerprint
+
+STAGE_OUTPUTS = {
+    'mapping': ['barcode_index.bcidx', 'barcode_consensus.col'],
+    'count': ['counts.col', 'barcode_counts.col'],
+    'fitness': ['variant_fitness.col'],
+    'replicates': ['avg_duplicates.col'],
+    'heatmap': ['heatmap.png'],
+}
+# modules a stage runs. their source and the source of every repository module they import is part of the cache
+# key of the stage, so changed code re-runs the stages it affects
+STAGE_MODULES = {
+    'mapping': ['bowtie_barcode_library_dict'],
+    'count': ['variant_fitness'],
+    'fitness': ['variant_fitness'],
+    'replicates': ['compare_duplicates'],
+    'heatmap': ['fitness_heatmap'],
+}
+STAGE_RECORD = 'stage.json'
+STAGE_LOG = 'stage.log'
+
+
+def import_tree(modules):
+    """modules of this repository plus every repository module they import, directly or through other repository
+    modules, at module level or inside functions. found from the source, so the result does not depend on what
+    the running process happened to import before
+
+    Returns:
+        sorted list of module names
+    """
+    repository = os.path.dirname(os.path.abspath(__file__))
+    found = set()
+    pending = list(modules)
+    while pending:
+        module = pending.pop()
+        if module in found:
+            continue
+        found.add(module)
+        with open(os.path.join(repository, module + '.py'), 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level and node.module:
+                names = [node.module]
+            else:
+                continue
+            pending.extend(name for name in names if os.path.exists(os.path.join(repository, name + '.py')))
+    return sorted(found)
+
+
+def source_digest(modules):
+    """sha1 of the source files of modules of this repository and of all repository modules they import"""
+    digest = hashlib.sha1()
+    repository = os.path.dirname(os.path.abspath(__file__))
+    for module in import_tree(modules):
+        with open(os.path.join(repository, module + '.py'), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class Stage(object):
+    """One call of a pipeline function with declared inputs and outputs. inputs are files outside the pipeline or
+    outputs of upstream stages. the cache key of a stage is a hash of its parameters, the contents of its input
+    files, the keys of its upstream stages and the source of the modules it runs, so a stage re-runs exactly when
+    something it depends on changed
+
+    Args:
+        kind: one of STAGE_OUTPUTS, selects the _run_<kind> function
+        label: name of the stage in reports, e.g. count untreated rep1
+        params: json serializable parameters that change the outputs
+        files: dict of input name and path or list of paths of files outside the pipeline
+        upstream: dict of input name and (Stage, output name) tuple
+        options: parameters that do not change the outputs, e.g. worker counts, not part of the key
+    """
+
+    def __init__(self, kind, label, params=None, files=None, upstream=None, options=None):
+        assert kind in STAGE_OUTPUTS, 'Stage kind must be one of {0}'.format(list(STAGE_OUTPUTS))
+        self.kind = kind
+        self.label = label
+        self.params = params or {}
+        self.files = files or {}
+        self.upstream = upstream or {}
+        self.options = options or {}
+        self.key = None
+
+    def compute_key(self, fingerprint_dir):
+        """sets the cache key, after the keys of all upstream stages are set"""
+        fingerprints = {}
+        for name, paths in self.files.items():
+            if isinstance(paths, list):
+                fingerprints[name] = [file_fingerprint(path, fingerprint_dir) for path in paths]
+            else:
+                fingerprints[name] = file_fingerprint(paths, fingerprint_dir)
+        upstream_keys = {name: [stage.key, output] for name, (stage, output) in self.upstream.items()}
+        self.key = hashlib.sha1(json.dumps(
+            [self.kind, self.params, fingerprints, upstream_keys, source_digest(STAGE_MODULES[self.kind])],
+            sort_keys=True).encode()).hexdigest()[:20]
+        return self.key
+
+    def directory(self, work_dir):
+        return os.path.join(work_dir, 'stages', '{0}-{1}'.format(self.kind, self.key))
+
+    def outputs(self, work_dir):
+        return {output: os.path.join(self.directory(work_dir), output) for output in STAGE_OUTPUTS[self.kind]}
+
+    def inputs(self, work_dir):
+        """dict of input name and absolute path or list of paths"""
+        inputs = dict(self.files)
+        for name, (stage, output) in self.upstream.items():
+            inputs[name] = stage.outputs(work_dir)[output]
+        return inputs
+
+    def is_cached(self, work_dir):
+        return os.path.exists(os.path.join(self.directory(work_dir), STAGE_RECORD))
+
+
+def _quality_filter(params):
+    from quality_filter import QualityFilter
+    return QualityFilter(**params['quality']) if params.get('quality') else None
+
+
+def _run_mapping(params, options, inputs):
+    from bowtie_barcode_library_dict import bowtie_barcode_library_dict
+    bowtie_barcode_library_dict(inputs['bowtie_output'], inputs['index_fastq'], params['max_mismatch'],
+                                min_reads=params['min_reads'], min_purity=params['min_purity'],
+                                tmp_dir=options.get('tmp_dir'), quality_filter=_quality_filter(params),
+                                bowtie_options={'workers': options.get('workers', 1),
+                                                'mismatch_tag': params['mismatch_tag']},
+                                barcode_length=params['barcode_length'])
+
+
+def _run_count(params, options, inputs):
+    from barcode_extraction import BarcodeExtractor
+    from variant_fitness import variant_counter_from_fastqs, write_count_table
+    barcode_extractor = BarcodeExtractor(None, quality_filter=_quality_filter(params))
+    variant_timepoint_counter = variant_counter_from_fastqs(
+        inputs['fastq_files'], inputs['barcode_index'], workers=options.get('workers', 1),
+        max_mismatches=params['max_mismatches'], cache_dir=options.get('cache_dir'), extractor=barcode_extractor,
+        barcode_count_file='barcode_counts.col', metadata={
+            'barcode_index': inputs['barcode_index'],
+            'max_mismatches': params['max_mismatches'],
+            'barcode_extraction': barcode_extractor.settings(),
+        })
+    write_count_table('counts.col', variant_timepoint_counter, {
+        'fastq_files': inputs['fastq_files'],
+        'barcode_index': inputs['barcode_index'],
+        'max_mismatches': params['max_mismatches'],
+        'barcode_extraction': barcode_extractor.settings(),
+    })
+
+
+def _run_fitness(params, options, inputs):
+    from variant_fitness import load_count_table, print_poor_fits, variant_fitness_statistics, write_fitness_table
+    variant_timepoint_counter = load_count_table(inputs['counts'])
+    variants, fitness_statistics = variant_fitness_statistics(
+        variant_timepoint_counter, params['timepoints'], params['weights'], params['resamples'],
+        params['resample_method'], params['confidence'], options.get('workers', 1))
+    print_poor_fits(variants, fitness_statistics)
+    write_fitness_table('variant_fitness.col', variant_timepoint_counter, variants, fitness_statistics, {
+        'sample': params['sample'],
+        'timepoints': params['timepoints'] or list(range(len(variant_timepoint_counter[(0, 'WT')]))),
+        'weights': params['weights'],
+        'resamples': params['resamples'],
+        'counts': inputs['counts'],
+    })
+
+
+def _run_replicates(params, options, inputs):
+    from columnar import load_variant_dict
+    from compare_duplicates import write_replicate_table
+    fitness_tables = [inputs['fitness_table_{0}'.format(i)] for i in range(len(params['replicates']))]
+    fitness_dicts = [load_variant_dict(fitness_table) for fitness_table in fitness_tables]
+    std_err_dicts = None
+    if params['consensus'] == 'weighted':
+        std_err_dicts = [load_variant_dict(fitness_table, params['std_err_column']) for fitness_table in fitness_tables]
+    write_replicate_table(params['replicates'], fitness_dicts, params['max_percent_difference'], None,
+                          params['consensus'], std_err_dicts, params['min_replicates'])
+
+
+def _run_heatmap(params, options, inputs):
+    import matplotlib
+    matplotlib.use('Agg')
+    from fitness_heatmap import heatmap_from_dataframe
+    from variant_matrix import VariantMatrix, position_range_arguments
+    variant_matrix = VariantMatrix.from_table(inputs['fitness_table']).normalized()
+    variant_matrix = variant_matrix.sliced(*position_range_arguments(params['position_range']))
+    heatmap_from_dataframe(variant_matrix.to_dataframe().T, 'heatmap.png')
+
+
+def _stage_process(stage, work_dir, connection):
+    """Runs a stage in a fresh process inside a temporary directory, which is renamed to the stage directory once
+    every output is written, so an interrupted stage never looks finished"""
+    stage_dir = stage.directory(work_dir)
+    tmp_dir = '{0}.tmp{1}'.format(stage_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    os.chdir(tmp_dir)
+    start_wall = time.perf_counter()
+    try:
+        with open(STAGE_LOG, 'w') as log, contextlib.redirect_stdout(log):
+            globals()['_run_' + stage.kind](stage.params, stage.options, stage.inputs(work_dir))
+        missing_outputs = [output for output in STAGE_OUTPUTS[stage.kind] if not os.path.exists(output)]
+        if missing_outputs:
+            raise IOError('stage {0} did not write {1}'.format(stage.label, ', '.join(missing_outputs)))
+        wall_seconds = time.perf_counter() - start_wall
+        with open(STAGE_RECORD, 'w') as f:
+            json.dump({'kind': stage.kind, 'label': stage.label, 'key': stage.key, 'params': stage.params,
+                       'inputs': stage.inputs(work_dir), 'wall_seconds': wall_seconds,
+                       'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=2)
+        os.chdir(work_dir)
+        try:
+            os.rename(tmp_dir, stage_dir)
+        except OSError:
+            # a concurrent run of the same pipeline finished this stage first
+            shutil.rmtree(tmp_dir)
+        connection.send({'wall_seconds': wall_seconds})
+    except Exception:
+        connection.send({'error': traceback.format_exc(), 'log': os.path.join(tmp_dir, STAGE_LOG)})
+    connection.close()
+
+
+def _resolve_paths(paths, spec_dir):
+    if isinstance(paths, list):
+        return [os.path.join(spec_dir, path) for path in paths]
+    return os.path.join(spec_dir, paths)
+
+
+def build_stages(spec, spec_dir='.', work_dir='pipeline'):
+    """Models an experiment spec as pipeline stages: barcode mapping, then per replicate counting and fitness,
+    per sample replicate comparison and a heatmap of every sample
+
+    Args:
+        spec: experiment spec dictionary, see the script description
+        spec_dir: directory relative paths of the spec are resolved against
+        work_dir: pipeline directory, holds the shared count cache
+
+    Returns:
+        list of Stage in dependency order
+
+    Raises:
+        IOError: spec has neither a barcode index nor a mapping section, or a sample has no replicates
+    """
+    stages = []
+    if 'barcode_index' in spec:
+        barcode_index_input = {'files': {'barcode_index': _resolve_paths(spec['barcode_index'], spec_dir)}}
+    elif 'mapping' in spec:
+        mapping_spec = spec['mapping']
+        mapping = Stage('mapping', 'mapping', {
+            'max_mismatch': mapping_spec.get('max_mismatch', 0),
+            'min_reads': mapping_spec.get('min_reads', 1),
+            'min_purity': mapping_spec.get('min_purity', 0.9),
+            'quality': mapping_spec.get('quality'),
+            'mismatch_tag': mapping_spec.get('mismatch_tag', 'AS'),
+            'barcode_length': mapping_spec.get('barcode_length', LIBRARY_BARCODE_LENGTH),
+        }, files={
+            'bowtie_output': _resolve_paths(mapping_spec['bowtie_output'], spec_dir),
+            'index_fastq': _resolve_paths(mapping_spec['index_fastq'], spec_dir),
+        }, options={'tmp_dir': mapping_spec.get('tmp_dir'), 'workers': mapping_spec.get('workers', 1)})
+        stages.append(mapping)
+        barcode_index_input = {'upstream': {'barcode_index': (mapping, 'barcode_index.bcidx')}}
+    else:
+        raise IOError('pipeline spec needs a barcode_index or a mapping section')
+
+    counting_spec = spec.get('counting', {})
+    fitness_spec = spec.get('fitness', {})
+    resamples = fitness_spec.get('resamples', 0)
+    heatmap_spec = spec.get('heatmap', {})
+    for sample, sample_spec in sorted(spec.get('samples', {}).items()):
+        replicates = sample_spec.get('replicates', {})
+        if not replicates:
+            raise IOError('sample {0} has no replicates'.format(sample))
+        fitness_stages = []
+        for replicate, replicate_spec in sorted(replicates.items()):
+            count = Stage('count', 'count {0} {1}'.format(sample, replicate), {
+                'max_mismatches': counting_spec.get('max_mismatches', 0),
+                'quality': counting_spec.get('quality'),
+            }, files=dict(barcode_index_input.get('files', {}),
+                          fastq_files=_resolve_paths(replicate_spec['fastq_files'], spec_dir)),
+                upstream=barcode_index_input.get('upstream'), options={
+                'workers': counting_spec.get('workers', 1),
+                'cache_dir': os.path.join(os.path.abspath(work_dir), 'count_cache'),
+            })
+            fitness = Stage('fitness', 'fitness {0} {1}'.format(sample, replicate), {
+                'sample': '{0}_{1}'.format(sample, replicate),
+                'timepoints': replicate_spec.get('timepoints'),
+                'weights': replicate_spec.get('weights'),
+                'resamples': resamples,
+                'resample_method': fitness_spec.get('resample_method', 'poisson'),
+                'confidence': fitness_spec.get('confidence', 0.95),
+            }, upstream={'counts': (count, 'counts.col')}, options={'workers': fitness_spec.get('workers', 1)})
+            stages.extend([count, fitness])
+            fitness_stages.append(fitness)
+
+        if len(fitness_stages) > 1:
+            replicates_stage = Stage('replicates', 'replicates {0}'.format(sample), {
+                'replicates': sorted(replicates),
+                'max_percent_difference': sample_spec.get('max_percent_difference', 50),
+                'consensus': sample_spec.get('consensus', 'mean'),
+                'min_replicates': sample_spec.get('min_replicates'),
+                'std_err_column': 'fitness_se' if resamples else 'std_err',
+            }, upstream={'fitness_table_{0}'.format(i): (fitness, 'variant_fitness.col')
+                         for i, fitness in enumerate(fitness_stages)})
+            stages.append(replicates_stage)
+            sample_output = (replicates_stage, 'avg_duplicates.col')
+        else:
+            sample_output = (fitness_stages[0], 'variant_fitness.col')
+        if heatmap_spec is not None:
+            stages.append(Stage('heatmap', 'heatmap {0}'.format(sample), {
+                'position_range': heatmap_spec.get('position_range', '1-140'),
+            }, upstream={'fitness_table': sample_output}))
+    return stages
+
+
+def run_pipeline(stages, work_dir='pipeline', jobs=1, dry_run=False):
+    """Runs the stages whose outputs are not cached yet, up to jobs stages at once in separate processes, each as
+    soon as its upstream stages finished
+
+    Args:
+        stages: list of Stage in dependency order
+        work_dir: pipeline directory, stage outputs are kept in work_dir/stages/<kind>-<key>
+        jobs: stages run concurrently, e.g. the counting of independent replicates
+        dry_run: only report which stages are cached
+
+    Returns:
+        dict of stage label and dict of status (cached, ran, pending, failed or skipped), directory, outputs and
+        wall seconds
+
+    Raises:
+        RuntimeError: a stage failed. stages that do not depend on a failed stage still run, stages downstream of
+            it are skipped, and the error is raised once nothing is left to run
+    """
+    work_dir = os.path.abspath(work_dir)
+    fingerprint_dir = os.path.join(work_dir, 'fingerprints')
+    os.makedirs(os.path.join(work_dir, 'stages'), exist_ok=True)
+    results = {}
+    for stage in stages:
+        stage.compute_key(fingerprint_dir)
+        results[stage.label] = {'kind': stage.kind, 'status': 'cached' if stage.is_cached(work_dir) else 'pending',
+                                'directory': stage.directory(work_dir), 'outputs': stage.outputs(work_dir),
+                                'wall_seconds': None}
+    if dry_run:
+        return results
+
+    pending = [stage for stage in stages if results[stage.label]['status'] == 'pending']
+    running = {}
+    failures = []
+    while pending or running:
+        # pending is in dependency order, so one pass skips everything downstream of a failed stage
+        blocked = set(label for label, result in results.items() if result['status'] in ('failed', 'skipped'))
+        for stage in list(pending):
+            if any(upstream.label in blocked for upstream, output in stage.upstream.values()):
+                print('Skipping {0}, an upstream stage failed'.format(stage.label))
+                results[stage.label]['status'] = 'skipped'
+                blocked.add(stage.label)
+                pending.remove(stage)
+        finished = [label for label, result in results.items() if result['status'] in ('cached', 'ran')]
+        ready = [stage for stage in pending if all(upstream.label in finished
+                                                   for upstream, output in stage.upstream.values())]
+        while ready and len(running) < jobs:
+            stage = ready.pop(0)
+            if stage.key in [running_stage.key for running_stage, process, connection in running.values()]:
+                # same key as a running stage, e.g. a replicate listed twice, which will reuse its outputs
+                continue
+            pending.remove(stage)
+            parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_stage_process, args=(stage, work_dir, child_connection))
+            process.start()
+            child_connection.close()
+            print('Running {0}'.format(stage.label))
+            running[process.sentinel] = (stage, process, parent_connection)
+        if not running:
+            break
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            stage, process, parent_connection = running.pop(sentinel)
+            try:
+                stage_result = parent_connection.recv()
+            except EOFError:
+                stage_result = {'error': 'stage process exited with code {0}'.format(process.exitcode)}
+            process.join()
+            if 'error' in stage_result:
+                results[stage.label]['status'] = 'failed'
+                failures.append('{0}: {1}{2}'.format(stage.label, stage_result['error'].rstrip(), '\nlog: {0}'.format(
+                    stage_result['log']) if 'log' in stage_result else ''))
+                # stages of the same key would only fail again
+                for same_stage in [pending_stage for pending_stage in pending if pending_stage.key == stage.key]:
+                    results[same_stage.label]['status'] = 'failed'
+                    pending.remove(same_stage)
+            else:
+                results[stage.label]['status'] = 'ran'
+                results[stage.label]['wall_seconds'] = stage_result['wall_seconds']
+                run_metrics.count('stages_ran')
+                for same_stage in [pending_stage for pending_stage in pending if pending_stage.key == stage.key]:
+                    results[same_stage.label]['status'] = 'cached'
+                    pending.remove(same_stage)
+    run_metrics.count('stages_cached', sum(result['status'] == 'cached' for result in results.values()))
+    if failures:
+        raise RuntimeError('pipeline stages failed\n' + '\n'.join(failures))
+    return results
+
+
+def print_pipeline_results(results):
+    print('stage\tstatus\twall s\toutputs')
+    for label, result in results.items():
+        print('{0}\t{1}\t{2}\t{3}'.format(
+            label, result['status'], round(result['wall_seconds'], 3) if result['wall_seconds'] else '',
+            ' '.join(result['outputs'].values())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to run barcode mapping, counting, fitness, replicate
+    comparison and heatmaps of an experiment from one json spec. every stage output is cached under a hash of the
+    stage's inputs, parameters and code, so only stages whose inputs changed run again. spec keys: barcode_index
+    (path) or mapping (bowtie_output, index_fastq, max_mismatch, min_reads, min_purity, quality, mismatch_tag,
+    barcode_length, workers), counting (max_mismatches, workers, quality), where quality is a dict of
+    QualityFilter thresholds, fitness (resamples, resample_method, confidence, workers) for resampled fitness
+    uncertainties, heatmap (position_range, or null for no heatmaps) and samples, a dict of sample name and dict of
+    replicates (dict of replicate name and dict of fastq_files, timepoints, weights), max_percent_difference,
+    consensus and min_replicates. relative paths are relative to the spec file""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-s', '--spec', required=True, help='experiment spec json file')
+    parser.add_argument('-d', '--work_dir', default='pipeline',
+                        help='directory of cached stage outputs and the results json')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='stages run concurrently')
+    parser.add_argument('-n', '--dry_run', action='store_true', help='list stages and whether they are cached')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run_metrics.start_run(args)
+
+    with open(args.spec, 'r') as f:
+        experiment_spec = json.load(f)
+    pipeline_stages = build_stages(experiment_spec, os.path.dirname(os.path.abspath(args.spec)), args.work_dir)
+    pipeline_results = run_pipeline(pipeline_stages, args.work_dir, args.jobs, args.dry_run)
+    print_pipeline_results(pipeline_results)
+    if not args.dry_run:
+        with open(os.path.join(args.work_dir, 'results.json'), 'w') as f:
+            json.dump(pipeline_results, f, indent=2)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+
+import numpy as np
+
+import run_metrics
+from fastq_reader import fastq_batches
+
+# ascii value of phred quality 0 in sanger / illumina 1.8+ fastq files
+PHRED_OFFSET = 33
+
+
+class QualityFilter(object):
+    """Filters barcode calls by the phred qualities of their bases. qualities of whole batches of reads are decoded
+    with one lookup into a 256 entry table, so no per read python code runs. thresholds that are None are not
+    applied
+
+    Args:
+        min_base_quality: lowest phred quality allowed at any base
+        min_mean_quality: lowest mean phred quality of the bases
+        max_expected_errors: highest sum of the error probabilities 10 ^ (-Q / 10) of the bases
+        phred_offset: ascii value of quality 0
+    """
+
+    def __init__(self, min_base_quality=None, min_mean_quality=None, max_expected_errors=None,
+                 phred_offset=PHRED_OFFSET):
+        self.min_base_quality = min_base_quality
+        self.min_mean_quality = min_mean_quality
+        self.max_expected_errors = max_expected_errors
+        self.phred_offset = phred_offset
+        self.phred_scores = np.maximum(np.arange(256) - phred_offset, 0).astype(np.int16)
+        self.error_probabilities = 10 ** (-self.phred_scores / 10)
+
+    def settings(self):
+        """json serializable thresholds for cache keys and table metadata"""
+        return {'min_base_quality': self.min_base_quality, 'min_mean_quality': self.min_mean_quality,
+                'max_expected_errors': self.max_expected_errors, 'phred_offset': self.phred_offset}
+
+    def passing(self, qualities, lengths=None):
+        """Applies the thresholds to the quality strings of a batch of reads
+
+        Args:
+            qualities: (reads, length) uint8 array of raw ascii quality values
+            lengths: optional bases per read, positions past the length of a read are ignored. reads without bases
+                never pass
+
+        Returns:
+            boolean array, True for reads passing every threshold
+        """
+        scores = self.phred_scores[qualities]
+        if lengths is None:
+            lengths = np.full(len(scores), scores.shape[1])
+            inside = None
+        else:
+            lengths = np.minimum(lengths, scores.shape[1])
+            inside = np.arange(scores.shape[1]) < lengths[:, None]
+        passed = lengths > 0
+        if self.min_base_quality is not None:
+            lowest = scores.min(axis=1) if inside is None else np.where(inside, scores, 255).min(axis=1)
+            passed &= lowest >= self.min_base_quality
+        if self.min_mean_quality is not None:
+            totals = scores.sum(axis=1) if inside is None else np.where(inside, scores, 0).sum(axis=1)
+            passed &= totals >= self.min_mean_quality * lengths
+        if self.max_expected_errors is not None:
+            errors = self.error_probabilities[qualities]
+            expected_errors = errors.sum(axis=1) if inside is None else np.where(inside, errors, 0).sum(axis=1)
+            passed &= expected_errors <= self.max_expected_errors
+        return passed
+
+    def read_mask(self, fastq_batch, start=0, length=None):
+        """passing mask of the qualities of seq[start:start + length] of every read of a batch, or of whole reads
+        if length is None. reads shorter than a fixed window do not pass"""
+        if length is None:
+            lengths = np.maximum(fastq_batch.seq_lengths - start, 0)
+            return self.passing(fastq_batch.quality_window(start, max(int(lengths.max(initial=0)), 1)), lengths)
+        passed = self.passing(fastq_batch.quality_window(start, length))
+        passed &= fastq_batch.seq_lengths >= start + length
+        return passed
+
+
+def print_quality_summary(fastq_files, match_counters):
+    """prints reads and low quality barcode calls per file from the reads and barcode_low_quality counts of match
+    counters"""
+    print('fastq\treads\tlow quality\tfraction filtered')
+    for fastq_file, match_counter in zip(fastq_files, match_counters):
+        reads, low_quality = match_counter['reads'], match_counter['barcode_low_quality']
+        print('{0}\t{1}\t{2}\t{3}'.format(fastq_file, reads, low_quality,
+                                          round(low_quality / reads, 4) if reads else 0))
+
+
+def add_quality_arguments(parser):
+    """adds the barcode quality options of the mapping and counting scripts"""
+    parser.add_argument('--min_base_quality', type=int,
+                        help='drop barcode calls with a base below this phred quality')
+    parser.add_argument('--min_mean_quality', type=float,
+                        help='drop barcode calls whose mean phred quality is below this')
+    parser.add_argument('--max_expected_errors', type=float,
+                        help='drop barcode calls whose expected number of errors, the sum of the error '
+                             'probabilities of their bases, is above this')
+    parser.add_argument('--phred_offset', type=int, default=PHRED_OFFSET, help='ascii value of quality 0')
+
+
+def quality_filter_from_arguments(args):
+    """QualityFilter of the quality options, None if no threshold is set"""
+    if args.min_base_quality is None and args.min_mean_quality is None and args.max_expected_errors is None:
+        return None
+    return QualityFilter(args.min_base_quality, args.min_mean_quality, args.max_expected_errors, args.phred_offset)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to print the fraction of reads of fastq files whose
+    barcode fails quality thresholds, to choose thresholds before mapping or counting""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-f', '--fastq_files', nargs='*', required=True, help='plain or gzipped fastq files')
+    parser.add_argument('-s', '--start', type=int, default=0, help='first base of the barcode in reads')
+    parser.add_argument('-l', '--barcode_length', type=int,
+                        help='bases per barcode, by default the whole read from start on')
+    add_quality_arguments(parser)
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    quality_filter = quality_filter_from_arguments(args)
+    if quality_filter is None:
+        raise IOError('at least one of --min_base_quality, --min_mean_quality and --max_expected_errors is required')
+    file_match_counters = []
+    with metrics.stage('filter reads', profile=True) as filtering:
+        for fastq_file in args.fastq_files:
+            file_match_counter = collections.Counter()
+            for fastq_batch in fastq_batches(fastq_file):
+                passed = quality_filter.read_mask(fastq_batch, args.start, args.barcode_length)
+                file_match_counter['reads'] += len(fastq_batch)
+                file_match_counter['barcode_low_quality'] += int(len(passed) - passed.sum())
+            file_match_counters.append(file_match_counter)
+            run_metrics.count('reads', file_match_counter['reads'])
+            run_metrics.count('reads_low_quality', file_match_counter['barcode_low_quality'])
+        filtering['records'] = metrics.counters['reads']
+    print_quality_summary(args.fastq_files, file_match_counters)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from count_cache import file_fingerprint
+from pipeline import source_digest
+
+# modules whose source is part of the stamp of a figure, so changed plotting code renders its figures again
+PLOT_MODULES = {
+    'heatmap': ['fitness_heatmap', 'variant_matrix', 'columnar'],
+    'position_average': ['variant_matrix', 'columnar'],
+    'barcode_histogram': ['barcode_mapping', 'barcode_consensus', 'columnar'],
+    'oxidation': ['oxidation', 'variant_annotation', 'variant_matrix', 'columnar'],
+    'xy_scatter': ['quick_hist'],
+    'helix_groups': ['correlate_fitness_helix', 'variant_annotation', 'variant_matrix', 'columnar'],
+}
+STAMPS = 'render_stamps.json'
+
+
+def _init_render_worker():
+    """imports the plotting stack once per worker, the startup every script invocation used to pay"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401
+    import pandas  # noqa: F401
+    import seaborn  # noqa: F401
+
+
+def _render_heatmap(inputs, output, position_range=None, value_column='fitness'):
+    from fitness_heatmap import heatmap_from_dataframe
+    from variant_matrix import VariantMatrix, position_range_arguments
+    variant_matrix = VariantMatrix.from_table(inputs[0], value_column).normalized()
+    variant_matrix = variant_matrix.sliced(*position_range_arguments(position_range))
+    heatmap_from_dataframe(variant_matrix.to_dataframe().T, output)
+
+
+def _render_position_average(inputs, output, position_range=None, value_column='fitness'):
+    import matplotlib.pyplot as plt
+    from variant_matrix import VariantMatrix, position_range_arguments
+    for input_table in inputs:
+        variant_matrix = VariantMatrix.from_table(input_table, value_column).normalized()
+        variant_matrix = variant_matrix.sliced(*position_range_arguments(position_range))
+        plt.plot(variant_matrix.positions, variant_matrix.position_means(), label=os.path.basename(input_table))
+    plt.xlabel('Position')
+    plt.ylabel('Average {0}'.format(value_column))
+    plt.legend()
+    plt.savefig(output, dpi=300)
+
+
+def _render_barcode_histogram(inputs, output, xlabel='Number of Barcodes per Variant'):
+    from barcode_consensus import ConsensusStats
+    from barcode_mapping import counter_histogram
+    library_barcode_counter = ConsensusStats.load(inputs[0]).variant_barcode_counter()
+    counter_histogram(library_barcode_counter, sum(library_barcode_counter.values()), xlabel, output)
+
+
+def _render_oxidation(inputs, output):
+    from oxidation import oxidation_violin
+    oxidation_violin(inputs[0], inputs[1], output)
+
+
+def _render_xy_scatter(inputs, output):
+    from quick_hist import xy_scatter
+    xy_scatter(inputs[0], inputs[1], output)
+
+
+def _render_helix_groups(inputs, output):
+    from correlate_fitness_helix import helix_group_boxplot
+    helix_group_boxplot(inputs[0], output)
+
+
+def render_figure(figure):
+    """Renders one manifest entry and closes its figures, so a worker can render any number of figures
+
+    Returns:
+        tuple of output path, seconds and None, or the formatted exception if rendering failed
+    """
+    import matplotlib.pyplot as plt
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(figure['output']) or '.', exist_ok=True)
+        globals()['_render_' + figure['plot']](figure['inputs'], figure['output'], **figure.get('options', {}))
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        plt.close('all')
+    return figure['output'], time.perf_counter() - start, error
+
+
+def figure_stamp(figure, fingerprint_dir):
+    """hash of the plot type, options, input file contents and plotting code of a manifest entry"""
+    return hashlib.sha1(json.dumps([
+        figure['plot'], figure.get('options', {}),
+        [file_fingerprint(input_file, fingerprint_dir) for input_file in figure['inputs']],
+        source_digest(PLOT_MODULES[figure['plot']]),
+    ], sort_keys=True).encode()).hexdigest()
+
+
+def load_render_manifest(manifest_file):
+    """Reads a json list of figures, or a dict with a figures list. every figure has a plot type, a list of input
+    files, optional options and an output path. relative paths are relative to the manifest
+
+    Raises:
+        IOError: a figure has an unknown plot type
+    """
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    figures = manifest['figures'] if isinstance(manifest, dict) else manifest
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    for figure in figures:
+        if figure['plot'] not in PLOT_MODULES:
+            raise IOError('unknown plot type {0}, expected one of {1}'.format(figure['plot'], sorted(PLOT_MODULES)))
+        inputs = figure['inputs'] if isinstance(figure['inputs'], list) else [figure['inputs']]
+        figure['inputs'] = [os.path.join(manifest_dir, input_file) for input_file in inputs]
+        figure['output'] = os.path.join(manifest_dir, figure['output'])
+    return figures
+
+
+def render_batch(figures, cache_dir, workers=1, force=False):
+    """Renders every figure whose output is missing or whose stamp changed since it was last rendered, in a pool
+    of workers that import the plotting stack once
+
+    Args:
+        figures: list of figure dicts from load_render_manifest
+        cache_dir: directory of the stamps of rendered figures and the input fingerprints
+        workers: rendering processes
+        force: render every figure
+
+    Returns:
+        dict of output path and status: skipped, rendered or the error of a failed figure
+    """
+    fingerprint_dir = os.path.join(cache_dir, 'fingerprints')
+    stamps_file = os.path.join(cache_dir, STAMPS)
+    stamps = {}
+    if os.path.exists(stamps_file):
+        with open(stamps_file, 'r') as f:
+            stamps = json.load(f)
+    figure_stamps = {figure['output']: figure_stamp(figure, fingerprint_dir) for figure in figures}
+    pending = [figure for figure in figures if force or not os.path.exists(figure['output']) or
+               stamps.get(figure['output']) != figure_stamps[figure['output']]]
+    statuses = {figure['output']: 'skipped' for figure in figures}
+    print('Rendering {0} of {1} figures'.format(len(pending), len(figures)))
+
+    if workers > 1 and len(pending) > 1:
+        with multiprocessing.Pool(min(workers, len(pending)), _init_render_worker) as pool:
+            rendered = list(pool.imap_unordered(render_figure, pending))
+    elif pending:
+        _init_render_worker()
+        rendered = [render_figure(figure) for figure in pending]
+    else:
+        rendered = []
+
+    for output, seconds, error in rendered:
+        if error is None:
+            statuses[output] = 'rendered'
+            stamps[output] = figure_stamps[output]
+            print('{0}\t{1} s'.format(output, round(seconds, 3)))
+        else:
+            statuses[output] = error
+            stamps.pop(output, None)
+            print('{0} failed\n{1}'.format(output, error))
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(stamps_file + '.tmp', 'w') as f:
+        json.dump(stamps, f, indent=2)
+    os.replace(stamps_file + '.tmp', stamps_file)
+    return statuses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to render many figures in one process pool from a json
+    manifest of figures, each with a plot type ({0}), input files, options and an output path. figures whose
+    inputs, options and plotting code are unchanged since they were last rendered are skipped""".format(
+        ', '.join(sorted(PLOT_MODULES))))
+    required = parser.add_argument_group('required')
+    required.add_argument('-m', '--manifest', required=True, help='render manifest json file')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='rendering processes')
+    parser.add_argument('-c', '--cache_dir',
+                        help='directory of render stamps and input fingerprints, default .render_cache next to the '
+                             'manifest')
+    parser.add_argument('-f', '--force', action='store_true', help='render every figure')
+    args = parser.parse_args()
+
+    manifest_figures = load_render_manifest(args.manifest)
+    render_cache_dir = args.cache_dir or os.path.join(os.path.dirname(os.path.abspath(args.manifest)),
+                                                      '.render_cache')
+    render_statuses = render_batch(manifest_figures, render_cache_dir, args.workers, args.force)
+    failed_figures = [output for output, status in render_statuses.items() if status not in ('skipped', 'rendered')]
+    if failed_figures:
+        raise RuntimeError('{0} figures failed: {1}'.format(len(failed_figures), ', '.join(failed_figures)))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import argparse
+import atexit
+import collections
+import contextlib
+import json
+import os
+import platform
+import resource
+import signal
+import sys
+import time
+
+# run the module level stage, count and record functions report to, see start_run
+_active_run = None
+
+
+def peak_rss_bytes():
+    """peak resident set size of this process since the last reset_peak_rss. read from /proc on linux, otherwise
+    from getrusage, which never resets"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports ru_maxrss in kilobytes, macos in bytes
+    return max_rss if platform.system() == 'Darwin' else max_rss * 1024
+
+
+def reset_peak_rss():
+    """resets the kernel peak rss counter to the current rss where linux allows it, so the peak of a stage does
+    not include memory released before it started"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def cpu_seconds():
+    """user plus system time of this process and its finished child processes, e.g. counting pool workers"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+class SamplingProfiler(object):
+    """Statistical profiler of the main thread. a profiling interval timer interrupts the process every interval
+    seconds of cpu time and the current python stack is counted. stacks are written in the collapsed format
+    (frame;frame;frame count) that flamegraph tools read. unix only"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.label = None
+        self._previous_handler = None
+
+    @staticmethod
+    def available():
+        return hasattr(signal, 'setitimer') and hasattr(signal, 'SIGPROF')
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        if self.label:
+            stack.append(self.label)
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self, label=None):
+        self.label = label
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self.label = None
+
+    def write(self, stacks_file):
+        with open(stacks_file, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+class RunMetrics(object):
+    """Wall and cpu time, records per second and peak rss of every stage of a run, plus named funnel counters
+    (reads seen, reads with barcode hits, alignments dropped, ...) and other json serializable records"""
+
+    def __init__(self, script, arguments=None, profiler=None):
+        self.script = script
+        self.arguments = arguments or {}
+        self.profiler = profiler
+        self.stages = []
+        self.counters = collections.Counter()
+        self.records = collections.OrderedDict()
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+        self.status = 'running'
+        self._open_stage_peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name, records=None, profile=False):
+        """Times the enclosed block. the yielded dict can be updated with the number of records processed,
+        which gives records_per_second. with profile, the sampling profiler runs during the block"""
+        stage_record = collections.OrderedDict([('stage', name), ('records', records)])
+        if self._open_stage_peaks:
+            # resetting the kernel peak below would lose the peak of the enclosing stage so far
+            self._open_stage_peaks[-1] = max(self._open_stage_peaks[-1], peak_rss_bytes())
+        reset_peak_rss()
+        start_rss = peak_rss_bytes()
+        self._open_stage_peaks.append(start_rss)
+        start_wall = time.perf_counter()
+        start_cpu = cpu_seconds()
+        profiling = profile and self.profiler is not None and self.profiler.label is None
+        if profiling:
+            self.profiler.start(name)
+        try:
+            yield stage_record
+        finally:
+            if profiling:
+                self.profiler.stop()
+            wall_seconds = time.perf_counter() - start_wall
+            stage_record['wall_seconds'] = wall_seconds
+            stage_record['cpu_seconds'] = cpu_seconds() - start_cpu
+            stage_record['records_per_second'] = stage_record['records'] / wall_seconds \
+                if stage_record['records'] and wall_seconds else None
+            peak_rss = max(self._open_stage_peaks.pop(), peak_rss_bytes())
+            if self._open_stage_peaks:
+                self._open_stage_peaks[-1] = max(self._open_stage_peaks[-1], peak_rss)
+            stage_record['start_rss_mb'] = start_rss / 2 ** 20
+            stage_record['peak_rss_mb'] = peak_rss / 2 ** 20
+            self.stages.append(stage_record)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def record(self, name, value):
+        self.records[name] = value
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('script', self.script),
+            ('arguments', self.arguments),
+            ('status', self.status),
+            ('start_time', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start_time))),
+            ('wall_seconds', time.perf_counter() - self.start_wall),
+            ('cpu_seconds', cpu_seconds() - self.start_cpu),
+            # stages reset the kernel peak, so the run peak is the largest stage peak
+            ('peak_rss_mb', max([stage_record['peak_rss_mb'] for stage_record in self.stages] +
+                                [peak_rss_bytes() / 2 ** 20])),
+            ('python', platform.python_version()),
+            ('stages', self.stages),
+            ('counters', dict(self.counters)),
+            ('records', self.records),
+        ])
+
+    def write(self, metrics_file):
+        with open(metrics_file, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+
+
+@contextlib.contextmanager
+def stage(name, records=None, profile=False):
+    """RunMetrics.stage of the active run. without an active run the block is not timed, but the yielded dict can
+    still be updated, so library code can be instrumented unconditionally"""
+    if _active_run is None:
+        yield collections.OrderedDict([('stage', name), ('records', records)])
+    else:
+        with _active_run.stage(name, records, profile) as stage_record:
+            yield stage_record
+
+
+def count(name, value=1):
+    """adds value to a funnel counter of the active run, if there is one"""
+    if _active_run is not None:
+        _active_run.count(name, value)
+
+
+def record(name, value):
+    """stores a json serializable value in the active run, if there is one"""
+    if _active_run is not None:
+        _active_run.record(name, value)
+
+
+def add_metrics_arguments(parser):
+    """adds the --metrics and --profile options every entry point takes"""
+    parser.add_argument('--metrics', help='write per stage timing, memory and funnel counters of this run to this '
+                                          'json file')
+    parser.add_argument('--profile',
+                        help='sample the python stack of the hot loops and write collapsed stacks for flamegraph '
+                             'tools to this file')
+
+
+def start_run(args, script=None):
+    """Starts recording a run of an entry point from its parsed arguments. with --metrics or --profile, the
+    metrics and profile are written when the process exits, also if the run fails
+
+    Returns:
+        active RunMetrics
+    """
+    global _active_run
+    profiler = None
+    if getattr(args, 'profile', None):
+        if SamplingProfiler.available():
+            profiler = SamplingProfiler()
+        else:
+            print('Sampling profiler is not available on this platform')
+    run = _active_run = RunMetrics(script or os.path.basename(sys.argv[0]), vars(args), profiler)
+    previous_excepthook = sys.excepthook
+
+    def excepthook(exception_type, exception, exception_traceback):
+        run.status = 'failed'
+        run.record('error', repr(exception))
+        previous_excepthook(exception_type, exception, exception_traceback)
+
+    def finish():
+        if run.status == 'running':
+            run.status = 'finished'
+        if getattr(args, 'metrics', None):
+            run.write(args.metrics)
+        if run.profiler is not None:
+            run.profiler.write(args.profile)
+
+    sys.excepthook = excepthook
+    atexit.register(finish)
+    return run
+
+
+def print_metrics(metrics):
+    print('stage\trecords\twall s\tcpu s\trecords/s\tpeak rss MB')
+    for stage_record in metrics['stages']:
+        print('{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(
+            stage_record['stage'], stage_record['records'] if stage_record['records'] is not None else '',
+            round(stage_record['wall_seconds'], 3), round(stage_record['cpu_seconds'], 3),
+            round(stage_record['records_per_second']) if stage_record['records_per_second'] else '',
+            round(stage_record['peak_rss_mb'], 1)))
+    print()
+    print('counter\tvalue')
+    for name, value in sorted(metrics['counters'].items()):
+        print('{0}\t{1}'.format(name, value))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to print the stages and counters of run metrics json
+    files""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-m', '--metrics_files', nargs='*', required=True, help='metrics json files')
+    args = parser.parse_args()
+
+    for metrics_file in args.metrics_files:
+        with open(metrics_file, 'r') as f:
+            run_metrics = json.load(f)
+        print('{0}\t{1}\t{2} s'.format(metrics_file, run_metrics['script'], round(run_metrics['wall_seconds'], 3)))
+        print_metrics(run_metrics)
+        print()
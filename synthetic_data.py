@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import os
+
+import numpy as np
+
+from barcode_extraction import FLANK
+from barcode_index import BarcodeIndex, decode_barcodes
+from columnar import write_variant_dict
+from variant_matrix import AMINO_ACIDS, WT_SEQ
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+HIGH_QUALITY = ord('F')
+LOW_QUALITY = ord('#')
+CHUNK_SIZE = 1000000
+MANIFEST = 'synthetic.json'
+# lengths of the two mates of a variant read pair, as in the CIGAR strings of bowtie_lines
+MATE_LENGTHS = (300, 160)
+# distinct random sequence and quality strings per mate, written in turn
+MATE_POOL_SIZE = 256
+QUALITY_ALPHABET = np.frombuffer(b'FFFFFFFF:,#', dtype=np.uint8)
+PATH_FIELDS = ['truth_fitness', 'barcode_index', 'bowtie_output', 'index_fastq', 'fastq_files', 'replicate_fitness']
+
+
+def library_variants(wt_seq=WT_SEQ):
+    """wild type plus every single amino acid substitution and stop codon, the 140 x 20 variant space"""
+    return [(0, 'WT')] + [(position, amino_acid) for position, wt_amino_acid in enumerate(wt_seq, 1)
+                          for amino_acid in AMINO_ACIDS if amino_acid != wt_amino_acid]
+
+
+def variant_fitness_values(variants, rng):
+    """fitness per generation of every variant: 0 for wild type, about -0.5 for stop codons and a mostly neutral
+    spread with a deleterious tail for substitutions"""
+    fitness = np.where(rng.random(len(variants)) < 0.8, rng.normal(0, 0.05, len(variants)),
+                       -rng.exponential(0.3, len(variants)))
+    fitness[[amino_acid == '*' for position, amino_acid in variants]] = -0.5
+    fitness[[variant == (0, 'WT') for variant in variants]] = 0
+    return fitness
+
+
+def barcode_library(variant_count, barcodes_per_variant, barcode_length, rng):
+    """random unique barcodes, a poisson distributed number per variant with at least one
+
+    Returns:
+        tuple of uint64 barcode keys and int32 variant ids in random order
+    """
+    barcode_counts = np.maximum(rng.poisson(barcodes_per_variant, variant_count), 1)
+    variant_ids = np.repeat(np.arange(variant_count, dtype=np.int32), barcode_counts)
+    assert barcode_length < 32, 'Synthetic barcodes must be shorter than 32 bases'
+    keys = np.unique(rng.integers(0, 4 ** barcode_length, int(len(variant_ids) * 1.1) + 16, dtype=np.uint64))
+    assert len(keys) >= len(variant_ids), 'Barcode length too short for the requested barcode diversity'
+    keys = rng.permutation(keys)[:len(variant_ids)]
+    return keys, variant_ids
+
+
+def key_bases(keys, barcode_length):
+    """(keys, barcode_length) uint8 array of ascii bases of 2 bit barcode keys"""
+    shifts = np.arange(2 * (barcode_length - 1), -1, -2, dtype=np.uint64)
+    return BASES[(keys[:, None] >> shifts) & np.uint64(3)]
+
+
+def add_errors(sequences, error_rate, rng):
+    """substitutes every base with probability error_rate and returns a low quality mask of the errors"""
+    errors = rng.random(sequences.shape) < error_rate
+    if errors.any():
+        codes = np.searchsorted(BASES, sequences[errors])
+        sequences[errors] = BASES[(codes + rng.integers(1, 4, len(codes))) % 4]
+    return errors
+
+
+def fastq_records(read_numbers, sequences, qualities, sample_index):
+    """Renders fixed length records in one (reads, record length) uint8 array
+
+    Args:
+        read_numbers: int array of read numbers written into the identifiers
+        sequences: (reads, length) uint8 array of ascii bases
+        qualities: (reads, length) uint8 array of ascii qualities
+        sample_index: index sequence written after the read number, as in illumina headers
+    """
+    prefix = np.frombuffer(b'@SYN:1:', dtype=np.uint8)
+    suffix = np.frombuffer(' 1:N:0:{0}\n'.format(sample_index).encode(), dtype=np.uint8)
+    digits = ord('0') + (read_numbers[:, None] // 10 ** np.arange(11, -1, -1, dtype=np.int64)) % 10
+    read_length = sequences.shape[1]
+    header_length = len(prefix) + digits.shape[1] + len(suffix)
+    records = np.empty((len(read_numbers), header_length + 2 * read_length + 4), dtype=np.uint8)
+    column = 0
+    for part in (prefix, digits, suffix, sequences, b'\n+\n', qualities, b'\n'):
+        part = np.frombuffer(part, dtype=np.uint8) if isinstance(part, bytes) else part
+        width = part.shape[-1]
+        records[:, column:column + width] = part
+        column += width
+    return records
+
+
+def open_output(path):
+    return gzip.open(path, 'wb', compresslevel=1) if path.endswith('.gz') else open(path, 'wb')
+
+
+def write_timepoint_fastqs(output_prefix, keys, variant_ids, fitness, read_count, timepoints, barcode_length,
+                           error_rate, rng, sample_index='ACGTAC', gzipped=False):
+    """Writes one fastq per timepoint of barcode + FLANK reads. each barcode starts at a log normal abundance and
+    grows by exp(fitness * t); reads are drawn multinomially from the abundances, then sequencing errors are added
+
+    Returns:
+        list of written fastq paths
+    """
+    abundance = rng.lognormal(0, 0.5, len(keys))
+    flank = np.frombuffer(FLANK.encode(), dtype=np.uint8)
+    fastq_files = []
+    for timepoint_number, timepoint in enumerate(timepoints):
+        frequencies = abundance * np.exp(fitness[variant_ids] * timepoint)
+        frequencies /= frequencies.sum()
+        barcode_reads = rng.multinomial(read_count, frequencies)
+        barcode_rows = rng.permutation(np.repeat(np.arange(len(keys)), barcode_reads))
+        fastq_file = '{0}_t{1}.fastq{2}'.format(output_prefix, timepoint_number, '.gz' if gzipped else '')
+        with open_output(fastq_file) as f:
+            for start in range(0, read_count, CHUNK_SIZE):
+                rows = barcode_rows[start:start + CHUNK_SIZE]
+                sequences = np.concatenate((key_bases(keys[rows], barcode_length),
+                                            np.broadcast_to(flank, (len(rows), len(flank)))), axis=1)
+                errors = add_errors(sequences, error_rate, rng)
+                qualities = np.where(errors, LOW_QUALITY, HIGH_QUALITY).astype(np.uint8)
+                read_numbers = np.arange(start, start + len(rows), dtype=np.int64)
+                f.write(fastq_records(read_numbers, sequences, qualities, sample_index).tobytes())
+        fastq_files.append(fastq_file)
+    return fastq_files
+
+
+def mate_pool(rng, pool_size=MATE_POOL_SIZE):
+    """random (sequence, quality) strings of MATE_LENGTHS bases for each mate, pool_size per mate
+
+    Returns:
+        tuple of one list of (sequence, quality) tuples per mate
+    """
+    return tuple([(BASES[rng.integers(0, 4, length)].tobytes().decode(),
+                   QUALITY_ALPHABET[rng.integers(0, len(QUALITY_ALPHABET), length)].tobytes().decode())
+                  for _ in range(pool_size)] for length in MATE_LENGTHS)
+
+
+def bowtie_lines(header, variant, mismatches, mate_fields=(('*', '*'), ('*', '*'))):
+    """paired bowtie lines with the read header, twist fasta identifier and AS:i alignment score fields that
+    parse_bowtie_output reads. sequences and qualities are * unless mate_fields gives a (sequence, quality) tuple
+    per mate"""
+    position, amino_acid = variant
+    wt_amino_acid = WT_SEQ[position - 1] if position else 'WT'
+    tag = 'Q-00000:REGION01_GROUP{0:04d}:NNNNNNNNNN:{1}:{2}-->{3}'.format(position, position * 3, wt_amino_acid,
+                                                                        amino_acid)
+    mates = ((99, 1, 291, 450, '300M'), (147, 291, 1, -450, '160M'))
+    return ''.join(
+        '{0}\t{1}\t{2}\t{3}\t42\t{4}\t=\t{5}\t{6}\t{9}\t{10}\tAS:i:{7}\tXS:i:0\tXN:i:0\tXM:i:{8}\tXO:i:0\tXG:i:0\t'
+        'NM:i:{8}\tMD:Z:0\tYS:i:0\tYT:Z:CP\n'.format(header, flag, tag, start, cigar, mate_start, insert,
+                                                     -mate_mismatches, mate_mismatches, sequence, quality)
+        for (flag, start, mate_start, insert, cigar), mate_mismatches, (sequence, quality)
+        in zip(mates, mismatches, mate_fields))
+
+
+def write_mapping_reads(bowtie_file, index_fastq, keys, variant_ids, variants, read_count, barcode_length,
+                        error_rate, rng, unaligned_fraction=0.05, shuffle_index=False, mate_sequences=False):
+    """Writes an index fastq of barcode reads and the bowtie alignments of their paired variant reads. reads are
+    spread evenly over barcodes, a fraction of index reads has no alignment, and alignment mismatches are drawn
+    per 150 base mate at the error rate. with mate_sequences, alignments carry random sequence and quality
+    fields of MATE_LENGTHS bases like real bowtie output, so parsing them costs what real lines cost. they are
+    drawn from their own generator, so the other files do not change
+
+    Returns:
+        tuple of bowtie output path and index fastq path
+    """
+    barcode_rows = rng.integers(0, len(keys), read_count)
+    aligned = rng.random(read_count) >= unaligned_fraction
+    mismatches = rng.binomial(150, error_rate, (read_count, 2))
+    mates = mate_pool(np.random.default_rng(read_count)) if mate_sequences else ([('*', '*')], [('*', '*')])
+    with open(bowtie_file, 'w') as f:
+        for start in range(0, read_count, CHUNK_SIZE):
+            f.write(''.join(
+                bowtie_lines('SYN:1:{0:012d}'.format(read_number), variants[variant_id], read_mismatches,
+                             (mates[0][read_number % len(mates[0])], mates[1][read_number % len(mates[1])]))
+                for read_number, variant_id, read_mismatches in zip(
+                    range(start, start + CHUNK_SIZE),
+                    variant_ids[barcode_rows[start:start + CHUNK_SIZE]].tolist(),
+                    mismatches[start:start + CHUNK_SIZE].tolist())
+                if aligned[read_number]))
+
+    read_order = rng.permutation(read_count) if shuffle_index else np.arange(read_count)
+    with open_output(index_fastq) as f:
+        for start in range(0, read_count, CHUNK_SIZE):
+            read_numbers = read_order[start:start + CHUNK_SIZE].astype(np.int64)
+            sequences = key_bases(keys[barcode_rows[read_numbers]], barcode_length)
+            errors = add_errors(sequences, error_rate, rng)
+            qualities = np.where(errors, LOW_QUALITY, HIGH_QUALITY).astype(np.uint8)
+            f.write(fastq_records(read_numbers, sequences, qualities, 'ACGTAC').tobytes())
+    return bowtie_file, index_fastq
+
+
+def generate(output_dir, reads=1000000, mapping_reads=1000000, timepoints=(0, 2, 4), barcodes_per_variant=20,
+             barcode_length=20, error_rate=0.001, replicates=3, seed=0, shuffle_index=False, gzipped=False,
+             mate_sequences=False):
+    """Writes a deterministic synthetic data set for every pipeline stage into output_dir along with a json
+    manifest of paths and parameters
+
+    Args:
+        output_dir: directory to write into, created if missing
+        reads: reads per timepoint fastq
+        mapping_reads: read pairs of the barcode mapping run (index fastq and bowtie output)
+        timepoints: generations of the timepoint fastqs
+        barcodes_per_variant: mean number of barcodes per variant, sets barcode diversity
+        barcode_length: bases per barcode, below 32
+        error_rate: per base substitution rate of all reads
+        replicates: number of replicate fitness tables for replicate comparison
+        seed: random seed, the same arguments and seed always give the same files
+        shuffle_index: write index reads in a different order than the alignments
+        gzipped: gzip the fastq files
+        mate_sequences: write sequence and quality fields of both mates into the bowtie output instead of *
+
+    Returns:
+        manifest dictionary, see load_manifest
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    variants = library_variants()
+    fitness = variant_fitness_values(variants, rng)
+    keys, variant_ids = barcode_library(len(variants), barcodes_per_variant, barcode_length, rng)
+
+    truth_file = os.path.join(output_dir, 'truth_fitness.col')
+    write_variant_dict(truth_file, dict(zip(variants, fitness.tolist())), metadata={'seed': seed})
+    barcode_index_file = os.path.join(output_dir, 'library.bcidx')
+    BarcodeIndex.from_dict(dict(zip(decode_barcodes(keys, barcode_length),
+                                    (variants[variant_id] for variant_id in variant_ids.tolist()))),
+                           barcode_length).save(barcode_index_file)
+
+    bowtie_file, index_fastq = write_mapping_reads(
+        os.path.join(output_dir, 'mapping.bowtie'),
+        os.path.join(output_dir, 'mapping_index.fastq' + ('.gz' if gzipped else '')),
+        keys, variant_ids, variants, mapping_reads, barcode_length, error_rate, rng, shuffle_index=shuffle_index,
+        mate_sequences=mate_sequences)
+    fastq_files = write_timepoint_fastqs(os.path.join(output_dir, 'selection'), keys, variant_ids, fitness, reads,
+                                         timepoints, barcode_length, error_rate, rng, gzipped=gzipped)
+
+    replicate_files = []
+    for replicate in range(replicates):
+        replicate_file = os.path.join(output_dir, 'replicate{0}_fitness.col'.format(replicate))
+        noisy_fitness = fitness + rng.normal(0, 0.02, len(fitness))
+        write_variant_dict(replicate_file, dict(zip(variants, noisy_fitness.tolist())), metadata={'seed': seed})
+        replicate_files.append(replicate_file)
+
+    manifest = {
+        'parameters': {
+            'reads': reads,
+            'mapping_reads': mapping_reads,
+            'timepoints': list(timepoints),
+            'barcodes_per_variant': barcodes_per_variant,
+            'barcode_length': barcode_length,
+            'error_rate': error_rate,
+            'replicates': replicates,
+            'seed': seed,
+            'shuffle_index': shuffle_index,
+            'gzipped': gzipped,
+            'mate_sequences': mate_sequences,
+        },
+        'barcodes': len(keys),
+        'truth_fitness': truth_file,
+        'barcode_index': barcode_index_file,
+        'bowtie_output': bowtie_file,
+        'index_fastq': index_fastq,
+        'fastq_files': fastq_files,
+        'replicate_fitness': replicate_files,
+    }
+    for name in PATH_FIELDS:
+        manifest[name] = relative_paths(manifest[name], output_dir)
+    with open(os.path.join(output_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return load_manifest(output_dir)
+
+
+def relative_paths(paths, output_dir):
+    if isinstance(paths, list):
+        return [os.path.relpath(path, output_dir) for path in paths]
+    return os.path.relpath(paths, output_dir)
+
+
+def load_manifest(data_dir):
+    """Reads the manifest of a synthetic data set, with file paths made absolute
+
+    Raises:
+        IOError: data_dir has no manifest
+    """
+    data_dir = os.path.abspath(data_dir)
+    manifest_file = os.path.join(data_dir, MANIFEST)
+    if not os.path.exists(manifest_file):
+        raise IOError('{0} is not a synthetic data set, {1} is missing'.format(data_dir, MANIFEST))
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    for name in PATH_FIELDS:
+        if isinstance(manifest[name], list):
+            manifest[name] = [os.path.join(data_dir, path) for path in manifest[name]]
+        else:
+            manifest[name] = os.path.join(data_dir, manifest[name])
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to generate a deterministic synthetic data set (bowtie
+    output, index fastq, barcode library, timepoint fastqs, replicate fitness tables) over the alpha synuclein
+    variant space""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-o', '--output_dir', required=True, help='directory to write the data set into')
+    parser.add_argument('-r', '--reads', type=int, default=1000000, help='reads per timepoint fastq')
+    parser.add_argument('-m', '--mapping_reads', type=int, default=1000000,
+                        help='read pairs in the bowtie output and index fastq')
+    parser.add_argument('-t', '--timepoints', nargs='*', type=float, default=[0, 2, 4],
+                        help='generations of the timepoint fastqs')
+    parser.add_argument('-b', '--barcodes_per_variant', type=float, default=20,
+                        help='mean number of barcodes per variant')
+    parser.add_argument('-l', '--barcode_length', type=int, default=20, help='bases per barcode')
+    parser.add_argument('-e', '--error_rate', type=float, default=0.001, help='per base substitution rate')
+    parser.add_argument('--replicates', type=int, default=3, help='number of replicate fitness tables')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--shuffle_index', action='store_true',
+                        help='write index reads in a different order than the alignments')
+    parser.add_argument('--gzip', action='store_true', help='gzip the fastq files')
+    parser.add_argument('--mate_sequences', action='store_true',
+                        help='write {0} and {1} base sequence and quality fields into the bowtie output instead of '
+                             '*, to benchmark parsing on lines as long as real ones'.format(*MATE_LENGTHS))
+    args = parser.parse_args()
+
+    synthetic_manifest = generate(args.output_dir, args.reads, args.mapping_reads, args.timepoints,
+                                  args.barcodes_per_variant, args.barcode_length, args.error_rate, args.replicates,
+                                  args.seed, args.shuffle_index, args.gzip, args.mate_sequences)
+    print(json.dumps(synthetic_manifest, indent=2))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+
+import numpy as np
+
+import run_metrics
+from columnar import is_table, load_variant_dict, read_table
+from variant_matrix import AMINO_ACID_COLUMNS, AMINO_ACIDS, WT_SEQ
+
+# amino acid classes as one letter codes
+OXIDATION_PRONE = 'CMFYW'
+HYDROPHOBIC = 'AVILMFYW'
+HYDROPHOBIC_NON_AROMATIC = 'AVIL'
+AROMATIC = 'FYW'
+SULFUR = 'CM'
+HELIX_BREAKERS = 'GP'
+ACIDIC = 'DE'
+BASIC = 'KR'
+AMINO_ACID_CLASSES = collections.OrderedDict([
+    ('oxidation_prone', OXIDATION_PRONE),
+    ('hydrophobic', HYDROPHOBIC),
+    ('hydrophobic_non_aromatic', HYDROPHOBIC_NON_AROMATIC),
+    ('aromatic', AROMATIC),
+    ('sulfur', SULFUR),
+    ('helix_breaker', HELIX_BREAKERS),
+    ('acidic', ACIDIC),
+    ('basic', BASIC),
+])
+# charge at neutral pH
+CHARGES = {'K': 1, 'R': 1, 'D': -1, 'E': -1}
+
+# last position of the N terminal helix and of the KTKEGV repeats
+N_TERMINAL_HELIX_END = 32
+REPEAT_END = 63
+REGIONS = ['N-terminal helix', 'KTKEGV repeats', 'C-terminus']
+
+# class membership and charge of every ascii byte, so amino acid columns are annotated with one lookup per class
+CLASS_MEMBERSHIP = np.zeros((len(AMINO_ACID_CLASSES), 256), dtype=bool)
+for class_row, class_amino_acids in enumerate(AMINO_ACID_CLASSES.values()):
+    CLASS_MEMBERSHIP[class_row, np.frombuffer(class_amino_acids.encode(), dtype=np.uint8)] = True
+CHARGE = np.zeros(256, dtype=np.int8)
+for charged_amino_acid, charge in CHARGES.items():
+    CHARGE[ord(charged_amino_acid)] = charge
+
+
+def position_regions(sequence_length, n_terminal_helix_end=N_TERMINAL_HELIX_END, repeat_end=REPEAT_END):
+    """region of every position from 0 to sequence_length as an index into REGIONS, -1 for position 0, the wild
+    type row of variant tables"""
+    regions = np.full(sequence_length + 1, len(REGIONS) - 1, dtype=np.int8)
+    regions[:repeat_end + 1] = 1
+    regions[:n_terminal_helix_end + 1] = 0
+    regions[0] = -1
+    return regions
+
+
+def annotation_columns(positions, amino_acids, wt_seq=WT_SEQ):
+    """Annotates variants given as position and amino acid columns with lookups into arrays over positions and
+    ascii bytes, without a python loop over variants
+
+    Args:
+        positions: 1 based positions, 0 for the wild type row
+        amino_acids: one letter amino acid codes, as strings or bytes. longer codes such as WT get no class
+
+    Returns:
+        OrderedDict of column name and numpy array: wt_amino_acid (index into AMINO_ACIDS) and region (index into
+        REGIONS), both -1 for the wild type row and positions outside wt_seq, wt_<class> and variant_<class>
+        booleans for every class of AMINO_ACID_CLASSES, wt_charge, variant_charge and charge_change
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    amino_acids = np.asarray(amino_acids, dtype='S')
+    letters = amino_acids.view(np.uint8).reshape(len(amino_acids), -1)
+    variant_letters = letters[:, 0].copy() if letters.shape[1] else np.zeros(len(letters), dtype=np.uint8)
+    if letters.shape[1] > 1:
+        variant_letters[letters[:, 1:].any(axis=1)] = 0
+    inside = (positions >= 1) & (positions <= len(wt_seq))
+    wt_letters = np.frombuffer(b'\0' + wt_seq.encode(), dtype=np.uint8)[np.where(inside, positions, 0)]
+
+    columns = collections.OrderedDict()
+    columns['wt_amino_acid'] = AMINO_ACID_COLUMNS[wt_letters]
+    columns['region'] = np.where(inside, position_regions(len(wt_seq))[np.where(inside, positions, 0)], -1)
+    for class_row, class_name in enumerate(AMINO_ACID_CLASSES):
+        columns['wt_' + class_name] = CLASS_MEMBERSHIP[class_row, wt_letters]
+        columns['variant_' + class_name] = CLASS_MEMBERSHIP[class_row, variant_letters]
+    columns['wt_charge'] = CHARGE[wt_letters]
+    columns['variant_charge'] = CHARGE[variant_letters]
+    columns['charge_change'] = columns['variant_charge'] - columns['wt_charge']
+    return columns
+
+
+def annotate(fitness_df, position_column='position', amino_acid_column='amino_acid', wt_seq=WT_SEQ):
+    """Returns a copy of a variant dataframe with the annotation_columns attached, wt_amino_acid and region as
+    categorical columns, so group-bys over them stay cheap"""
+    import pandas as pd
+    columns = annotation_columns(fitness_df[position_column].to_numpy(),
+                                 fitness_df[amino_acid_column].astype(str).to_numpy(), wt_seq)
+    columns['wt_amino_acid'] = pd.Categorical.from_codes(columns['wt_amino_acid'], list(AMINO_ACIDS))
+    columns['region'] = pd.Categorical.from_codes(columns['region'], REGIONS)
+    return fitness_df.assign(**columns)
+
+
+def load_annotated_fitness(path, value_column='fitness', wt_seq=WT_SEQ):
+    """Loads the variants of a fitness csv with variant_num and variant_aa columns, a variant table or a legacy
+    pickle or text fitness dictionary into an annotated dataframe of position, amino_acid and value columns.
+    variants without a value are dropped"""
+    import pandas as pd
+    if path.endswith('.csv'):
+        fitness_df = pd.read_csv(path, header=0).rename(columns={'variant_num': 'position',
+                                                                 'variant_aa': 'amino_acid'})
+    elif is_table(path):
+        columns, metadata = read_table(path, ['position', 'amino_acid', value_column])
+        fitness_df = pd.DataFrame({'position': np.asarray(columns['position']),
+                                   'amino_acid': np.asarray(columns['amino_acid']).astype(str),
+                                   value_column: np.asarray(columns[value_column])})
+    else:
+        variant_value_dict = load_variant_dict(path, value_column)
+        fitness_df = pd.DataFrame([(position, amino_acid, value) for (position, amino_acid), value
+                                   in variant_value_dict.items()], columns=['position', 'amino_acid', value_column])
+    fitness_df = fitness_df.dropna(subset=[value_column])
+    fitness_df = fitness_df.astype({'position': np.int64})
+    return annotate(fitness_df, wt_seq=wt_seq)
+
+
+def group_statistics(fitness_df, group_columns, value_column='fitness'):
+    """number, mean and median of the values of every group of an annotated dataframe"""
+    return fitness_df.groupby(group_columns, observed=True)[value_column].agg(['count', 'mean', 'median'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to annotate variants of fitness tables with wild type
+    residue, region and amino acid classes, and print the fitness of every group of annotation columns for every
+    table""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-f', '--fitness_files', nargs='*', required=True,
+                          help='fitness csv with variant_num and variant_aa columns, variant table or legacy pickle '
+                               'or text dictionary, one per condition')
+    parser.add_argument('-g', '--group_by', nargs='*', default=['region'],
+                        help='annotation columns to group by: wt_amino_acid, region, wt_<class>, variant_<class>, '
+                             'wt_charge, variant_charge or charge_change, with classes {0}'.format(
+                                 ', '.join(AMINO_ACID_CLASSES)))
+    parser.add_argument('-v', '--value_column', default='fitness', help='column to summarize')
+    parser.add_argument('--include_stop', action='store_true', help='keep stop codon variants')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    print('\t'.join(['file'] + args.group_by + ['variants', 'mean', 'median']))
+    for fitness_file in args.fitness_files:
+        with metrics.stage('annotate {0}'.format(fitness_file)) as annotation:
+            annotated_df = load_annotated_fitness(fitness_file, args.value_column)
+            annotated_df = annotated_df[annotated_df['position'] > 0]
+            if not args.include_stop:
+                annotated_df = annotated_df[annotated_df['amino_acid'] != '*']
+            statistics = group_statistics(annotated_df, args.group_by, args.value_column)
+            annotation['records'] = len(annotated_df)
+        run_metrics.count('variants', len(annotated_df))
+        for group, row in statistics.iterrows():
+            group = group if isinstance(group, tuple) else (group,)
+            print('\t'.join([fitness_file] + [str(value) for value in group] +
+                            [str(int(row['count'])), str(round(row['mean'], 4)), str(round(row['median'], 4))]))
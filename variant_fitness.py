@@ -2,73 +2,443 @@
 
 import argparse
 import collections
-import itertools
+import multiprocessing
 import numpy as np
 import pickle
-from scipy.stats import linregress
 
+import run_metrics
+from barcode_counts import BarcodeCountMatrix
+from barcode_extraction import BarcodeExtractor, add_extraction_arguments, extractor_from_arguments, \
+    print_offset_distribution
+from barcode_index import BarcodeIndex, encode_barcodes, is_barcode_index
+from fastq_reader import fastq_batches, fastq_byte_ranges
+from columnar import read_table, table_variants, variant_columns, write_table
+from count_cache import CountCache, DEFAULT_CHECKPOINT_BYTES
+from fitness_regression import RESAMPLING_METHODS, fitness_from_counts, fitness_uncertainty
+from quality_filter import add_quality_arguments, print_quality_summary, quality_filter_from_arguments
 
-def variant_counter_from_fastqs(fastq_files, barcode_variant_dict):
-    """get counter by looping over fastq and comparing to barcode dict keys"""
 
-    variant_counter = collections.defaultdict(lambda: [0.5, 0.5, 0.5])
+_worker_barcode_index = None
 
-    for i, fastq_file in enumerate(fastq_files):
-        with open(fastq_file, 'r') as f:
-            for identifier, seq, spacer, quality in itertools.zip_longest(*[f] * 4, fillvalue=None):
-                barcode = seq[:20]
-                if barcode in barcode_variant_dict:
-                    variant_counter[barcode_variant_dict[barcode]][i] += 1
+
+def _init_counting_worker(barcode_index):
+    """barcode_index is either a BarcodeIndex or the path of an index file, which every worker memory maps so
+    that the workers share its pages"""
+    global _worker_barcode_index
+    if not isinstance(barcode_index, BarcodeIndex):
+        barcode_index = BarcodeIndex.load(barcode_index)
+    _worker_barcode_index = barcode_index
+
+
+def barcode_counts_from_fastq(fastq_file, barcode_index, start=0, end=None, max_mismatches=0, match_counter=None,
+                              checkpoint=None, extractor=None):
+    """count reads per barcode in one fastq file or in the records of a byte range of it. the barcode of each read,
+    by default its first barcode_index.barcode_length bases, is looked up in the index one block of reads at a time
+
+    Args:
+        fastq_file: plain or gzipped fastq
+        barcode_index: BarcodeIndex to search
+        start: first byte of the range to count
+        end: byte after the range to count, None counts to the end of the file
+        max_mismatches: substitutions allowed between read and barcode, 0 counts exact matches only
+        match_counter: optional collections.Counter incremented with read and match counts
+        checkpoint: optional count_cache.Checkpoint. counting resumes from its saved offset and partial counts are
+            saved every checkpoint.interval bytes
+        extractor: optional barcode_extraction.BarcodeExtractor locating barcodes in reads
+
+    Returns:
+        int64 array of read counts aligned with the rows of barcode_index
+    """
+    barcode_counts = np.zeros(len(barcode_index), dtype=np.int64)
+    if extractor is None:
+        extractor = BarcodeExtractor(barcode_index.barcode_length)
+    if match_counter is None:
+        match_counter = collections.Counter()
+    if checkpoint is not None:
+        resumed = checkpoint.load()
+        if resumed is not None:
+            start, barcode_counts, resumed_match_counter = resumed
+            match_counter.update(resumed_match_counter)
+            print('Resuming count of {0} at byte {1}'.format(fastq_file, start))
+    checkpoint_offset = start
+    for fastq_batch in fastq_batches(fastq_file, start=start, end=end):
+        count_fastq_batch(fastq_batch, barcode_index, barcode_counts, extractor, max_mismatches, match_counter)
+        if checkpoint is not None and fastq_batch.end_offset - checkpoint_offset >= checkpoint.interval:
+            checkpoint.save(fastq_batch.end_offset, barcode_counts, match_counter)
+            checkpoint_offset = fastq_batch.end_offset
+    return barcode_counts
+
+
+def count_fastq_batch(fastq_batch, barcode_index, barcode_counts, extractor, max_mismatches=0, match_counter=None):
+    """adds the reads of one fastq batch to barcode_counts, an int64 array aligned with the rows of barcode_index"""
+    keys, valid = encode_barcodes(extractor.extract(fastq_batch, match_counter))
+    barcode_counts += barcode_index.count_keys(keys, valid, max_mismatches, match_counter)
+    if match_counter is not None:
+        match_counter['reads'] += len(fastq_batch)
+
+
+def count_job(fastq_file, barcode_index, start=0, end=None, max_mismatches=0, count_cache=None, fingerprint=None,
+              extractor=None):
+    """counts one fastq byte range, or loads its counts from count_cache if they were counted before
+
+    Returns:
+        tuple of barcode counts array and match counter
+    """
+    if count_cache is None:
+        match_counter = collections.Counter()
+        barcode_counts = barcode_counts_from_fastq(fastq_file, barcode_index, start, end, max_mismatches,
+                                                   match_counter, extractor=extractor)
+        return barcode_counts, match_counter
+    key = count_cache.key(fingerprint, start, end)
+    cached = count_cache.load(key)
+    if cached is not None:
+        return cached
+    match_counter = collections.Counter()
+    barcode_counts = barcode_counts_from_fastq(fastq_file, barcode_index, start, end, max_mismatches, match_counter,
+                                               count_cache.checkpoint(key), extractor)
+    count_cache.store(key, barcode_counts, match_counter, {'fastq_file': fastq_file, 'start': start, 'end': end})
+    return barcode_counts, match_counter
+
+
+def _count_shard(shard):
+    i, fastq_file, start, end, max_mismatches, count_cache, fingerprint, extractor = shard
+    barcode_counts, match_counter = count_job(
+        fastq_file, _worker_barcode_index, start, end, max_mismatches, count_cache, fingerprint, extractor)
+    return i, start, end, barcode_counts, match_counter
+
+
+def _count_byte_ranges(fastq_file, shard_count, count_cache=None, fingerprint=None):
+    """byte ranges to count a fastq in. with a count cache, the ranges of an interrupted count are reused whatever
+    the number of workers, so its shards resume from their checkpoints, and new ranges are stored before counting"""
+    byte_ranges = count_cache.byte_ranges(fingerprint) if count_cache is not None else None
+    if byte_ranges is None:
+        byte_ranges = fastq_byte_ranges(fastq_file, shard_count)
+        if count_cache is not None:
+            count_cache.save_byte_ranges(fingerprint, byte_ranges)
+    return byte_ranges
+
+
+def _add_shard_count(shard_count, file_counts, shard_keys, barcode_count):
+    """adds the counts of one shard to the counts of its file and records the byte range of partial shards"""
+    i, start, end, barcode_counts, match_counter = shard_count
+    if i not in file_counts:
+        file_counts[i] = (np.zeros(barcode_count, dtype=np.int64), collections.Counter())
+    file_counts[i][0][:] += barcode_counts
+    file_counts[i][1].update(match_counter)
+    if (start, end) != (0, None):
+        shard_keys[i].append((start, end))
+
+
+def variant_counter_from_fastqs(fastq_files, barcode_variant_dict, barcode_length=20, workers=1, max_mismatches=0,
+                                cache_dir=None, checkpoint_bytes=DEFAULT_CHECKPOINT_BYTES, extractor=None,
+                                barcode_count_file=None, metadata=None):
+    """get counter by reading fastqs (plain or gzipped) in blocks and looking up the first barcode_length bases of
+    every read in a 2 bit packed barcode index. with max_mismatches of 1 or 2, reads without an exact match are
+    assigned to the closest barcode of a single variant and the number of rescued reads is printed per file.
+    with more than one worker, files and record aligned byte ranges of
+    plain files are counted in a process pool and the partial counts are summed per timepoint.
+    with a cache_dir, per file barcode counts are cached by fastq content, index version and max_mismatches, so
+    only new or changed fastqs are counted, and interrupted counts resume from their last checkpoint with any
+    number of workers.
+    per variant counts are summed from the sparse barcodes x timepoints count matrix, which is written to
+    barcode_count_file if given, so counts can be aggregated again with barcode filters by barcode_counts.py
+
+    Args:
+        fastq_files: fastq files in timepoint order
+        barcode_variant_dict: BarcodeIndex, path to a barcode index file, or dictionary with barcodes as keys and
+            library variants as values
+        barcode_length: length of barcodes when building an index from a dictionary
+        workers: number of counting processes
+        max_mismatches: substitutions allowed between read and barcode
+        cache_dir: optional count cache directory
+        checkpoint_bytes: bytes of fastq counted between checkpoints of the count cache
+        extractor: optional barcode_extraction.BarcodeExtractor, e.g. to locate barcodes by their flank or to
+            filter them by quality. the offsets of flank anchored barcodes and the fraction of low quality barcodes
+            are printed per file
+        barcode_count_file: optional path of the barcode count matrix
+        metadata: json serializable dict stored with the barcode count matrix
+
+    Returns:
+        defaultdict with variants as keys and lists of read counts plus a 0.5 pseudocount per timepoint as values
+    """
+
+    if isinstance(barcode_variant_dict, dict):
+        barcode_index = BarcodeIndex.from_dict(barcode_variant_dict, barcode_length)
+    elif isinstance(barcode_variant_dict, BarcodeIndex):
+        barcode_index = barcode_variant_dict
+    else:
+        barcode_index = BarcodeIndex.load(barcode_variant_dict)
+    # workers memory map an index file themselves, unless the neighbor index is built here and has to be sent
+    index_file = barcode_variant_dict if isinstance(barcode_variant_dict, str) else None
+    if extractor is not None:
+        if extractor.barcode_length is None:
+            extractor.barcode_length = barcode_index.barcode_length
+        assert extractor.barcode_length == barcode_index.barcode_length, \
+            'Extracted barcodes have {0} bases, the index {1}'.format(extractor.barcode_length,
+                                                                     barcode_index.barcode_length)
+    if max_mismatches and barcode_index.neighbor_keys is None:
+        print('Building barcode neighbor index')
+        barcode_index.build_neighbors()
+        index_file = None
+
+    file_counts = {}
+    count_cache = None
+    fingerprints = collections.defaultdict(lambda: None)
+    if cache_dir:
+        count_cache = CountCache(cache_dir, barcode_index.version, max_mismatches, checkpoint_bytes,
+                                 extractor.settings() if extractor is not None else None)
+        for i, fastq_file in enumerate(fastq_files):
+            fingerprints[i] = count_cache.fingerprint(fastq_file)
+            cached = count_cache.load(count_cache.key(fingerprints[i]))
+            if cached is not None:
+                print('Using cached counts for {0}'.format(fastq_file))
+                run_metrics.count('fastqs_from_cache')
+                file_counts[i] = cached
+    pending_files = [(i, fastq_file) for i, fastq_file in enumerate(fastq_files) if i not in file_counts]
+
+    shard_keys = collections.defaultdict(list)
+    if workers > 1 and pending_files:
+        # several shards per worker keeps the pool busy when files differ in size
+        shards_per_file = -(-4 * workers // len(pending_files))
+        shards = [(i, fastq_file, start, end, max_mismatches, count_cache, fingerprints[i], extractor)
+                  for i, fastq_file in pending_files
+                  for start, end in _count_byte_ranges(fastq_file, shards_per_file, count_cache, fingerprints[i])]
+        worker_index = index_file if index_file is not None else barcode_index
+        with multiprocessing.Pool(workers, _init_counting_worker, (worker_index,)) as pool:
+            # shard counts are added as they arrive, so only the count arrays of the running shards are kept
+            for shard_count in pool.imap_unordered(_count_shard, shards):
+                _add_shard_count(shard_count, file_counts, shard_keys, len(barcode_index))
+    else:
+        for i, fastq_file in pending_files:
+            for start, end in _count_byte_ranges(fastq_file, 1, count_cache, fingerprints[i]):
+                barcode_counts, match_counter = count_job(
+                    fastq_file, barcode_index, start, end, max_mismatches, count_cache, fingerprints[i], extractor)
+                _add_shard_count((i, start, end, barcode_counts, match_counter), file_counts, shard_keys,
+                                 len(barcode_index))
+
+    if count_cache is not None:
+        # replace the shard entries of a file by one entry for the whole file, which any worker count can reuse
+        for i, shard_ranges in shard_keys.items():
+            count_cache.store(count_cache.key(fingerprints[i]), file_counts[i][0], file_counts[i][1],
+                              {'fastq_file': fastq_files[i], 'start': 0, 'end': None})
+            for start, end in shard_ranges:
+                count_cache.remove(count_cache.key(fingerprints[i], start, end))
+        for i, fastq_file in pending_files:
+            count_cache.clear_byte_ranges(fingerprints[i])
+
+    for i, (barcode_counts, match_counter) in file_counts.items():
+        for name in ['reads', 'exact', 'one_mismatch', 'two_mismatches', 'ambiguous']:
+            run_metrics.count(name if name == 'reads' else 'reads_' + name, match_counter[name])
+        run_metrics.count('reads_with_barcode_hit', int(barcode_counts.sum()))
+    barcode_count_matrix = BarcodeCountMatrix.from_barcode_counts(
+        barcode_index, [file_counts[i][0] for i in range(len(fastq_files))])
+    if barcode_count_file:
+        barcode_count_matrix.save(barcode_count_file, dict(metadata or {}, fastq_files=fastq_files))
+    variant_counter = barcode_count_matrix.variant_counter(barcode_index)
+
+    if extractor is not None and extractor.flank:
+        print_offset_distribution(fastq_files, [file_counts[i][1] for i in range(len(fastq_files))])
+        run_metrics.count('reads_flank_not_found', sum(file_counts[i][1]['barcode_flank_not_found']
+                                                       for i in range(len(fastq_files))))
+    if extractor is not None and extractor.quality_filter is not None:
+        print_quality_summary(fastq_files, [file_counts[i][1] for i in range(len(fastq_files))])
+        run_metrics.count('reads_low_quality', sum(file_counts[i][1]['barcode_low_quality']
+                                                   for i in range(len(fastq_files))))
+    if max_mismatches:
+        print('fastq\treads\texact\trescued\tambiguous')
+        for i, fastq_file in enumerate(fastq_files):
+            match_counter = file_counts[i][1]
+            print('{0}\t{1}\t{2}\t{3}\t{4}'.format(
+                fastq_file, match_counter['reads'], match_counter['exact'],
+                match_counter['one_mismatch'] + match_counter['two_mismatches'], match_counter['ambiguous']))
     return variant_counter
 
 
-def calculate_variant_fitness(variant_timepoint_counter):
-    """uses method described in Doug Folwer's Enrich2 paper - fitness is the slope of linear regression line"""
-    variant_fitness_dict = {}
-    r2_values = []
+def variant_fitness_statistics(variant_timepoint_counter, timepoints=None, weights=None, resamples=0,
+                               resample_method='poisson', confidence=0.95, workers=1):
+    """fits wild type normalized log ratios over time for all variants in one vectorized pass. with resamples,
+    fitness is fitted again on that many resampled count sets of all variants and wild type to estimate its
+    uncertainty
+
+    Args:
+        variant_timepoint_counter: dict with variants as keys and lists of counts per timepoint as values. must
+            contain the wild type variant (0, 'WT')
+        timepoints: time of every count column, e.g. generations or hours. defaults to 0, 1, 2, ...
+        weights: optional per timepoint weights of the least squares fit
+        resamples: number of resampled count sets, 0 for no uncertainty estimate
+        resample_method: poisson or multinomial, see fitness_regression.resample_counts
+        confidence: coverage of the confidence intervals
+        workers: number of processes fitting resamples
+
+    Returns:
+        tuple of list of variants (wild type excluded) and dict of arrays aligned with it: slope, intercept,
+        r_squared, std_err, the (variants, timepoints) log_ratios and, with resamples, fitness_se, ci_low and
+        ci_high
+    """
+    variants = [variant for variant in variant_timepoint_counter if variant != (0, 'WT')]
+    wt_counts = np.array(variant_timepoint_counter[(0, 'WT')], dtype=float)
+    count_matrix = np.array([variant_timepoint_counter[variant] for variant in variants], dtype=float)
+    count_matrix = count_matrix.reshape(len(variants), len(wt_counts))
+    if timepoints is None:
+        timepoints = np.arange(len(wt_counts))
+    fitness_statistics = fitness_from_counts(count_matrix, wt_counts, timepoints, weights)
+    if resamples:
+        with run_metrics.stage('resample fitness', resamples * len(variants)):
+            fitness_statistics.update(fitness_uncertainty(count_matrix, wt_counts, timepoints, weights, resamples,
+                                                          resample_method, confidence, workers=workers))
+    return variants, fitness_statistics
+
+
+def print_poor_fits(variants, fitness_statistics, min_r_squared=0.8):
+    poor_fits = np.flatnonzero(fitness_statistics['r_squared'] < min_r_squared).tolist()
+    run_metrics.count('poor_fits', len(poor_fits))
+    run_metrics.record('poor_fits', [variants[i] for i in poor_fits])
     print('variant\tr squared\tvalues')
-    for variant, count_list in variant_timepoint_counter.items():
-        if variant == (0, 'WT'):
-            continue
-        ratio_array = np.array(count_list) / np.array(variant_timepoint_counter[(0, 'WT')])
-        m_vt = np.log(ratio_array)
-        slope, intercept, r_value, p_value, std_err = linregress([0, 1, 2], m_vt)
+    for i in poor_fits:
+        print('{0}\t{1}\t{2}'.format(
+            variants[i],
+            round(fitness_statistics['r_squared'][i], 2),
+            ' '.join(map(str, (round(y, 2) for y in fitness_statistics['log_ratios'][i])))))
+
+
+def calculate_variant_fitness(variant_timepoint_counter, timepoints=None, weights=None):
+    """uses method described in Doug Folwer's Enrich2 paper - fitness is the slope of linear regression line.
+    see variant_fitness_statistics for arguments"""
+    variants, fitness_statistics = variant_fitness_statistics(variant_timepoint_counter, timepoints, weights)
+    print_poor_fits(variants, fitness_statistics)
+    return dict(zip(variants, fitness_statistics['slope']))
+
 
-        variant_fitness_dict[variant] = slope
-        r2_values.append(r_value**2)
+def write_fitness_table(table_file, variant_timepoint_counter, variants, fitness_statistics, metadata):
+    """writes fitness statistics and per timepoint counts of all variants as a variant table. wild type counts
+    are stored in the metadata. resampled uncertainties are written as fitness_se, fitness_ci_low and
+    fitness_ci_high columns"""
+    columns = variant_columns(variants)
+    for column in ['slope', 'intercept', 'r_squared', 'std_err']:
+        columns['fitness' if column == 'slope' else column] = fitness_statistics[column]
+    for column in ['fitness_se', 'ci_low', 'ci_high']:
+        if column in fitness_statistics:
+            columns[column if column == 'fitness_se' else 'fitness_' + column] = fitness_statistics[column]
+    columns['counts'] = np.array([variant_timepoint_counter[variant] for variant in variants], dtype=float)
+    metadata = dict(metadata, wt_counts=list(variant_timepoint_counter[(0, 'WT')]))
+    write_table(table_file, columns, metadata)
 
-        if r_value**2 < 0.8:
-            print('{0}\t{1}\t{2}'.format(
-                variant,
-                round(r_value ** 2, 2),
-                ' '.join(map(str, (round(y, 2) for y in m_vt)))))
 
-    return variant_fitness_dict
+def write_count_table(table_file, variant_timepoint_counter, metadata=None):
+    """writes per timepoint counts of all variants, wild type included, as a variant table"""
+    variants = sorted(variant_timepoint_counter)
+    columns = variant_columns(variants)
+    columns['counts'] = np.array([variant_timepoint_counter[variant] for variant in variants], dtype=float)
+    write_table(table_file, columns, metadata)
+
+
+def load_count_table(table_file):
+    """dictionary of variants and lists of per timepoint counts from a table written by write_count_table"""
+    columns, metadata = read_table(table_file, mmap=False)
+    return dict(zip(table_variants(columns), columns['counts'].tolist()))
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="""script to generate a pickle file containing counts of library 
-    variants""")
+    parser = argparse.ArgumentParser(description="""script to generate a variant table containing counts and fitness
+    of library variants, and the barcodes x timepoints count matrix barcode_counts.col that barcode_counts.py
+    aggregates again with barcode filters""")
     required = parser.add_argument_group('required')
     required.add_argument('-f', '--fastq_files', nargs='*', required=True,
-                          help='illumina fastq file containing sequenced barcodes. when calculating fitness values '
-                               'it is assumed that the order of fastq files corresponds to the order of time points')
+                          help='illumina fastq file (plain or gzipped) containing sequenced barcodes. when '
+                               'calculating fitness values it is assumed that the order of fastq files corresponds '
+                               'to the order of time points')
     required.add_argument('-b', '--barcode_pickle', required=True,
-                          help='pickle containing a dictionary with barcode as keys and library variants as values. '
-                               'reads in fastq file will be searched for exact matches to dictionary keys')
+                          help='barcode index file written by barcode_index.py, or pickle containing a dictionary '
+                               'with barcode as keys and library variants as values. reads in fastq file will be '
+                               'searched for exact matches to barcodes')
     # parser.add_argument('-t', '--fitness', action='store_true',
     #                     help='calculate and output relative fitness for library variants instead of counts')
     parser.add_argument('-n', '--name_suffix')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes counting barcodes. files and byte ranges of uncompressed files '
+                             'are counted in parallel')
+    parser.add_argument('-m', '--max_mismatches', type=int, choices=[0, 1, 2], default=0,
+                        help='assign reads whose barcode is up to this many substitutions from a library barcode. '
+                             'reads equally close to barcodes of two variants are not counted')
+    parser.add_argument('-t', '--timepoints', nargs='*', type=float,
+                        help='time of each fastq file, e.g. generations or hours. defaults to 0, 1, 2, ...')
+    parser.add_argument('--weights', nargs='*', type=float,
+                        help='weight of each timepoint in the fitness regression')
+    parser.add_argument('-r', '--resamples', type=int, default=0,
+                        help='resample the counts of all variants and wild type this many times to write fitness '
+                             'standard errors and confidence intervals, e.g. 1000')
+    parser.add_argument('--resample_method', choices=RESAMPLING_METHODS, default='poisson',
+                        help='poisson: draw every count around its observed value. multinomial: bootstrap the reads '
+                             'of every timepoint')
+    parser.add_argument('--confidence', type=float, default=0.95, help='coverage of the confidence intervals')
+    parser.add_argument('-c', '--cache_dir',
+                        help='directory caching barcode counts per fastq. fastqs whose content, barcode index and '
+                             'mismatch setting are unchanged are not counted again')
+    add_extraction_arguments(parser)
+    add_quality_arguments(parser)
+    parser.add_argument('--counts_only', action='store_true',
+                        help='write the per timepoint counts of all variants to variant_counts.col without fitting '
+                             'fitness')
+    parser.add_argument('--checkpoint_bytes', type=int, default=DEFAULT_CHECKPOINT_BYTES,
+                        help='with a cache dir, save partial counts every this many bytes of fastq so an '
+                             'interrupted count resumes where it stopped')
+    run_metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
-    with open(args.barcode_pickle, 'rb') as f:
-        barcode_variant_dict = pickle.load(f)
-
-    variant_timepoint_counter = variant_counter_from_fastqs(args.fastq_files, barcode_variant_dict)
-    # TODO: have script to compare replicates, test this script
-    variant_fitness_dict = calculate_variant_fitness(variant_timepoint_counter)
-    if args.name_suffix:
-        output_file = 'variant_fitness_{0}.pkl'.format(args.name_suffix)
+    metrics = run_metrics.start_run(args)
+    if args.timepoints and len(args.timepoints) != len(args.fastq_files):
+        raise IOError('one timepoint is required per fastq file')
+    if args.weights and len(args.weights) != len(args.fastq_files):
+        raise IOError('one weight is required per fastq file')
+    if is_barcode_index(args.barcode_pickle):
+        barcode_variant_dict = args.barcode_pickle
+    else:
+        with open(args.barcode_pickle, 'rb') as f:
+            barcode_variant_dict = pickle.load(f)
+
+    barcode_extractor = extractor_from_arguments(args, quality_filter=quality_filter_from_arguments(args))
+    barcode_count_file = 'barcode_counts_{0}.col'.format(args.name_suffix) if args.name_suffix else \
+        'barcode_counts.col'
+    with metrics.stage('count barcodes', profile=True) as counting:
+        variant_timepoint_counter = variant_counter_from_fastqs(
+            args.fastq_files, barcode_variant_dict, workers=args.workers, max_mismatches=args.max_mismatches,
+            cache_dir=args.cache_dir, checkpoint_bytes=args.checkpoint_bytes, extractor=barcode_extractor,
+            barcode_count_file=barcode_count_file, metadata={
+                'sample': args.name_suffix,
+                'barcode_index': args.barcode_pickle,
+                'max_mismatches': args.max_mismatches,
+                'barcode_extraction': barcode_extractor.settings(),
+            })
+        counting['records'] = metrics.counters['reads']
+    if args.counts_only:
+        count_file = 'variant_counts_{0}.col'.format(args.name_suffix) if args.name_suffix else 'variant_counts.col'
+        write_count_table(count_file, variant_timepoint_counter, {
+            'sample': args.name_suffix,
+            'fastq_files': args.fastq_files,
+            'barcode_index': args.barcode_pickle,
+            'max_mismatches': args.max_mismatches,
+            'barcode_extraction': barcode_extractor.settings(),
+        })
     else:
-        output_file = 'variant_fitness.pkl'
-    with open(output_file, 'wb') as f:
-        pickle.dump(variant_fitness_dict, f)
+        # TODO: have script to compare replicates, test this script
+        with metrics.stage('fit fitness', len(variant_timepoint_counter)):
+            variants, fitness_statistics = variant_fitness_statistics(
+                variant_timepoint_counter, args.timepoints, args.weights, args.resamples, args.resample_method,
+                args.confidence, args.workers)
+        print_poor_fits(variants, fitness_statistics)
+        if args.name_suffix:
+            output_file = 'variant_fitness_{0}.col'.format(args.name_suffix)
+        else:
+            output_file = 'variant_fitness.col'
+        timepoints = args.timepoints or list(range(len(args.fastq_files)))
+        write_fitness_table(output_file, variant_timepoint_counter, variants, fitness_statistics, {
+            'sample': args.name_suffix,
+            'fastq_files': args.fastq_files,
+            'timepoints': timepoints,
+            'weights': args.weights,
+            'resamples': args.resamples,
+            'resample_method': args.resample_method if args.resamples else None,
+            'confidence': args.confidence if args.resamples else None,
+            'barcode_index': args.barcode_pickle,
+            'max_mismatches': args.max_mismatches,
+            'barcode_extraction': barcode_extractor.settings(),
+        })
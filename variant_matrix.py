@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import argparse
+
+import numpy as np
+
+import run_metrics
+from columnar import is_table, load_variant_dict, read_table, variant_columns
+
+WT_SEQ = 'MDVFMKGLSKAKEGVVAAAEKTKQGVAEAAGKTKEGVLYVGSKTKEGVVHGVATVAEKTKEQVTNVGGAVV' \
+         'TGVTAVAQKTVEGAGSIAAATGFVKKDQLGKNEEGAPQEGILEDMPVDPDNEAYEMPSEEGYQDYEPEA'
+AMINO_ACIDS = 'AVILMFYWSTNQHKRDECGP*'
+# the 20 amino acids without the stop codon, the columns of heatmaps and position averages
+PROTEIN_AMINO_ACIDS = AMINO_ACIDS[:-1]
+
+# column of every amino acid letter, -1 for other bytes
+AMINO_ACID_COLUMNS = np.full(256, -1, dtype=np.int8)
+AMINO_ACID_COLUMNS[np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)] = np.arange(len(AMINO_ACIDS))
+
+
+class VariantMatrix(object):
+    """Dense positions x amino acids array of per variant values, e.g. fitness, with NaN for variants without a
+    value. rows are consecutive positions of the wild type sequence, columns are AMINO_ACIDS
+
+    Args:
+        values: (positions, 21) float array
+        wt_residues: wild type amino acid of every row
+        first_position: position of the first row, 1 based
+        wt_fitness: value of the wild type variant (0, 'WT'), subtracted by normalized
+    """
+
+    def __init__(self, values, wt_residues=WT_SEQ, first_position=1, wt_fitness=0.0):
+        assert values.shape == (len(wt_residues), len(AMINO_ACIDS)), \
+            'Values must be a {0} x {1} array'.format(len(wt_residues), len(AMINO_ACIDS))
+        self.values = values
+        self.wt_residues = wt_residues
+        self.first_position = first_position
+        self.wt_fitness = wt_fitness
+        self.wt_mask = np.arange(len(AMINO_ACIDS)) == AMINO_ACID_COLUMNS[
+            np.frombuffer(wt_residues.encode(), dtype=np.uint8)][:, None]
+
+    @classmethod
+    def from_columns(cls, positions, amino_acids, values, wt_seq=WT_SEQ):
+        """Builds the matrix from position, amino acid and value columns of a variant table in one vectorized
+        step. variants outside the wild type sequence or with other amino acid codes are ignored"""
+        positions = np.asarray(positions, dtype=np.int64)
+        amino_acids = np.asarray(amino_acids, dtype='S')
+        values = np.asarray(values, dtype=float)
+        letters = amino_acids.view(np.uint8).reshape(len(amino_acids), -1)
+        columns = AMINO_ACID_COLUMNS[letters[:, 0]].astype(np.int64)
+        single_letter = letters[:, 1:].sum(axis=1) == 0 if letters.shape[1] > 1 else np.ones(len(letters), bool)
+        valid = (positions >= 1) & (positions <= len(wt_seq)) & (columns >= 0) & single_letter
+        matrix = np.full((len(wt_seq), len(AMINO_ACIDS)), np.nan)
+        matrix[positions[valid] - 1, columns[valid]] = values[valid]
+        wt_rows = np.flatnonzero((positions == 0) & (amino_acids == b'WT'))
+        wt_fitness = float(values[wt_rows[0]]) if len(wt_rows) and not np.isnan(values[wt_rows[0]]) else 0.0
+        return cls(matrix, wt_seq, 1, wt_fitness)
+
+    @classmethod
+    def from_dict(cls, variant_value_dict, wt_seq=WT_SEQ):
+        """Builds the matrix from a dictionary of (position, amino acid) keys and float values"""
+        columns = variant_columns(list(variant_value_dict.keys()))
+        return cls.from_columns(columns['position'], columns['amino_acid'], list(variant_value_dict.values()),
+                                wt_seq)
+
+    @classmethod
+    def from_table(cls, path, value_column='fitness', wt_seq=WT_SEQ):
+        """Builds the matrix from a variant table, reading only the position, amino acid and value columns, or
+        from a legacy pickle or text fitness dictionary"""
+        if not is_table(path):
+            return cls.from_dict(load_variant_dict(path, value_column), wt_seq)
+        columns, metadata = read_table(path, ['position', 'amino_acid', value_column])
+        return cls.from_columns(columns['position'], columns['amino_acid'], columns[value_column], wt_seq)
+
+    @property
+    def positions(self):
+        return np.arange(self.first_position, self.first_position + len(self.values))
+
+    @property
+    def missing(self):
+        """mask of variants without a value"""
+        return np.isnan(self.values)
+
+    def normalized(self):
+        """matrix of values relative to the wild type variant, with 0 for wild type amino acids without a value of
+        their own"""
+        values = self.values - self.wt_fitness
+        values[self.wt_mask & np.isnan(values)] = 0
+        return VariantMatrix(values, self.wt_residues, self.first_position, 0.0)
+
+    def sliced(self, first_position, last_position):
+        """matrix of the rows of positions first_position to last_position, both included"""
+        assert self.first_position <= first_position <= last_position < self.first_position + len(self.values), \
+            'Positions {0}-{1} are outside the matrix'.format(first_position, last_position)
+        start = first_position - self.first_position
+        stop = last_position - self.first_position + 1
+        return VariantMatrix(self.values[start:stop], self.wt_residues[start:stop], first_position, self.wt_fitness)
+
+    def _columns(self, amino_acids):
+        return [AMINO_ACIDS.index(amino_acid) for amino_acid in amino_acids]
+
+    def position_means(self, amino_acids=PROTEIN_AMINO_ACIDS):
+        """mean over the amino acids of every position, NaN for positions without values"""
+        values = self.values[:, self._columns(amino_acids)]
+        counts = (~np.isnan(values)).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nansum(values, axis=1) / counts
+
+    def amino_acid_means(self, amino_acids=PROTEIN_AMINO_ACIDS, exclude_wt=True):
+        """mean over the positions of every amino acid, by default without wild type residues"""
+        columns = self._columns(amino_acids)
+        values = np.where(self.wt_mask, np.nan, self.values)[:, columns] if exclude_wt else self.values[:, columns]
+        counts = (~np.isnan(values)).sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nansum(values, axis=0) / counts
+
+    def to_dataframe(self, amino_acids=PROTEIN_AMINO_ACIDS):
+        """positions by amino acids dataframe"""
+        import pandas as pd
+        return pd.DataFrame(self.values[:, self._columns(amino_acids)], index=self.positions,
+                            columns=list(amino_acids))
+
+
+def position_range_arguments(position_range, default_range=(1, len(WT_SEQ))):
+    """first and last position from a range argument of first and last position separated by a dash"""
+    if not position_range:
+        return default_range
+    first_position, last_position = map(int, position_range.split('-'))
+    return first_position, last_position
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="""script to print the wild type normalized positions by amino
+    acids fitness matrix of a variant table""")
+    required = parser.add_argument_group('required')
+    required.add_argument('-p', '--pickle_file', required=True,
+                          help='input variant table, or legacy pickle / text dictionary with keys as tuple of '
+                               'postion, amino acid and values as fitness floats')
+    parser.add_argument('-r', '--position_range',
+                        help='range of positions to print. first and last position separated by dash')
+    parser.add_argument('-v', '--value_column', default='fitness', help='column of variant tables to use')
+    run_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = run_metrics.start_run(args)
+
+    with metrics.stage('load variant matrix') as loading:
+        variant_matrix = VariantMatrix.from_table(args.pickle_file, args.value_column).normalized()
+        variant_matrix = variant_matrix.sliced(*position_range_arguments(args.position_range))
+        loading['records'] = len(variant_matrix.positions)
+    print('\t'.join(['position'] + list(AMINO_ACIDS)))
+    for row_position, row_values in zip(variant_matrix.positions.tolist(), variant_matrix.values.tolist()):
+        print('\t'.join([str(row_position)] + [str(round(value, 4)) for value in row_values]))